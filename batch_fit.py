@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+"""
+Batch fitting of many independent samples.
+
+Takes a directory or a list of Core Labs .xlsx reports and/or .csv compositions
+(SCN, mfi_lab, wfi_lab columns as used by gamma_distribution.py), sends every
+independent fit to a process pool and streams the results back as each one
+finishes. A failing sample is reported and the rest of the batch carries on.
+
+Long-format .csv archives of many samples (sample_id, SCN, mfi, wfi columns,
+one row per sample and SCN) are read in chunks while the samples already read
+are being fitted, so memory is bounded by the chunk size whatever the number
+of rows; only the ids of the samples read so far are kept, and a sample whose
+rows are not contiguous is reported as a failed fit.
+Their results are appended to one <archive>_results.csv and one
+<archive>_gamma.csv file with a sample_id column.
+
+Usage example:
+    python batch_fit.py DATA --workers 8 --mode sample --out-dir fits
+    python batch_fit.py export.csv --workers 8 --chunksize 200000 --out-dir fits
+
+GitHub: https://github.com/dimmol/gamma_dist
+"""
+
+import argparse
+import os
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+
+import numpy as np
+import pandas as pd
+
+from corelab_reader import CoreLabsXLSXLoader, FlashExpDataCollection, FlashExperimentData
+from fit_cache import FitCache
+from fit_monitor import FitMonitor
+from gamma_distribution import gamma_distribution_fit
+
+# Columns expected in a .csv composition input.
+CSV_COLUMNS = ['SCN', 'mfi_lab', 'wfi_lab']
+
+# Columns of a long-format .csv archive: one row per sample and SCN. mfi and
+# wfi can also be named mfi_lab and wfi_lab. An optional sample_mw column
+# gives the whole sample MW of every sample.
+LONG_CSV_COLUMNS = ['sample_id', 'SCN', 'mfi', 'wfi']
+
+# Files of the sources (directories are listed in name order).
+def source_paths(sources):
+    if isinstance(sources, str):
+        sources = [sources]
+    paths = []
+    for source in sources:
+        if os.path.isdir(source):
+            paths.extend(os.path.join(source, name) for name in sorted(os.listdir(source)))
+        else:
+            paths.append(source)
+    return paths
+
+# A .csv whose header cannot be read is not taken for an archive: it is left
+# to collect_tasks, which reports it as a failed task.
+def is_long_csv(path):
+    if os.path.splitext(path)[1].lower() != '.csv':
+        return False
+    try:
+        return 'sample_id' in pd.read_csv(path, nrows=0).columns
+    except Exception:
+        return False
+
+# A task is a (path, worksheets) tuple. For .csv inputs worksheets is None.
+# In 'sample' mode every flash worksheet of a report is fitted on its own,
+# in 'collection' mode all flash worksheets of a report are fitted together
+# with shared alpha and SCN bounds. Long-format .csv archives are left to
+# iter_stream_fits. A file that cannot be read (e.g. a corrupt report or an
+# empty .csv) becomes a (path, None) task, so the worker reports it as a
+# failed task with the error and the rest of the batch still runs.
+def collect_tasks(sources, mode='sample'):
+    if mode not in ('sample', 'collection'):
+        raise ValueError("mode must be 'sample' or 'collection'")
+    tasks = []
+    for path in source_paths(sources):
+        ext = os.path.splitext(path)[1].lower()
+        if ext not in ('.xlsx', '.csv'):
+            continue
+        try:
+            if ext == '.xlsx':
+                worksheets = CoreLabsXLSXLoader(path).flash_sheet_names()
+            else:
+                columns = pd.read_csv(path, nrows=0).columns
+        except Exception:
+            tasks.append((path, None))
+            continue
+        if ext == '.xlsx':
+            # Not a flash report (e.g. the components database).
+            if not worksheets:
+                continue
+            if mode == 'sample':
+                tasks.extend((path, [worksheet]) for worksheet in worksheets)
+            else:
+                tasks.append((path, worksheets))
+        elif 'sample_id' not in columns and all(column in columns for column in CSV_COLUMNS):
+            tasks.append((path, None))
+    return tasks
+
+# Flash samples of the report parsed last in this process, keyed by path,
+# size and modification time. Opening a workbook costs far more than parsing
+# its flash worksheets, and the tasks of a report are queued together, so a
+# worker parses every report once rather than once per worksheet task.
+_report_samples = {}
+
+def _read_report(path):
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _report_samples:
+        _report_samples.clear()
+        _report_samples[key] = dict(CoreLabsXLSXLoader(path).iter_samples())
+    return _report_samples[key]
+
+# Reading the input of a task: the composition dataframe of a .csv input or
+# the FlashExpDataCollection of the report worksheets. The path can also be
+# an open binary file (e.g. an uploaded report). Samples of a report file are
+# copies of the parsed ones, so fitting them leaves the parsed report as read.
+# A report without worksheets (one collect_tasks could not read) is read whole.
+def parse_task(task):
+    path, worksheets = task
+    if worksheets is None:
+        if isinstance(path, str) and os.path.splitext(path)[1].lower() == '.xlsx':
+            return CoreLabsXLSXLoader(path).read()
+        return pd.read_csv(path, header = 0, index_col = False)
+    if not isinstance(path, str):
+        return CoreLabsXLSXLoader(path, worksheet=worksheets).read()
+    samples = _read_report(path)
+    data = FlashExpDataCollection()
+    for worksheet in worksheets:
+        sample = samples[worksheet]
+        data.add_sample(worksheet, FlashExperimentData.from_arrays(
+            sample.components, sample.values, sample.av_lqd_mw, sample.depth, sample.cylinder))
+    return data
+
+# Fitting the parsed input of a task. Returns the regression results and a
+# dictionary of the best fit data of every sample. A .csv composition needs
+# the whole sample MW: there is no default to fall back on. A fit ending with
+# a non-finite RMSE raises like any other failure.
+def fit_parsed(data, sample_mw=None, ave_MC10plus=None, ita=None, cache=None, monitor=None,
+               name=None):
+    if isinstance(data, pd.DataFrame):
+        if sample_mw is None:
+            raise ValueError('no sample MW for %s: pass sample_mw (--sample-mw) or add a '
+                             'sample_mw column to the archive' % name)
+        res_df, out_df = gamma_distribution_fit(data, sample_mw, ave_MC10plus, ita,
+                                                cache=cache, monitor=monitor)
+        output = {name: out_df}
+    else:
+        res_df = data.gamma_distribution_fit(results_path=None, verbose=False, cache=cache,
+                                             monitor=monitor)
+        output = {key: item.gamma_output for key, item in data.items()}
+    rmse = res_df['Values'].iloc[-1]
+    if not np.isfinite(rmse):
+        raise ValueError('the fit of %s failed: RMSE is %s' % (name, rmse))
+    return res_df, output
+
+# Fitting a single task. Runs in a worker process and never raises: failures
+# are returned as part of the result. cache_dir enables the fit cache and
+# monitor_path appends parse and fit records (see fit_monitor) to a JSON lines file.
+def run_task(task, sample_mw=None, ave_MC10plus=None, ita=None, cache_dir=None,
+             monitor_path=None):
+    path, worksheets = task
+    cache = FitCache(cache_dir) if cache_dir else None
+    start_time = time.time()
+    result = {'source': path, 'worksheets': worksheets,
+              'samples': worksheets or [os.path.basename(path)],
+              'ok': False, 'results': None, 'output': {}, 'error': None}
+    monitor = None
+    if monitor_path:
+        monitor = FitMonitor(jsonl_path=monitor_path, iterations=False,
+                             label=path+' '+', '.join(result['samples']))
+    try:
+        data = parse_task(task)
+        if monitor is not None:
+            monitor.emit({'event': 'parse', 'label': monitor.label,
+                          'time_parse_s': time.time()-start_time})
+        result['results'], result['output'] = fit_parsed(data, sample_mw, ave_MC10plus, ita, cache,
+                                                         monitor, result['samples'][0])
+        result['ok'] = True
+    except Exception:
+        result['error'] = traceback.format_exc()
+    result['elapsed'] = time.time()-start_time
+    return result
+
+# Generator yielding task results in the order they finish.
+# workers=None uses all available cores.
+def iter_batch_fits(tasks, workers=None, sample_mw=None, ave_MC10plus=None, ita=None,
+                    cache_dir=None, monitor_path=None):
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_task, task, sample_mw, ave_MC10plus, ita, cache_dir,
+                                   monitor_path)
+                   for task in tasks]
+        for future in as_completed(futures):
+            yield future.result()
+
+# Generator reading a long-format .csv archive in chunks of chunksize rows.
+# Yields (sample_id, composition, sample MW) for every sample as soon as its
+# last row has been read. The composition has the CSV_COLUMNS expected by
+# gamma_distribution_fit and the sample MW is None without a sample_mw
+# column. Rows of a sample have to be contiguous (e.g. the archive is sorted
+# by sample_id): only the current chunk and the sample running over its end
+# are held in memory, plus the set of sample ids already read. That set grows
+# with the number of samples (not rows) and is what catches a sample whose
+# rows are split: a later run of rows of a sample already read is yielded
+# with a ValueError in place of the composition, so run_samples reports it
+# as a failed fit and the rest of the archive is still read.
+def iter_long_csv(path, chunksize=100000):
+    columns = pd.read_csv(path, nrows=0).columns
+    names = {'mfi': 'mfi_lab', 'wfi': 'wfi_lab'}
+    usecols = [column for column in LONG_CSV_COLUMNS+list(names.values())+['sample_mw']
+               if column in columns]
+    missing = [column for column in LONG_CSV_COLUMNS
+               if column not in columns and names.get(column) not in columns]
+    if missing:
+        raise ValueError('missing .csv columns: %s' % ', '.join(missing))
+    seen, rest = set(), None
+    for chunk in pd.read_csv(path, usecols=usecols, dtype={'sample_id': str, 'SCN': str},
+                             chunksize=chunksize):
+        chunk = chunk.rename(columns=names)
+        if rest is not None:
+            chunk = pd.concat([rest, chunk], ignore_index=True)
+        ids = chunk['sample_id'].values
+        starts = np.flatnonzero(np.append(True, ids[1:] != ids[:-1]))
+        # The last sample of the chunk may go on in the next one.
+        for start, end in zip(starts[:-1], starts[1:]):
+            yield _long_csv_sample(chunk, start, end, seen)
+        rest = chunk.iloc[starts[-1]:]
+    if rest is not None:
+        yield _long_csv_sample(rest, 0, len(rest), seen)
+
+def _long_csv_sample(chunk, start, end, seen):
+    sample_id = chunk['sample_id'].iat[start]
+    if sample_id in seen:
+        return sample_id, ValueError('rows of sample %s are not contiguous: only its first '
+                                     'run of rows is fitted' % sample_id), None
+    seen.add(sample_id)
+    sample_mw = float(chunk['sample_mw'].iat[start]) if 'sample_mw' in chunk.columns else None
+    comp_input = pd.DataFrame({column: chunk[column].values[start:end] for column in CSV_COLUMNS})
+    return sample_id, comp_input, sample_mw
+
+# Fitting a batch of samples read by iter_long_csv. Runs in a worker process
+# and returns one result per sample in the format of run_task. A sample read
+# with an error in place of its composition is a failed result.
+def run_samples(path, samples, sample_mw=None, ave_MC10plus=None, ita=None, cache_dir=None,
+                monitor_path=None):
+    cache = FitCache(cache_dir) if cache_dir else None
+    results = []
+    for sample_id, comp_input, mw in samples:
+        start_time = time.time()
+        result = {'source': path, 'worksheets': None, 'samples': [sample_id],
+                  'ok': False, 'results': None, 'output': {}, 'error': None}
+        monitor = None
+        if monitor_path:
+            monitor = FitMonitor(jsonl_path=monitor_path, iterations=False,
+                                 label=path+' '+sample_id)
+        if mw is None or np.isnan(mw):
+            mw = sample_mw
+        try:
+            if isinstance(comp_input, Exception):
+                raise comp_input
+            result['results'], result['output'] = fit_parsed(comp_input, mw, ave_MC10plus, ita,
+                                                             cache, monitor, sample_id)
+            result['ok'] = True
+        except Exception:
+            result['error'] = traceback.format_exc()
+        result['elapsed'] = time.time()-start_time
+        results.append(result)
+    return results
+
+# Generator fitting a long-format .csv archive while it is being read. Samples
+# are sent to the process pool in batches of batch_size and reading pauses
+# while max_pending batches (by default two per worker) are waiting or being
+# fitted. Yields the result of every sample in the order they finish, as
+# they come in.
+def iter_stream_fits(path, workers=None, sample_mw=None, ave_MC10plus=None, ita=None,
+                     cache_dir=None, monitor_path=None, chunksize=100000, batch_size=16,
+                     max_pending=None):
+    max_pending = max_pending or 2*(workers or os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending, batch = set(), []
+
+        def submit(batch):
+            return executor.submit(run_samples, path, batch, sample_mw, ave_MC10plus, ita,
+                                   cache_dir, monitor_path)
+
+        for sample in iter_long_csv(path, chunksize):
+            batch.append(sample)
+            if len(batch) < batch_size:
+                continue
+            if len(pending) >= max_pending:
+                wait(pending, return_when=FIRST_COMPLETED)
+            done = {future for future in pending if future.done()}
+            pending -= done
+            for future in done:
+                yield from future.result()
+            pending.add(submit(batch))
+            batch = []
+        if batch:
+            pending.add(submit(batch))
+        for future in as_completed(pending):
+            yield from future.result()
+
+# Appending the regression results and best fit data of a streamed sample to
+# the open archive output files, with a leading sample_id column.
+def append_result(result, files):
+    sample_id = result['samples'][0]
+    for f, df in zip(files, (result['results'], result['output'][sample_id])):
+        df = df.assign(sample_id=sample_id)[['sample_id']+list(df.columns)]
+        df.to_csv(f, header=(f.tell() == 0), index=False)
+
+# Writing the best fit data and regression results of a finished task.
+def write_result(result, out_dir):
+    stem = os.path.splitext(os.path.basename(result['source']))[0]
+    if result['worksheets'] is not None and len(result['worksheets']) == 1:
+        stem = stem+'_'+result['worksheets'][0]
+    result['results'].to_csv(os.path.join(out_dir, stem+'_results.csv'))
+    for key, df in result['output'].items():
+        name = stem if len(result['output']) == 1 else stem+'_'+key
+        df.to_csv(os.path.join(out_dir, name+'_gamma.csv'))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Batch gamma distribution fitting.')
+    parser.add_argument('sources', nargs='+',
+                        help='directories, .xlsx Core Labs reports, .csv compositions or '
+                             'long-format .csv archives')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default: all cores)')
+    parser.add_argument('--mode', choices=['sample', 'collection'], default='sample',
+                        help='fit report samples one by one or as a shared-alpha collection')
+    parser.add_argument('--out-dir', default=None, help='directory for the fit results')
+    parser.add_argument('--sample-mw', type=float, default=None,
+                        help='whole sample MW for .csv inputs (required unless a long-format '
+                             'archive has a sample_mw column)')
+    parser.add_argument('--c10-mw', type=float, default=None,
+                        help='initial C10+ MW estimate for .csv inputs (default: from the '
+                             'lab MWs)')
+    parser.add_argument('--ita', type=float, default=None,
+                        help='initial C10 lower bound for .csv inputs (default: from the '
+                             'lab MWs)')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory of the fit cache (re-fits of unchanged samples are skipped)')
+    parser.add_argument('--monitor', default=None,
+                        help='JSON lines file for parse and fit instrumentation records')
+    parser.add_argument('--chunksize', type=int, default=100000,
+                        help='rows read at a time from long-format .csv archives')
+    parser.add_argument('--batch-size', type=int, default=16,
+                        help='archive samples sent to a worker at a time')
+    args = parser.parse_args(argv)
+
+    start_time = time.time()
+    streams = [path for path in source_paths(args.sources) if is_long_csv(path)]
+    tasks = collect_tasks([path for path in source_paths(args.sources) if path not in streams],
+                          args.mode)
+    if args.out_dir:
+        os.makedirs(args.out_dir, exist_ok=True)
+    count, failed = len(tasks), 0
+
+    def report(result):
+        label = result['source']+' '+', '.join(result['samples'])
+        if result['ok']:
+            rmse = result['results']['Values'].iloc[-1]
+            print('OK     %s  RMSE: %.4f  (%.2f s)' % (label, rmse, result['elapsed']))
+        else:
+            print('FAILED %s\n%s' % (label, result['error']))
+        return result['ok']
+
+    for result in iter_batch_fits(tasks, args.workers, args.sample_mw, args.c10_mw, args.ita,
+                                  args.cache_dir, args.monitor):
+        if not report(result):
+            failed += 1
+        elif args.out_dir:
+            write_result(result, args.out_dir)
+    for path in streams:
+        files = []
+        if args.out_dir:
+            stem = os.path.join(args.out_dir, os.path.splitext(os.path.basename(path))[0])
+            files = [open(stem+suffix, 'w', newline='') for suffix in ('_results.csv', '_gamma.csv')]
+        try:
+            for result in iter_stream_fits(path, args.workers, args.sample_mw, args.c10_mw,
+                                           args.ita, args.cache_dir, args.monitor,
+                                           args.chunksize, args.batch_size):
+                count += 1
+                if not report(result):
+                    failed += 1
+                elif files:
+                    append_result(result, files)
+        except Exception:
+            # The archive could not be read on (e.g. missing columns).
+            count += 1
+            failed += 1
+            print('FAILED %s\n%s' % (path, traceback.format_exc()))
+        finally:
+            for f in files:
+                f.close()
+    print('%d tasks, %d failed' % (count, failed))
+    print("--- Execution time %s seconds ---" % (time.time() - start_time))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
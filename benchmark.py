@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for parsing and gamma distribution fitting on synthetic data.
+
+Synthetic C10+ compositions are generated from known gamma parameters (alpha,
+ita and heavy end MW) so that, besides timings, the parameter recovery error
+of the fits can be reported. Synthetic Core Labs style workbooks are written
+with the same layout as the real reports for the parsing benchmark.
+
+Every benchmark prints one JSON record per line (wall time, evaluations per
+second, peak traced memory, recovery errors), e.g.:
+    python benchmark.py --samples 50 --output bench.jsonl
+
+GitHub: https://github.com/dimmol/gamma_dist
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from corelab_reader import CoreLabsXLSXLoader, FlashExperimentData, FlashExpDataCollection, component_database
+from gamma_distribution import BoundModel, gamma_distribution_fit, gamma_integrals
+
+# Components ahead of C10 in a Core Labs composition table with their flashed
+# liquid mole percents (taken from a real report, used as relative amounts).
+LIGHT_ROWS = [('H2', 'Hydrogen', 0.0), ('H2S', 'Hydrogen sulphide', 0.0),
+              ('CO2', 'Carbon dioxide', 0.0), ('N2', 'Nitrogen', 0.0),
+              ('C1', 'Methane', 0.058), ('C2', 'Ethane', 0.162), ('C3', 'Propane', 0.676),
+              ('iC4', 'i-Butane', 0.424), ('nC4', 'n-Butane', 1.026),
+              ('C5', 'neo-Pentane', 0.033), ('iC5', 'i-Pentane', 1.024),
+              ('nC5', 'n-Pentane', 1.047), ('C6', 'Hexanes', 3.398),
+              ('C6', 'Me-Cyclo-pentane', 1.193), ('C6', 'Benzene', 0.037),
+              ('C6', 'Cyclo-hexane', 1.393), ('C7', 'Heptanes', 6.359),
+              ('C7', 'Me-Cyclo-hexane', 4.355), ('C7', 'Toluene', 0.407),
+              ('C8', 'Octanes', 10.277), ('C8', 'Ethyl-benzene', 0.146),
+              ('C8', 'Meta/Para-xylene', 0.885), ('C8', 'Ortho-xylene', 0.253),
+              ('C9', 'Nonanes', 8.683), ('C9', 'Tri-Me-benzene', 0.496)]
+
+# C10+ gamma model for given parameters. SCN n spans the MW interval between
+# the bounds of the SCNs (from ita to the plus fraction, by default from
+# scn_bounds). Returns SCN names and the mole fractions, weight fractions and
+# MWs of the SCN groups.
+def gamma_model(alpha, ita, mw_plus, n_scn=27, bounds=None):
+    scn = np.arange(10, 10+n_scn)
+    names = ['C'+str(n) for n in scn[:-1]]+['C'+str(scn[-1])+'+']
+    if bounds is None:
+        bounds = scn_bounds(alpha, ita, mw_plus, n_scn)
+    beta = (mw_plus-ita)/alpha
+    p0, p1 = gamma_integrals((bounds-ita)/beta, alpha)
+    mi = ita+alpha*beta*np.diff(p1)/np.diff(p0)
+    zi = np.diff(p0)
+    wi = zi*mi
+    return names, zi/zi.sum(), wi/wi.sum(), mi
+
+# SCN bounds of the gamma model: ita, the upper bound of every SCN and 100000
+# for the plus fraction. SCN n ends near the midpoint 14n+3 of the nominal SCN
+# MWs 14n-4, moved to within half the BoundModel tolerance of the midpoint of
+# the modelled SCN MWs: RegressionLayout centres the solver box of every SCN
+# bound there, so the true bounds are feasible in a fit of the synthetic data.
+def scn_bounds(alpha, ita, mw_plus, n_scn=27, max_iter=1000):
+    scn = np.arange(10, 10+n_scn-1)
+    nominal = 14*scn+3.
+    tolerance = 0.5*np.array([BoundModel().scn_tolerance(n) for n in scn])
+    inner = nominal
+    for _ in range(max_iter):
+        bounds = np.concatenate(([ita], inner, [100000.]))
+        mi = gamma_model(alpha, ita, mw_plus, n_scn, bounds)[3]
+        mid = (mi[:-1]+mi[1:])/2
+        inner, previous = np.clip(nominal, mid*(1-tolerance), mid*(1+tolerance)), inner
+        if np.abs(inner-previous).max() < 1e-9:
+            break
+    return np.concatenate(([ita], inner, [100000.]))
+
+# Synthetic C10+ composition in the gamma_distribution.py .csv input format.
+# As the composition is the C10+ fraction only, the sample MW is the C10+ MW.
+# noise is the relative standard deviation of multiplicative noise on wfi_lab.
+def synthetic_composition(alpha, ita, mw_plus, n_scn=27, noise=0.0, rng=None):
+    rng = rng or np.random.default_rng()
+    names, zi, wi, mi = gamma_model(alpha, ita, mw_plus, n_scn)
+    wi = wi*(1+noise*rng.standard_normal(len(wi)))
+    return pd.DataFrame({'SCN': names, 'mfi_lab': 100*zi, 'wfi_lab': 100*wi}), mw_plus
+
+# Synthetic flashed liquid table (as produced by CoreLabsXLSXLoader) and its
+# average MW. c10_plus is the C10+ mole fraction of the liquid and bounds the
+# SCN bounds of the gamma model.
+def synthetic_liquid(alpha, ita, mw_plus, n_scn=27, c10_plus=0.6, noise=0.0, rng=None,
+                     bounds=None):
+    rng = rng or np.random.default_rng()
+    names, zi, wi, mi = gamma_model(alpha, ita, mw_plus, n_scn, bounds)
+    pc_db = component_database().set_index('CoreLab Name')
+    light_mp = np.array([row[2] for row in LIGHT_ROWS])
+    light_mp = 100*(1-c10_plus)*light_mp/light_mp.sum()
+    light_mw = pc_db.loc[[row[1] for row in LIGHT_ROWS], 'MW_lab'].values
+    heavy_mp = 100*c10_plus*zi
+    heavy_mp = heavy_mp*(1+noise*rng.standard_normal(len(heavy_mp)))
+    mp = np.concatenate((light_mp, heavy_mp))
+    mw = np.concatenate((light_mw, mi))
+    av_mw = (mp*mw).sum()/mp.sum()
+    wp = 100*mp*mw/(mp*mw).sum()
+    liquid = pd.DataFrame({'scn': [row[0] for row in LIGHT_ROWS]+names,
+                           'cl_name': [row[1] for row in LIGHT_ROWS]+names,
+                           'lqd_mp': mp, 'lqd_wp': wp})
+    return liquid, av_mw
+
+# Parameters of n synthetic samples: shared alpha and ita, heavy end MWs
+# spread around 225.
+def synthetic_parameters(n, rng, alpha=0.85, ita=130.0):
+    return [(alpha, ita, mw) for mw in rng.uniform(205.0, 245.0, n)]
+
+# Collection of synthetic samples. The samples share the SCN bounds of the
+# first one, as the layout of a collection fit centres its boxes on them.
+def synthetic_collection(params, n_scn=27, noise=0.0, rng=None):
+    samples = FlashExpDataCollection([])
+    bounds = scn_bounds(*params[0], n_scn=n_scn)
+    for i, (alpha, ita, mw_plus) in enumerate(params):
+        liquid, av_mw = synthetic_liquid(alpha, ita, mw_plus, n_scn, noise=noise, rng=rng,
+                                         bounds=bounds)
+        gas = liquid.rename(columns={'lqd_mp': 'gas_mp', 'lqd_wp': 'gas_wp'})
+        gas[['gas_mp', 'gas_wp']] = 0.0
+        res = liquid.rename(columns={'lqd_mp': 'res_mp', 'lqd_wp': 'res_wp'})
+        samples.add_sample('C.'+str(i+1), FlashExperimentData(liquid, gas, res, av_mw))
+    return samples
+
+# Writing a Core Labs style workbook (one 'C.<i>' flash worksheet per sample)
+# for the parsing benchmark. Requires the 27 SCN layout (C10 to C36+).
+def write_synthetic_workbook(file_path, samples):
+    from openpyxl import Workbook
+    wb = Workbook()
+    wb.active.title = 'Front'
+    for i, (key, item) in enumerate(samples.items()):
+        assert len(item.liquid) == 52
+        ws = wb.create_sheet(key)
+        ws['B8'] = 'Compositional Analysis of Reservoir Fluid Sample to C36+'
+        ws['B9'] = 'Sample No.: %d; Chamber No.: %d; Depth: %.1f m MD' % (i+1, 1000+i, 4000.0+i)
+        ws['O39'] = item.av_lqd_mw
+        for j, row in enumerate(item.liquid.itertuples(index=False), 12):
+            values = [row.scn, row.cl_name, row.lqd_mp, row.lqd_wp, 0.0, 0.0, row.lqd_mp, row.lqd_wp]
+            for k, value in enumerate(values, 2):
+                ws.cell(row=j, column=k, value=value)
+    wb.save(file_path)
+
+# Wall time of fn and, with memory=True, its peak traced memory. Tracing
+# slows allocation-heavy code down several times, so with memory=True fn is
+# first run under tracemalloc as a warm-up (its time is reported as
+# warmup_time_s) and the wall time is taken from a second, untraced run.
+# Returns the output of the timed run.
+def measure(fn, memory=True):
+    record = {}
+    if memory:
+        tracemalloc.start()
+        try:
+            start_time = time.perf_counter()
+            fn()
+            record['warmup_time_s'] = time.perf_counter()-start_time
+            record['peak_mem_mb'] = tracemalloc.get_traced_memory()[1]/2**20
+        finally:
+            tracemalloc.stop()
+    start_time = time.perf_counter()
+    out = fn()
+    record['wall_time_s'] = time.perf_counter()-start_time
+    return out, record
+
+def bench_parsing(n_samples, rng):
+    samples = synthetic_collection(synthetic_parameters(n_samples, rng), 27, rng=rng)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, 'synthetic.xlsx')
+        write_synthetic_workbook(file_path, samples)
+        parsed, record = measure(CoreLabsXLSXLoader(file_path).read)
+    assert len(parsed) == n_samples
+    record['samples_per_s'] = n_samples/record['wall_time_s']
+    return record
+
+def bench_objective(n_samples, n_scn, rng, n_evals=2000, batch=1000):
+    params = synthetic_parameters(n_samples, rng)
+    samples = synthetic_collection(params, n_scn, rng=rng)
+    cut = samples._prepare_regression()
+    objective = cut.objective
+    x = cut.init_vals.copy()
+    x[0], x[1] = params[0][0], params[0][1]
+    x[-len(params):] = [p[2] for p in params]
+    start_time = time.perf_counter()
+    for _ in range(n_evals):
+        objective(x)
+    elapsed = time.perf_counter()-start_time
+    start_time = time.perf_counter()
+    objective.gradient(x)
+    grad_time = time.perf_counter()-start_time
+    xs = np.tile(x, (batch, 1))
+    start_time = time.perf_counter()
+    objective(xs)
+    batch_time = time.perf_counter()-start_time
+    return {'evals_per_s': n_evals/elapsed, 'eval_time_us': 1e6*elapsed/n_evals,
+            'gradient_time_us': 1e6*grad_time, 'batched_evals_per_s': batch/batch_time}
+
+# Single sample fit started off the true ita and C10+ MW, by less than their
+# solver boxes (2% and 5%) so that the true parameters stay feasible.
+def bench_single_fit(n_scn, rng, noise=0.0):
+    alpha, ita, mw_plus = 0.85, 130.0, 225.0
+    comp_input, sample_mw = synthetic_composition(alpha, ita, mw_plus, n_scn, noise, rng)
+    (res_df, out_df), record = measure(
+        lambda: gamma_distribution_fit(comp_input, sample_mw, ave_MC10plus=0.98*mw_plus,
+                                       ita=0.99*ita))
+    values = res_df.set_index('Variables')['Values']
+    record.update({'rmse': values['RMSE'], 'alpha_err': values['alpha']-alpha,
+                   'mw_rel_err': values['ave_mC10plus']/mw_plus-1})
+    return record
+
+def bench_collection_fit(n_samples, n_scn, rng, noise=0.0, solver='least_squares'):
+    params = synthetic_parameters(n_samples, rng)
+    samples = synthetic_collection(params, n_scn, noise=noise, rng=rng)
+    res_df, record = measure(lambda: samples.gamma_distribution_fit(verbose=False, solver=solver))
+    values = res_df.set_index('Variables')['Values']
+    mw = np.array([values[key.replace('.', '_')+'_heavy_mw'] for key in samples.sample_names])
+    mw_true = np.array([p[2] for p in params])
+    record.update({'solver': solver, 'rmse': values['RMSE'], 'alpha_err': values['alpha']-params[0][0],
+                   'mw_rel_err_max': np.abs(mw/mw_true-1).max()})
+    return record
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Gamma distribution fitting benchmarks.')
+    parser.add_argument('--samples', type=int, default=20, help='number of synthetic samples')
+    parser.add_argument('--scn', type=int, default=27, help='number of SCN groups from C10 (plus fraction included)')
+    parser.add_argument('--noise', type=float, default=0.0, help='relative noise on synthetic compositions')
+    parser.add_argument('--solver', default='least_squares', choices=['SLSQP', 'least_squares'],
+                        help='solver of the collection fit')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', nargs='*', default=None,
+                        choices=['parsing', 'objective', 'single_fit', 'collection_fit'],
+                        help='benchmarks to run (default: all)')
+    parser.add_argument('--output', default=None, help='JSON lines file (default: stdout)')
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(args.seed)
+    benchmarks = {
+        'parsing': lambda: bench_parsing(args.samples, rng),
+        'objective': lambda: bench_objective(args.samples, args.scn, rng),
+        'single_fit': lambda: bench_single_fit(args.scn, rng, args.noise),
+        'collection_fit': lambda: bench_collection_fit(args.samples, args.scn, rng, args.noise, args.solver),
+    }
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for name, bench in benchmarks.items():
+            if args.only is not None and name not in args.only:
+                continue
+            # Synthetic workbooks use the C10 to C36+ layout.
+            n_scn = 27 if name == 'parsing' else args.scn
+            n_samples = 1 if name == 'single_fit' else args.samples
+            record = {'benchmark': name, 'n_samples': n_samples, 'n_scn': n_scn}
+            record.update(bench())
+            out.write(json.dumps(record)+'\n')
+            out.flush()
+    finally:
+        if args.output:
+            out.close()
+
+if __name__ == "__main__":
+    main()
@@ -7,124 +7,383 @@ Created on Mon Jun  8 19:26:05 2020
 GitHub: https://github.com/dimmol/gamma_dist
 """
 
-from openpyxl import load_workbook
 import pandas as pd
 import numpy as np
+import functools
+import os
 import re
+import struct
+import zipfile
 import scipy.special as sps
-import scipy.stats as stats
-import scipy.optimize as optim
 import time
-import matplotlib.pyplot as plt
+import weakref
+from gamma_distribution import (RegressionLayout, bootstrap_fit, local_fit, multi_start_fit,
+                                scn_number)
+from fit_cache import cached_start
 
-# Class to store sample data and relevant fluid properties.
+# Components database (CoreLab component names and book properties). It is
+# read once on first use and shared by all samples.
+COMPONENTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'DATA', 'Components.xlsx')
+_component_db = None
+
+def component_database():
+    global _component_db
+    if _component_db is None:
+        _component_db = pd.read_excel(COMPONENTS_PATH, sheet_name = 'Sheet1',
+                                      nrows = 53, usecols = 'A:G, I', header = 0,
+                                      na_values = [''])
+    return _component_db
+
+# Mole and weight percent columns of the phase composition tables.
+PHASE_COLUMNS = {'liquid': ['lqd_mp', 'lqd_wp'], 'gas': ['gas_mp', 'gas_wp'],
+                 'reservoir': ['res_mp', 'res_wp']}
+
+# Component labels of a composition table: the SCN group and the CoreLab name
+# of every row (None for empty cells). Tables are interned, so all samples
+# reported with the same component list share one instance. The intern map
+# only holds weak references: a table is dropped once no sample uses it.
+class ComponentTable:
+    __slots__ = ('scn', 'cl_name', '_first_rows', '_book_mw', '__weakref__')
+    _tables = weakref.WeakValueDictionary()
+
+    def __init__(self, scn, cl_name):
+        self.scn = scn
+        self.cl_name = cl_name
+        self._first_rows = None
+        self._book_mw = None
+
+    @classmethod
+    def get(cls, scn, cl_name):
+        scn = tuple(None if pd.isna(label) else label for label in scn)
+        cl_name = tuple(None if pd.isna(label) else label for label in cl_name)
+        table = cls._tables.get((scn, cl_name))
+        if table is None:
+            table = cls(np.array(scn, dtype=object), np.array(cl_name, dtype=object))
+            table.scn.flags.writeable = table.cl_name.flags.writeable = False
+            cls._tables[(scn, cl_name)] = table
+        return table
+
+    def __len__(self):
+        return len(self.scn)
+
+    # Index of the first row of an SCN group (e.g. 'C10'). The isomer rows
+    # of an SCN (e.g. 'iC4' and 'nC4') belong to its group.
+    def first_row(self, scn):
+        if self._first_rows is None:
+            self._first_rows = {}
+            for i, label in enumerate(self.scn):
+                self._first_rows.setdefault(label, i)
+                k = scn_number(label)
+                if k is not None:
+                    self._first_rows.setdefault('C%d' % k, i)
+        return self._first_rows[scn]
+
+    # Components database MW (MW_lab) of every row, NaN for components not in
+    # the database.
+    @property
+    def book_mw(self):
+        if self._book_mw is None:
+            pc_db = component_database()
+            lookup = dict(zip(pc_db['CoreLab Name'], pc_db['MW_lab']))
+            self._book_mw = np.array([lookup.get(name, np.nan) for name in self.cl_name],
+                                     dtype='float64')
+            self._book_mw.flags.writeable = False
+        return self._book_mw
+
+# Heavy end data of samples sharing one ComponentTable in one vectorised pass.
+# values holds the sample values stacked along the first axis and av_lqd_mw
+# the average liquid MWs. The Cn+ fraction starts at the first row of the SCN
+# group Cn, so the data is computed for a cut at every row r:
+#   lab_mw   - MW of every row from the liquid mole and weight percents,
+#   heavy_wp - liquid weight percent of the rows from r on,
+#   heavy_mw - MW of the rows from r on, back-calculated from the average
+#              liquid MW and the book MWs of the rows before r.
+# Missing values are skipped in the sums. Returns one dictionary per sample.
+def heavy_end_data(components, values, av_lqd_mw):
+    av_lqd_mw = np.asarray(av_lqd_mw, dtype='float64')[:, None]
+    mp, wp = values[..., 0], values[..., 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lab_mw = wp*av_lqd_mw/mp
+        moles = wp/components.book_mw
+    moles = np.where(np.isnan(moles), 0.0, moles)
+    wp = np.where(np.isnan(wp), 0.0, wp)
+    zero = np.zeros((len(wp), 1))
+    heavy_wp = wp.sum(axis=1, keepdims=True)-np.concatenate((zero, wp.cumsum(axis=1)[:, :-1]), axis=1)
+    light_moles = np.concatenate((zero, moles.cumsum(axis=1)[:, :-1]), axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        heavy_mw = heavy_wp/100/(1/av_lqd_mw-light_moles/100)
+    for array in (lab_mw, heavy_wp, heavy_mw):
+        array.flags.writeable = False
+    return [{'lab_mw': lab_mw[i], 'heavy_wp': heavy_wp[i], 'heavy_mw': heavy_mw[i]}
+            for i in range(len(values))]
+
+# Class to store sample data and relevant fluid properties. The compositions
+# are kept as one float64 array with a row per component and the PHASE_COLUMNS
+# of the liquid, gas and reservoir phases as columns; the component labels are
+# a shared ComponentTable. Samples are built from the liquid, gas and reservoir
+# composition dataframes (scn and cl_name columns followed by the PHASE_COLUMNS
+# of the phase; a missing phase is left blank) or with from_arrays().
 class FlashExperimentData:
-    
+    __slots__ = ('components', '_values', '_av_lqd_mw', '_heavy_end_data', '_frames', 'depth',
+                 'cylinder', 'gamma_input', '_gamma_output')
+
     def __init__(self, lqd=None, gas=None, res=None, ave_lqd_mw=None):
-        self.liquid = lqd
-        self.gas = gas
-        self.reservoir = res
+        self._init(None, None, ave_lqd_mw)
+        for phase, df in zip(PHASE_COLUMNS, (lqd, gas, res)):
+            if df is not None:
+                self.set_phase(phase, df)
+
+    def _init(self, components, values, ave_lqd_mw=None, depth=None, cylinder=None):
+        self.components = components
+        self.values = values
         self.av_lqd_mw = ave_lqd_mw
-        # Estimation of average MW of C7 & C10 plus fractions
-        # can be implemented later.
-        self._ave_C10_mw = None
-        self._ave_C7_mw = None
-        self._c10_heavy_end_lqd = None
-        self._c7_heavy_end_lqd = None
+        self.depth = depth
+        self.cylinder = cylinder
         self.gamma_input = None
         self.gamma_output = None
-        self.depth = None
-        self.cylinder = None
-        self.pc_db = pd.read_excel(r'.\DATA\Components.xlsx', sheet_name = 'Sheet1',
-                   nrows = 53, usecols = 'A:G, I', header = 0, 
-                   na_values = [''])
-    
-    def assign_composition(self):
-        pass
-    
-    # def _test(self, n=10):
-    #     df = self.liquid[self.liquid['lqd_wp'] != 0].copy()
-    #     df.reset_index(drop=True, inplace=True)
-    #     i = df[df['scn'] == 'C'+str(n)].index[0]
-    #     print(i)
-    #     mw = self.av_lqd_mw
-    #     df = df.merge(self.pc_db[['CoreLab Name', 'MW_lab']], how='left', 
-    #                   left_on=['cl_name'], right_on=['CoreLab Name']).drop(['CoreLab Name'], axis=1)
-    #     df.loc[i:, 'MW_lab'] = df.apply(lambda x : x['lqd_wp']*mw/x['lqd_mp'], axis = 1)
-    #     print(df)
+
+    # Sample from a ComponentTable and the matching array of values (a row per
+    # component, the PHASE_COLUMNS of all phases as columns).
+    @classmethod
+    def from_arrays(cls, components, values, ave_lqd_mw=None, depth=None, cylinder=None):
+        assert values.shape == (len(components), 2*len(PHASE_COLUMNS))
+        sample = cls.__new__(cls)
+        sample._init(components, values, ave_lqd_mw, depth, cylinder)
+        return sample
+
+    # The composition is read-only: assigning new values or a new average
+    # liquid MW discards the memoised heavy end data and phase dataframes.
+    # Values are copied unless no array they are a view of is writeable (e.g.
+    # a read-only memory map), so edits to the caller's array cannot leave the
+    # memoised data stale.
+    @property
+    def values(self):
+        return self._values
+
+    @values.setter
+    def values(self, values):
+        if values is not None:
+            base = values
+            while isinstance(base, np.ndarray):
+                if base.flags.writeable:
+                    values = np.array(values, dtype='float64')
+                    break
+                base = base.base
+            values = values.view()
+            values.flags.writeable = False
+        self._values = values
+        self._heavy_end_data = None
+        self._frames = {}
+
+    @property
+    def av_lqd_mw(self):
+        return self._av_lqd_mw
+
+    @av_lqd_mw.setter
+    def av_lqd_mw(self, ave_lqd_mw):
+        self._av_lqd_mw = ave_lqd_mw
+        self._heavy_end_data = None
+
+    # Heavy end data of the sample (see heavy_end_data), computed on first
+    # use and memoised until the composition changes.
+    @property
+    def heavy_end_data(self):
+        if self._heavy_end_data is None:
+            self._heavy_end_data = heavy_end_data(self.components, self.values[None],
+                                                  [self.av_lqd_mw])[0]
+        return self._heavy_end_data
+
+    # Best fit data of the last fit of the sample. A collection fit stores a
+    # function of the fitted values instead of the dataframe, so the frame is
+    # built on every access and a fitted collection does not hold one per sample.
+    @property
+    def gamma_output(self):
+        out = self._gamma_output
+        return out() if callable(out) else out
+
+    @gamma_output.setter
+    def gamma_output(self, out):
+        self._gamma_output = out
+
+    # Replacing the composition of a phase with the PHASE_COLUMNS of df. The
+    # liquid phase also sets the component labels (scn and cl_name columns);
+    # other phases have to match them row by row.
+    def set_phase(self, phase, df):
+        if phase == 'liquid' or self.components is None:
+            components = ComponentTable.get(df['scn'], df['cl_name'])
+        else:
+            components = self.components
+        if self.values is None or len(self.values) != len(df):
+            values = np.full((len(df), 2*len(PHASE_COLUMNS)), np.nan)
+        else:
+            values = np.array(self.values)
+        j = list(PHASE_COLUMNS).index(phase)
+        values[:, 2*j:2*j+2] = df[PHASE_COLUMNS[phase]].values
+        self.components = components
+        self.values = values
+
+    @property
+    def pc_db(self):
+        return component_database()
+
+    # Mole and weight percent columns of a phase. This is a view of the
+    # sample values, not a copy.
+    def phase_values(self, phase='liquid'):
+        j = list(PHASE_COLUMNS).index(phase)
+        return self.values[:, 2*j:2*j+2]
+
+    # Composition dataframe of a phase (scn, cl_name, mole and weight percents).
+    # It is built on first access and kept until the values change, so a
+    # sample whose phase frames are used holds them on top of its values
+    # array. Edits to the dataframe are not written back (see set_phase).
+    def phase(self, phase='liquid'):
+        if self.values is None:
+            return None
+        df = self._frames.get(phase)
+        if df is None:
+            df = self.phase_frame(phase)
+            self._frames[phase] = df
+        return df
+
+    # Same dataframe as phase() built from phase_values without being kept,
+    # e.g. for the input of a regression layout.
+    def phase_frame(self, phase='liquid'):
+        mp, wp = PHASE_COLUMNS[phase]
+        values = self.phase_values(phase)
+        return pd.DataFrame({'scn': self.components.scn, 'cl_name': self.components.cl_name,
+                             mp: values[:, 0], wp: values[:, 1]})
+
+    @property
+    def liquid(self):
+        return self.phase('liquid')
+
+    @liquid.setter
+    def liquid(self, df):
+        self.set_phase('liquid', df)
+
+    @property
+    def gas(self):
+        return self.phase('gas')
+
+    @gas.setter
+    def gas(self, df):
+        self.set_phase('gas', df)
+
+    @property
+    def reservoir(self):
+        return self.phase('reservoir')
+
+    @reservoir.setter
+    def reservoir(self, df):
+        self.set_phase('reservoir', df)
     
-    # The following property decorators are to define the heavy 
-    # end of the liquid fraction.
-    # Don't like this way of splitting the heavy end but I reckon
-    # I exhausted my knowledge of Pandas.
+    # Heavy end (Cn+ rows) of a phase as mole and weight percent columns.
+    # Like phase_values this is a view of the sample values.
+    def heavy_end(self, n=10, phase='liquid'):
+        return self.phase_values(phase)[self.components.first_row('C'+str(n)):]
+
+    # Cn+ rows of the liquid composition dataframe.
     @property
     def c10_heavy_end_lqd(self):
-        i = self.liquid[self.liquid['scn'] == 'C10'].index[0]
-        self._c10_heavy_end_lqd = self.liquid.iloc[i:]
-        return self._c10_heavy_end_lqd
+        return self.liquid.iloc[self.components.first_row('C10'):]
     
+    # Lab MW of every liquid row (weight over mole percent times the average
+    # liquid MW).
+    @property
+    def lab_mw(self):
+        return self.heavy_end_data['lab_mw']
+
     # Calculating MW for the heavy end using lab MWs for light SCNs. These are often
     # inconsistent with book MWs for light components. This will introduce some errors in
     # resulting MW but this will hopefully be addressed by regression.
     def _calculate_MW(self, n=10):
-        df = self.liquid[self.liquid['lqd_wp'] != 0].copy()
-        df.reset_index(drop=True, inplace=True)
-        mw = self.av_lqd_mw
-        i = df[df['scn'] == 'C'+str(n)].index[0]
-        # df['MW_lab'] = df.apply(lambda x : x['lqd_wp']*mw/x['lqd_mp'], axis = 1)
-        df = df.merge(self.pc_db[['CoreLab Name', 'MW_lab']], how='left', 
-                      left_on=['cl_name'], right_on=['CoreLab Name']).drop(['CoreLab Name'], axis=1)
-        df.loc[i:, 'MW_lab'] = df.apply(lambda x : x['lqd_wp']*mw/x['lqd_mp'], axis = 1)
-        a = df.loc[i:, 'lqd_wp'].sum()/100
-        b = 1/self.av_lqd_mw
-        c = df.loc[:i-1, 'lqd_wp'].div(df.loc[:i-1, 'MW_lab']).sum()/100
-        return a/(b-c)
+        return float(self.heavy_end_data['heavy_mw'][self.components.first_row('C'+str(n))])
+
+    # Liquid weight fractions of the Cn+ rows normalised to the Cn+ fraction.
+    def heavy_end_fractions(self, n=10):
+        i = self.components.first_row('C'+str(n))
+        return self.heavy_end(n)[:, 1]/self.heavy_end_data['heavy_wp'][i]
 
     @property
     def ave_C10_mw(self):
-        self._ave_C10_mw = self._calculate_MW()
-        return self._ave_C10_mw
+        return self._calculate_MW()
     
     @property
     def c7_heavy_end_lqd(self):
-        i = self.liquid[self.liquid['scn'] == 'C7'].index[0]
-        self._c7_heavy_end_lqd = self.liquid.iloc[i:]
-        return self._c7_heavy_end_lqd
+        return self.liquid.iloc[self.components.first_row('C7'):]
     
+    # Input of a single sample Cn+ fit (see gamma_distribution.RegressionLayout).
     def prepare_input(self, id, n=10):
-        lqd = self.c10_heavy_end_lqd
-        mw = self.av_lqd_mw
-        self.gamma_input = lqd.copy()
-        self.gamma_input['MWi_lab'] = self.gamma_input.apply(lambda x : x['lqd_wp']*mw/x['lqd_mp'], axis = 1)
-        # Calculating initial values of upper bounds of individual MWn slices.
-        # Upper bounds are considered as midway between SCN MW values.
-        # C36+ upper bound is set to an arbitrary number (10000).
-        self.gamma_input['ubound_init'] = self.gamma_input['MWi_lab']+(self.gamma_input['MWi_lab'].shift(-1)-self.gamma_input['MWi_lab'])/2
-        self.gamma_input['ubound_init'] = self.gamma_input['ubound_init'].fillna(100000)
-        
-        # Generating regresion variables for component molecular weight bounds:
-        self.gamma_input['ubound'] = 'm'+self.gamma_input['scn']
-        
-        # Adding top row to represent a lower boundary of C10 (or upper C9 boundary)
-        top_index = 'C'+str(n-1)
-        df_top = pd.DataFrame(pd.DataFrame([[top_index]+[np.nan] * (len(self.gamma_input.columns)-1)], columns=self.gamma_input.columns))
-        self.gamma_input = df_top.append(self.gamma_input, ignore_index=True)
-        
-        # Calculating rescaled C10+ weight fractions.
-        self.gamma_input['wni_lab'] = self.gamma_input['lqd_wp']/self.gamma_input['lqd_wp'].sum()
-        
-        # Adding a regression variable for lower C10 molecular weight boundary:
-        self.gamma_input.at[0,'ubound'] = 'ita'
-        self.gamma_input.iloc[-1, self.gamma_input.columns.get_loc('ubound')] = self.gamma_input.iloc[-1, self.gamma_input.columns.get_loc('ubound_init')]
-        self.gamma_input['sample_id'] = id.replace('.', '_')
-        self.gamma_input['heavy_end_mw'] = id.replace('.', '_')+'_heavy_mw'
+        layout = RegressionLayout([self.phase_frame()], [self.av_lqd_mw],
+                                  sample_ids=[id.replace('.', '_')])
+        self.gamma_input = layout.cut(n).dfs[0]
+
 
+# Offset of the data of a zip member in the archive file, or None when the
+# member cannot be mapped (compressed or encrypted). The local file header is
+# read for the offset since its name and extra field lengths may differ from
+# the central directory (zipfile resolves ZIP64 header offsets; data
+# descriptors follow the data and do not move it).
+def _member_offset(f, info):
+    if info.compress_type != zipfile.ZIP_STORED or info.flag_bits & 0x1:
+        return None
+    f.seek(info.header_offset)
+    header = f.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader:
+        return None
+    fields = struct.unpack(zipfile.structFileHeader, header)
+    if fields[0] != zipfile.stringFileHeader:
+        return None
+    return info.header_offset+zipfile.sizeFileHeader+fields[10]+fields[11]
 
-# Class to store multiple sample data.
-class FlashExpDataCollection(FlashExperimentData, dict):
+# Reading all arrays of an .npz file. np.load ignores mmap_mode for .npz
+# archives, so with mmap_mode set the members (np.savez stores them
+# uncompressed) are memory-mapped directly at their offset in the zip file.
+# The .npy header is parsed through zipfile; members that cannot be mapped are
+# read into memory.
+def _load_npz(file_path, mmap_mode=None):
+    if mmap_mode is None:
+        with np.load(file_path) as data:
+            return {key: data[key] for key in data.files}
+    arrays = {}
+    with zipfile.ZipFile(file_path) as zf, open(file_path, 'rb') as f:
+        for info in zf.infolist():
+            key = info.filename[:-4]
+            with zf.open(info) as member:
+                version = np.lib.format.read_magic(member)
+                if version == (1, 0):
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(member)
+                else:
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(member)
+                header_len = member.tell()
+            offset = _member_offset(f, info)
+            size = int(np.prod(shape))*dtype.itemsize
+            if (offset is None or dtype.hasobject or size == 0 or
+                    header_len+size > info.file_size):
+                with zf.open(info) as member:
+                    arrays[key] = np.lib.format.read_array(member)
+            else:
+                arrays[key] = np.memmap(file_path, dtype=dtype, mode=mmap_mode, shape=shape,
+                                        order='F' if fortran_order else 'C',
+                                        offset=offset+header_len)
+    return arrays
+
+# Default columns of the best fit data export.
+EXPORT_COLUMNS = ['sample_id', 'scn', 'Mi', 'Wni', 'Zni']
+# Text columns of the best fit data; all other columns are exported as float64.
+TEXT_COLUMNS = ['sample_id', 'scn', 'cl_name', 'heavy_end_mw']
+
+# Class to store multiple sample data: a dictionary of FlashExperimentData
+# keyed by the sample (worksheet) names.
+class FlashExpDataCollection(dict):
     
-    def __init__(self, worksheet_names):
-        dict.__init__(self, ((wn, FlashExperimentData.__init__(self)) for wn in worksheet_names))
+    # samples are (name, FlashExperimentData) pairs or a mapping; bare sample
+    # names are added without data.
+    def __init__(self, samples=()):
+        if not isinstance(samples, dict):
+            samples = [(item, None) if isinstance(item, str) else item for item in samples]
+        dict.__init__(self, samples)
+        self.layout = None
         
     @property
     def sample_names(self):
@@ -132,12 +391,98 @@ class FlashExpDataCollection(FlashExperimentData, dict):
     
     def add_sample(self, sample_name, sample):
         self[sample_name] = sample
+
+    # Compact columnar storage of the parsed compositions. All samples are
+    # stored in one uncompressed .npz file: a float64 table of mole and weight
+    # percents for the three phases (one row per component and sample), the
+    # component index of every row into a shared SCN/component name dictionary,
+    # per-sample row offsets and the sample descriptors.
+    def save(self, file_path):
+        components, table_idx = {}, {}
+        component_idx, offsets = [], [0]
+        for item in self.values():
+            table = item.components
+            if id(table) not in table_idx:
+                table_idx[id(table)] = np.array([components.setdefault(pair, len(components)) for pair in
+                                                 zip(table.scn, table.cl_name)], dtype=np.int32)
+            component_idx.append(table_idx[id(table)])
+            offsets.append(offsets[-1]+len(table))
+        depth = [np.nan if item.depth is None else item.depth for item in self.values()]
+        np.savez(file_path, sample_names=np.array(self.sample_names, dtype=str),
+                 offsets=np.array(offsets, dtype=np.int64),
+                 component_idx=np.concatenate(component_idx) if component_idx else np.empty(0, np.int32),
+                 component_scn=np.array([scn or '' for scn, _ in components], dtype=str),
+                 component_name=np.array([name or '' for _, name in components], dtype=str),
+                 values=(np.concatenate([item.values for item in self.values()]) if self
+                         else np.empty((0, 2*len(PHASE_COLUMNS)))),
+                 av_lqd_mw=np.array([item.av_lqd_mw for item in self.values()], dtype='float64'),
+                 depth=np.array(depth, dtype='float64'),
+                 cylinder=np.array(['' if item.cylinder is None else str(item.cylinder)
+                                    for item in self.values()], dtype=str))
+
+    # Loading a collection written by save(). The sample values are views of
+    # the stored table; with mmap_mode='r' it is memory-mapped from the file
+    # rather than read into memory.
+    @classmethod
+    def load(cls, file_path, mmap_mode=None):
+        data = _load_npz(file_path, mmap_mode)
+        scn = np.where(data['component_scn'] == '', None, data['component_scn']).astype(object)
+        name = np.where(data['component_name'] == '', None, data['component_name']).astype(object)
+        offsets = data['offsets']
+        samples, tables = cls(), {}
+        for i, key in enumerate(data['sample_names'].tolist()):
+            rows = slice(offsets[i], offsets[i+1])
+            idx = data['component_idx'][rows]
+            table = tables.get(idx.tobytes())
+            if table is None:
+                table = tables[idx.tobytes()] = ComponentTable.get(scn[idx], name[idx])
+            depth = float(data['depth'][i])
+            # Missing cylinders are stored as '' ('None' in older files).
+            cylinder = str(data['cylinder'][i])
+            sample = FlashExperimentData.from_arrays(table, data['values'][rows],
+                                                     float(data['av_lqd_mw'][i]),
+                                                     None if np.isnan(depth) else depth,
+                                                     None if cylinder in ('', 'None') else cylinder)
+            samples.add_sample(key, sample)
+        return samples
         
-    def _prepare_regression(self):
-        for key, item in self.items():
-            item.prepare_input(key)
-            
-    def gamma_distribution(self, reg_vals, reg_vars, rmse_switch = False):
+    # Computing the heavy end data of all samples that do not have it yet in
+    # one vectorised pass per component table.
+    def precompute(self):
+        groups = {}
+        for item in self.values():
+            if item._heavy_end_data is None:
+                groups.setdefault(id(item.components), []).append(item)
+        for items in groups.values():
+            data = heavy_end_data(items[0].components, np.stack([item.values for item in items]),
+                                  [item.av_lqd_mw for item in items])
+            for item, item_data in zip(items, data):
+                item._heavy_end_data = item_data
+
+    # Cn+ MW of every sample (see FlashExperimentData._calculate_MW).
+    def heavy_end_mws(self, n=10):
+        self.precompute()
+        return np.array([item._calculate_MW(n) for item in self.values()])
+
+    # Regression layout of the Cn+ fraction of all samples. The layout of the
+    # previous call is kept when warm_start is True (so that its fitted values
+    # are reused) and it still has the same samples and average liquid MWs,
+    # otherwise it is built again from the liquid compositions (phase_frame,
+    # so the samples keep no liquid dataframes). The input frames of the cut
+    # are not stored on the samples.
+    # bounds is an optional gamma_distribution.BoundModel.
+    def _prepare_regression(self, n=10, alpha=1, warm_start=False, bounds=None):
+        sample_ids = [key.replace('.', '_') for key in self.keys()]
+        sample_mws = np.array([item.av_lqd_mw for item in self.values()], dtype='float64')
+        if (self.layout is None or not warm_start or self.layout.sample_ids != sample_ids or
+                not np.array_equal(self.layout.sample_mws, sample_mws)):
+            self.layout = RegressionLayout([item.phase_frame() for item in self.values()],
+                                           sample_mws, sample_ids=sample_ids)
+        return self.layout.cut(n, alpha, heavy_mw=self.heavy_end_mws(n), bounds=bounds)
+
+    # dfs are the input frames of the samples (by default their gamma_input,
+    # see FlashExperimentData.prepare_input), e.g. the dfs of a RegressionCut.
+    def gamma_distribution(self, reg_vals, reg_vars, rmse_switch = False, dfs=None):
 
         # Ensuring consistency of input data
         assert len(reg_vals) == len(reg_vars)
@@ -150,8 +495,9 @@ class FlashExpDataCollection(FlashExperimentData, dict):
         # Updating the dataframe with set regression values (replacing variables with values):
         # Note, this time it is not a single dataframe but a class containing a number of dataframes.
         error_array = pd.Series(dtype='float64')
-        for key, item in self.items():
-            df = item.gamma_input
+        if dfs is None:
+            dfs = [item.gamma_input for item in self.values()]
+        for (key, item), df in zip(self.items(), dfs):
             df = df.replace(lookup)
             ind = key.replace('.', '_')+'_heavy_mw'
             # Below equation references are from the SPE Phase Behavior monograph.
@@ -164,8 +510,7 @@ class FlashExpDataCollection(FlashExperimentData, dict):
             # Distribution Model to MW and Boiling Point Data For Petroleum Fractions", Equation 21
             df['Q'] = (np.exp(-df['y'])*(df['y']**lookup['alpha'])/
                        sps.gamma(lookup['alpha']))
-            df['P0'] = stats.gamma.cdf((df['ubound']-lookup['ita']), 
-                                       a=lookup['alpha'], scale=beta) # Equation 5.18
+            df['P0'] = sps.gammainc(lookup['alpha'], df['y'].clip(lower=0)) # Equation 5.18
             df['P1'] = df['P0']-(df['Q']/lookup['alpha']) # Equation 5.19
             df['Mi'] = (lookup['ita']+lookup['alpha']*beta*
                         ((df['P1']-df['P1'].shift())/(df['P0']-df['P0'].shift()))) # Equation 5.17
@@ -181,43 +526,164 @@ class FlashExpDataCollection(FlashExperimentData, dict):
     
         return 100*error_array.mean()**0.5
         
-    def gamma_distribution_fit(self, n=10, alpha=1):
-        # Gamma distribution fit from C7 is not implemented yet.
-        if n == 7:
-            raise NotImplementedError
-        self._prepare_regression()
-        df = self[self.sample_names[0]].gamma_input
-        reg_variables = np.concatenate((np.array(['alpha']), df.loc[df.index[0:-1], 'ubound'].unique(),
-                                        np.array([sample.replace('.', '_')+'_heavy_mw' for sample in self.sample_names])))
-        init_vals = df.loc[df.index[0:-1], 'ubound_init']
-        init_vals.iloc[0] = init_vals.iloc[1]-14
-        init_vals = pd.Series(alpha).append(init_vals, ignore_index=True)
-        for key, item in self.items():
-            init_vals = init_vals.append(pd.Series(item.ave_C10_mw), ignore_index=True)
-            
-        ub = init_vals+init_vals*0.02
-        ub[17:] = init_vals[17:]+init_vals[17:]*0.05
-        lb = init_vals-init_vals*0.02
-        lb[17:] = init_vals[17:]-init_vals[17:]*0.05
-        lb[0] = -np.inf
-        ub[0] = np.inf
-    
-        res = optim.minimize(self.gamma_distribution, args=(reg_variables), x0=init_vals,
-                             method = 'SLSQP', bounds=optim.Bounds(lb, ub), options={'maxiter':10000})
-        res_df = pd.DataFrame({'Variables': reg_variables, 'Values':res.x})
-        print('RMSE: ', res.fun)
-        print(res_df)
-        res_df = res_df.append({'Variables' : 'RMSE', 'Values' : res.fun}, ignore_index=True)
-        res_df.to_csv(r'.\DATA\results.csv')
-
-        self.gamma_distribution(res.x, reg_variables, rmse_switch = True)
-        
-    def gamma_distribution_export(self, file_path):
+    # results_path is an optional .csv file for the regression results and verbose=False
+    # keeps the console quiet (e.g. when running in a worker process).
+    # solver='least_squares' runs a trust region least squares fit with the
+    # block-sparse residual Jacobian instead of SLSQP on the RMSE. Its cost
+    # grows roughly linearly with the number of samples, so this is the mode
+    # to use for field-wide collections of hundreds of samples.
+    # cache is an optional fit_cache.FitCache. Unchanged collections are then
+    # taken from the cache and similar ones are warm started from the closest
+    # cached solution.
+    # n_starts > 0 runs a multi-start search over alpha, ita and the heavy end
+    # MWs and refines the top_k candidates (in workers processes if > 1).
+    # monitor is an optional fit_monitor.FitMonitor recording call counts,
+    # timings and the RMSE trajectory of the fit.
+    # n is the first SCN of the fit (C7+, C10+ or any other cut). With
+    # warm_start=True the regression layout of the previous fit is reused and
+    # the fit starts from its alpha and SCN bounds, e.g. when sweeping the cut.
+    # bounds is an optional gamma_distribution.BoundModel replacing the preset
+    # SCN bound boxes, e.g. BoundModel('correlation') fits a smooth SCN bound
+    # correlation with a few coefficients instead of every SCN bound. The
+    # results always list the SCN bounds.
+    def gamma_distribution_fit(self, n=10, alpha=1, results_path=None, verbose=True,
+                               solver='SLSQP', cache=None, n_starts=0, top_k=4, workers=None,
+                               monitor=None, warm_start=False, bounds=None):
+        if solver not in ('SLSQP', 'least_squares'):
+            raise ValueError("solver must be 'SLSQP' or 'least_squares'")
+        if monitor is not None:
+            monitor.begin(samples=list(self.sample_names), solver=solver, n_starts=n_starts)
+        start = time.perf_counter()
+        cut = self._prepare_regression(n, alpha, warm_start, bounds)
+        reg_variables, lb, ub = cut.reg_vars, cut.lb, cut.ub
+        dfs = cut.dfs
+        objective = cut.objective
+        if monitor is not None:
+            monitor.times['prepare'] += time.perf_counter()-start
+        x, rmse, cache_hit = cut.x0, None, False
+        if cache is not None:
+            features = self.layout.cache_features(cut)
+            settings = {'n': n, 'alpha': alpha, 'solver': solver, 'n_starts': n_starts,
+                        'top_k': top_k}
+            if cut.parameters is not None:
+                settings['bounds'] = cut.model.settings()
+            start = time.perf_counter()
+            x, rmse = cached_start(cache, features, settings, reg_variables, x, lb, ub)
+            cache_hit = rmse is not None
+            if monitor is not None:
+                monitor.times['io'] += time.perf_counter()-start
+        if rmse is None:
+            if n_starts:
+                x, rmse = multi_start_fit(objective, x, lb, ub, n_starts, top_k, solver=solver,
+                                          workers=workers, monitor=monitor)
+            else:
+                x, rmse = local_fit(objective, x, lb, ub, solver, monitor)
+            if cache is not None:
+                start = time.perf_counter()
+                cache.put(features, settings, reg_variables, x, rmse, lb, ub)
+                if monitor is not None:
+                    monitor.times['io'] += time.perf_counter()-start
+        x_full = cut.expand(x)
+        self.layout.update(cut, x_full)
+        res_df = pd.DataFrame({'Variables': cut.full_vars, 'Values': x_full})
+        if verbose:
+            print('RMSE: ', rmse)
+            print(res_df)
+        res_df = pd.DataFrame({'Variables': np.append(cut.full_vars, 'RMSE'),
+                               'Values': np.append(x_full, rmse)})
+        if results_path:
+            start = time.perf_counter()
+            res_df.to_csv(results_path)
+            if monitor is not None:
+                monitor.times['io'] += time.perf_counter()-start
+
+        # Best fit data built on access from the fitted values (see
+        # FlashExperimentData.gamma_output).
+        ev = objective.evaluate(x)
+        for s, (item, df) in enumerate(zip(self.values(), dfs)):
+            item.gamma_output = functools.partial(objective.frame, x, df, s, ev)
+        if monitor is not None:
+            monitor.end(rmse, n_vars=objective.n_vars, n_residuals=len(objective.fit_slices),
+                        cache_hit=cache_hit)
+        return res_df
         
+    # Uncertainty of the fit from n_replicas perturbed copies of the lab data
+    # of all samples (see gamma_distribution.bootstrap_fit): method is
+    # 'monte_carlo' (relative noise wt_noise on the Cn+ weight fractions) or
+    # 'bootstrap' (resampled fit residuals), and the average liquid MWs get
+    # relative noise mw_noise. The collection is fitted first (see
+    # gamma_distribution_fit) and every replica is refitted starting from that
+    # solution, in workers processes if > 1, chunk_size replicas at a time
+    # (memory grows with chunk_size times the number of samples). Returns the
+    # parameter and the Mi/Wni slice statistics dataframes.
+    def gamma_distribution_bootstrap(self, n=10, alpha=1, n_replicas=1000, method='monte_carlo',
+                                     wt_noise=0.02, mw_noise=0.01, percentiles=(2.5, 50, 97.5),
+                                     workers=None, seed=None, solver='SLSQP', warm_start=False,
+                                     bounds=None, chunk_size=250):
+        res_df = self.gamma_distribution_fit(n, alpha, verbose=False, solver=solver,
+                                             warm_start=warm_start, bounds=bounds)
+        cut = self._prepare_regression(n, alpha, warm_start=True, bounds=bounds)
+        return bootstrap_fit(cut, res_df['Values'].values[:-1], n_replicas, method, wt_noise,
+                             mw_noise, percentiles, workers, seed, chunk_size)
+
+    # Generator of the best fit data in chunks of up to chunk_size samples.
+    # Every chunk is a single dataframe with the requested columns (by default
+    # sample_id, scn, Mi, Wni and Zni) of the fitted SCN rows of its samples.
+    def iter_gamma_output(self, columns=None, chunk_size=1000):
+        columns = columns or EXPORT_COLUMNS
+        frames = []
         for key, item in self.items():
-            item.gamma_output.to_csv(file_path, mode='a') # [['SCN', 'Mi', 'Wni', 'Zni']]
+            # The top row is the lower Cn boundary, not a component.
+            frames.append(item.gamma_output[columns].iloc[1:])
+            if len(frames) == chunk_size:
+                yield pd.concat(frames, ignore_index=True)
+                frames = []
+        if frames:
+            yield pd.concat(frames, ignore_index=True)
+
+    # Writing the best fit data of all samples through one open writer.
+    # file_format is 'csv', 'parquet' or 'feather' (the latter two need pyarrow).
+    # Parquet and Feather files get a fixed schema (TEXT_COLUMNS as strings,
+    # everything else float64) so that chunks with differently inferred types
+    # (e.g. all missing values) can be appended. An existing file is
+    # overwritten; without samples a file with the header or schema only is
+    # written.
+    def gamma_distribution_export(self, file_path, columns=None, file_format='csv', chunk_size=1000):
+        columns = columns or EXPORT_COLUMNS
+        chunks = self.iter_gamma_output(columns, chunk_size)
+        if file_format == 'csv':
+            with open(file_path, 'w', newline='') as f:
+                header = True
+                for chunk in chunks:
+                    chunk.to_csv(f, header=header, index=False)
+                    header = False
+                if header:
+                    pd.DataFrame(columns=columns).to_csv(f, index=False)
+        elif file_format in ('parquet', 'feather'):
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError:
+                raise ImportError('pyarrow is required for %s export' % file_format)
+            schema = pa.schema([(column, pa.string() if column in TEXT_COLUMNS else pa.float64())
+                                for column in columns])
+            if file_format == 'parquet':
+                writer = pq.ParquetWriter(file_path, schema)
+            else:
+                # Feather V2 is the Arrow IPC file format.
+                writer = pa.ipc.new_file(file_path, schema)
+            try:
+                for chunk in chunks:
+                    writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+            finally:
+                writer.close()
+        else:
+            raise ValueError("file_format must be 'csv', 'parquet' or 'feather'")
             
     def _sample_plot(self, df, cylinder=None, depth=None):
+        # matplotlib is only imported when plotting so that fitting workers
+        # do not pay for it.
+        import matplotlib.pyplot as plt
         # Creating a plot of lab vs calculated compositions
         plt.style.use('classic')
         fig = plt.figure(figsize=[7,5])
@@ -247,7 +713,13 @@ class FlashExpDataCollection(FlashExperimentData, dict):
     def gamma_distribution_plot(self):
         for key, item in self.items():
             self._sample_plot(item.gamma_output, item.cylinder, item.depth)
-        
+
+# Opening a workbook in read-only streaming mode. openpyxl is imported on
+# first use so that fitting from .npz or .csv inputs never loads it.
+def _load_workbook(file_path, data_only=True):
+    from openpyxl import load_workbook
+    return load_workbook(file_path, read_only=True, data_only=data_only, keep_links=False)
+
 # Class that contains functionality to parse a Core Labs Excel report
 # and pass the data to FlashExperimentData class instance.
 # openpyxl only works with Excel 2010+ file format.
@@ -260,44 +732,82 @@ class CoreLabsXLSXLoader:
         self.file_path = report_path
         self.worksheet = worksheet
     
-    # Method to parse an individual worksheet.
+    # Composition table columns (B:I) and its location on a flash worksheet.
+    COMPOSITION_COLUMNS = ['scn', 'cl_name', 'lqd_mp', 'lqd_wp', 'gas_mp',
+                           'gas_wp', 'res_mp', 'res_wp']
+    COMPOSITION_ROWS = (12, 63)
+
+    # Building the sample compositions from the rows of the B12:I63 block.
+    # Blank cells are read as missing values.
+    @classmethod
+    def _composition(cls, rows):
+        scn, cl_name, values = [], [], []
+        for row in rows:
+            row = [None if cell == ' ' else cell for cell in row]
+            # Filling in empty cells in carbon group columns.
+            scn.append(row[0] if row[0] is not None or not scn else scn[-1])
+            cl_name.append(row[1])
+            values.append([np.nan if cell is None else cell for cell in row[2:]])
+        return ComponentTable.get(scn, cl_name), np.array(values, dtype='float64')
+
+    # Single streaming pass over the rows 8 to 63 of a read-only worksheet.
+    # Picks up the sample description (B8, B9), the flashed liquid average
+    # mole weight (typically in the cell O39 in CL reports) and the
+    # composition table.
+    def _parse_sheet(self, sheet):
+        first, last = self.COMPOSITION_ROWS
+        desc, lqd_av_mw, rows = '', None, []
+        for i, row in enumerate(sheet.iter_rows(min_row=8, max_row=last, min_col=2,
+                                                max_col=15, values_only=True), 8):
+            row = row+(None,)*(14-len(row))
+            if i in (8, 9):
+                desc += row[0] or ''
+            if i == 39:
+                lqd_av_mw = row[13]
+            if i >= first:
+                rows.append(row[:8])
+        return desc, FlashExperimentData.from_arrays(*self._composition(rows), lqd_av_mw)
+
+    # Method to parse an individual worksheet. Returns the liquid, gas and
+    # reservoir composition dataframes.
     def read_flash_data(self, worksheet):
-        # Reading the composition table as the whole.
-        df = pd.read_excel(self.file_path, worksheet, skiprows = 11, nrows = 52, 
-                        usecols = 'B:I', header = None,
-                        names = ['scn', 'cl_name', 'lqd_mp', 'lqd_wp', 'gas_mp',
-                                 'gas_wp', 'res_mp', 'res_wp'], na_values = ' ')
-        # Filling in empty cells in carbon group columns.
-        df['scn'] = df['scn'].ffill()
-        df.set_index(['scn', 'cl_name'], inplace=True)
-        # df.sort_index(inplace=True)
-        liq = df.iloc[:, 0:2].reset_index()
-        gas = df.iloc[:, 2:4].reset_index()
-        res = df.iloc[:, 4:].reset_index()
-        return liq, gas, res
+        wb = _load_workbook(self.file_path)
+        try:
+            sample = self._parse_sheet(wb[worksheet])[1]
+        finally:
+            wb.close()
+        return sample.liquid, sample.gas, sample.reservoir
     
+    # Names of the worksheets with flash data found in the workbook.
+    def flash_sheet_names(self, wb=None):
+        if wb is None:
+            wb = _load_workbook(self.file_path, data_only=False)
+            wb.close()
+        return [worksheet for worksheet in wb.sheetnames if
+                re.search('C\.\d+', worksheet)]
+
+    # Generator yielding (worksheet name, FlashExperimentData) pairs. The
+    # workbook is opened once in read-only mode and every flash worksheet is
+    # parsed in a single pass over its rows.
+    def iter_samples(self):
+        wb = _load_workbook(self.file_path)
+        try:
+            if self.worksheet:
+                flash_data_list = self.worksheet
+            else:
+                flash_data_list = self.flash_sheet_names(wb)
+            for worksheet in flash_data_list:
+                desc, sample = self._parse_sheet(wb[worksheet])
+                depth, sample_num, cylinder = self.__parser(desc)
+                # print('Depth: ', depth, 'Sample number: ', sample_num, 'Cylinder: ', cylinder)
+                sample.depth = depth
+                sample.cylinder = cylinder
+                yield worksheet, sample
+        finally:
+            wb.close()
+
     def read(self):
-        wb = load_workbook(self.file_path)
-        if self.worksheet:
-            flash_data_list = self.worksheet
-        else:
-            flash_data_list = [worksheet for worksheet in wb.sheetnames if
-                               re.search('C\.\d+', worksheet)]
-        samples = FlashExpDataCollection(flash_data_list)
-        for worksheet in flash_data_list:
-            sheet = wb[worksheet]
-            desc = sheet['B8'].value+sheet['B9'].value
-            depth, sample_num, cylinder = self.__parser(desc)
-            # print('Depth: ', depth, 'Sample number: ', sample_num, 'Cylinder: ', cylinder)
-            liq, gas, res = self.read_flash_data(worksheet)
-            # Typically, flashed liquid average mole weight in CL reports is in
-            # the cell O39:
-            lqd_av_mw = sheet['O39'].value
-            samples.add_sample(worksheet, FlashExperimentData(liq, gas, res,
-                                                              lqd_av_mw))
-            samples[worksheet].depth = depth
-            samples[worksheet].cylinder = cylinder
-        return samples
+        return FlashExpDataCollection(self.iter_samples())
     
     # Parcer function is supposed to extract useful sample descriptors from
     # the text strings above the composition table. In most Core LAbs reports
@@ -326,7 +836,7 @@ if __name__ == "__main__":
     input_file = '.\DATA\PS1.xlsx'
     cl_report = CoreLabsXLSXLoader(input_file) #, worksheet=['C.1', 'C.4']
     sample_collection = cl_report.read()
-    sample_collection.gamma_distribution_fit()
+    sample_collection.gamma_distribution_fit(results_path=r'.\DATA\results.csv')
     sample_collection.gamma_distribution_export(r'.\DATA\gamma.csv')
     sample_collection.gamma_distribution_plot()
     
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of converged gamma distribution fits.
+
+Entries are keyed by a hash of the sample composition features (normalised
+Cn+ weight and mole fractions and average MW), the solver boundaries and the
+fit settings. An exact hit lets the caller skip the solve altogether;
+otherwise the closest cached solution with the same fit settings and
+regression layout can be used as a warm start.
+The cache directory is kept under max_bytes by evicting the least recently
+used entries.
+
+GitHub: https://github.com/dimmol/gamma_dist
+"""
+
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+class FitCache:
+
+    def __init__(self, cache_dir, max_bytes=100*2**20):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    # Hash of the fit settings (a dictionary of plain values). It is the
+    # prefix of every entry file name so near hits only look at compatible fits.
+    @staticmethod
+    def settings_key(settings):
+        text = repr(sorted(settings.items()))
+        return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+    # Features are rounded before hashing so that re-reading the same numbers
+    # from a report always gives the same key. The solver boundaries lb, ub
+    # (derived from the lab MWs) are part of the key but not of the features
+    # compared by nearest().
+    def key(self, features, settings, lb=(), ub=()):
+        values = np.concatenate([np.asarray(a, dtype='float64').ravel() for a in (features, lb, ub)])
+        digest = hashlib.sha1(np.round(values, 10).tobytes()).hexdigest()[:24]
+        return self.settings_key(settings)+'_'+digest
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key+'.npz')
+
+    @staticmethod
+    def _load(path):
+        with np.load(path, allow_pickle=False) as data:
+            return {'features': data['features'], 'reg_vars': data['reg_vars'].tolist(),
+                    'x': data['x'], 'rmse': float(data['rmse'])}
+
+    # Exact hit or None.
+    def get(self, features, settings, lb=(), ub=()):
+        path = self._path(self.key(features, settings, lb, ub))
+        try:
+            entry = self._load(path)
+            os.utime(path)
+        except (OSError, KeyError, ValueError):
+            return None
+        return entry
+
+    # Closest cached fit with the same settings and as many regression
+    # variables within max_distance (Euclidean distance of the features), or None.
+    def nearest(self, features, settings, n_vars, max_distance=0.05):
+        features = np.asarray(features, dtype='float64')
+        prefix = self.settings_key(settings)+'_'
+        best, best_distance = None, max_distance
+        for name in os.listdir(self.cache_dir):
+            if not (name.startswith(prefix) and name.endswith('.npz')):
+                continue
+            try:
+                entry = self._load(os.path.join(self.cache_dir, name))
+            except (OSError, KeyError, ValueError):
+                continue
+            if entry['features'].shape != features.shape or len(entry['x']) != n_vars:
+                continue
+            distance = np.linalg.norm(entry['features']-features)
+            if distance <= best_distance:
+                best, best_distance = entry, distance
+        return best
+
+    def put(self, features, settings, reg_vars, x, rmse, lb=(), ub=()):
+        path = self._path(self.key(features, settings, lb, ub))
+        # Writing to a temporary file first so that concurrent workers never
+        # see a half written entry.
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, features=np.asarray(features, dtype='float64'),
+                     reg_vars=np.asarray(reg_vars, dtype=str),
+                     x=np.asarray(x, dtype='float64'), rmse=rmse)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    # Removing least recently used entries until the cache fits in max_bytes.
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npz'):
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            total -= size
+
+# Cached fit lookup shared by the fit functions. Returns (x, rmse) for an exact
+# hit, (x0, None) with x0 warm started from the closest cached fit clipped into
+# the bounds, or (init_vals, None) when nothing suitable is cached. An exact
+# hit outside lb, ub (e.g. a hash collision) is only used as a warm start.
+def cached_start(cache, features, settings, reg_vars, init_vals, lb, ub):
+    init_vals = np.asarray(init_vals, dtype='float64')
+    entry = cache.get(features, settings, lb, ub)
+    if entry is not None and entry['reg_vars'] == list(reg_vars):
+        x = entry['x']
+        tol = 1e-9*(1+np.abs(x))
+        if np.all((x >= lb-tol) & (x <= ub+tol)):
+            return x, entry['rmse']
+    entry = cache.nearest(features, settings, len(init_vals))
+    if entry is None:
+        return init_vals, None
+    return np.clip(entry['x'], lb, ub), None
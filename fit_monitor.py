@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in instrumentation of gamma distribution fits.
+
+A FitMonitor passed to the fit functions counts objective and gradient calls,
+records the RMSE trajectory per solver iteration and splits the wall time into
+objective, gradient, solver and preparation/I/O phases. Records are plain
+dictionaries handed to a callback and/or appended to a JSON lines file:
+    {'event': 'iteration', 'label': ..., 'iteration': 3, 'rmse': ..., 'elapsed_s': ...}
+    {'event': 'fit', 'label': ..., 'objective_calls': ..., 'gradient_calls': ...,
+     'iterations': ..., 'time_objective_s': ..., 'time_solver_s': ..., 'success': ...}
+
+GitHub: https://github.com/dimmol/gamma_dist
+"""
+
+import json
+import time
+from collections import defaultdict
+
+class FitMonitor:
+
+    # iterations=False skips the per-iteration records (the trajectory is
+    # still kept in the fit record). label tags every record, e.g. the source file.
+    def __init__(self, callback=None, jsonl_path=None, iterations=True, label=None):
+        self.callback = callback
+        self.jsonl_path = jsonl_path
+        self.iterations = iterations
+        self.label = label
+        self.fits = []
+        self.begin()
+
+    # Starting a new fit. Extra keyword arguments are copied into the records.
+    def begin(self, label=None, **info):
+        if label is not None:
+            self.label = label
+        self.info = info
+        self.counts = defaultdict(int)
+        self.times = defaultdict(float)
+        self.trajectory = []
+        self.status = {}
+        self._start = time.perf_counter()
+
+    def emit(self, record):
+        if self.callback is not None:
+            self.callback(record)
+        if self.jsonl_path:
+            with open(self.jsonl_path, 'a') as f:
+                f.write(json.dumps(record, default=str)+'\n')
+
+    # Wrapping a function so that its calls are counted and timed under name.
+    # on_value is called with every returned value.
+    def timed(self, fn, name, on_value=None):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            value = fn(*args, **kwargs)
+            self.times[name] += time.perf_counter()-start
+            self.counts[name] += 1
+            if on_value is not None:
+                on_value(value)
+            return value
+        return wrapper
+
+    def iteration(self, rmse):
+        rmse = float(rmse)
+        self.trajectory.append(rmse)
+        if self.iterations:
+            self.emit({'event': 'iteration', 'label': self.label, 'iteration': len(self.trajectory),
+                       'rmse': rmse, 'elapsed_s': time.perf_counter()-self._start})
+
+    # Convergence status of the solver result (scipy OptimizeResult).
+    def solver_result(self, res):
+        self.status = {'success': bool(res.success), 'message': str(res.message),
+                       'iterations': int(getattr(res, 'nit', len(self.trajectory)))}
+
+    # Finishing the fit and emitting its summary record.
+    def end(self, rmse, **extra):
+        times = dict(self.times)
+        solver = times.pop('solver', 0.0)
+        record = {'event': 'fit', 'label': self.label}
+        record.update(self.info)
+        record.update({'objective_calls': self.counts['objective'],
+                       'gradient_calls': self.counts['gradient'],
+                       'rmse': float(rmse), 'rmse_trajectory': self.trajectory,
+                       'time_objective_s': times.pop('objective', 0.0),
+                       'time_gradient_s': times.pop('gradient', 0.0)})
+        # Solver time is what is left of the solve after objective and gradient calls.
+        record['time_solver_s'] = max(solver-record['time_objective_s']-record['time_gradient_s'], 0.0)
+        for name, value in times.items():
+            record['time_'+name+'_s'] = value
+        record['time_total_s'] = time.perf_counter()-self._start
+        record.update(self.status)
+        record.update(extra)
+        self.fits.append(record)
+        self.emit(record)
+        return record
@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+"""
+Local gamma distribution fitting service.
+
+An asyncio HTTP/1.1 server (TCP or Unix socket) accepting Core Labs .xlsx
+reports and .csv compositions (SCN, mfi_lab, wfi_lab columns). Uploads are
+parsed in a thread pool and fitted in a process pool that is started once and
+kept warm, so requests do not pay the Python/SciPy start-up. Jobs wait in a
+bounded queue and uploads are refused with 503 and a Retry-After header while
+it is full.
+
+Endpoints:
+    POST /jobs?mode=sample&name=PS1&sample_mw=171&c10_mw=225&ita=131
+        The request body is the report or composition. In 'sample' mode every
+        flash worksheet is fitted on its own, in 'collection' mode all of them
+        together. sample_mw, c10_mw and ita only apply to .csv compositions;
+        sample_mw is required for them (400 otherwise) and c10_mw and ita
+        default to the values derived from the lab MWs.
+        Returns 202 with the job id.
+    GET /jobs/<id>
+        Job status (queued, parsing, fitting, done or failed) and the results
+        of the finished tasks.
+    GET /jobs/<id>/events
+        Results streamed as newline-delimited JSON as each task finishes,
+        followed by an 'end' record.
+    GET /status
+        Queue length, jobs and workers.
+
+Usage example:
+    python fit_service.py --port 8765 --workers 8
+    curl --data-binary @DATA/PS1.xlsx 'http://127.0.0.1:8765/jobs?mode=sample'
+    curl http://127.0.0.1:8765/jobs/1/events
+
+GitHub: https://github.com/dimmol/gamma_dist
+"""
+
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import os
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import parse_qs, urlsplit
+
+import pandas as pd
+
+from batch_fit import CSV_COLUMNS, fit_parsed
+from corelab_reader import CoreLabsXLSXLoader, FlashExpDataCollection
+from fit_cache import FitCache
+
+HTTP_REASONS = {200: 'OK', 202: 'Accepted', 400: 'Bad Request', 404: 'Not Found',
+                413: 'Payload Too Large', 503: 'Service Unavailable'}
+
+# Whether an upload is an .xlsx report (a zip archive) rather than a .csv
+# composition.
+def is_report(body):
+    return body[:2] == b'PK'
+
+# Error answered with an HTTP status.
+class HTTPError(Exception):
+
+    def __init__(self, status, message, headers=None):
+        Exception.__init__(self, message)
+        self.status = status
+        self.headers = headers or {}
+
+# Runs in a worker process. Fits one task and returns a JSON friendly record;
+# never raises.
+def fit_job_task(name, data, settings, cache_dir=None):
+    start_time = time.time()
+    record = {'event': 'result', 'task': name, 'ok': False}
+    try:
+        cache = FitCache(cache_dir) if cache_dir else None
+        res_df, output = fit_parsed(data, settings['sample_mw'], settings['ave_MC10plus'],
+                                    settings['ita'], cache, name=name)
+        record['results'] = dict(zip(res_df['Variables'], res_df['Values'].astype(float)))
+        record['output'] = {key: json.loads(df.to_json(orient='records'))
+                            for key, df in output.items()}
+        record['ok'] = True
+    except Exception:
+        record['error'] = traceback.format_exc()
+    record['elapsed'] = time.time()-start_time
+    return record
+
+# Runs in a worker process when the service starts so that the pool is warm.
+def _warm_up():
+    return os.getpid()
+
+class FitJob:
+
+    def __init__(self, job_id, body, mode, name, settings):
+        self.id = job_id
+        self.body = body
+        self.mode = mode
+        self.name = name
+        self.settings = settings
+        self.status = 'queued'
+        self.error = None
+        self.n_tasks = None
+        self.results = []
+        self.created = time.time()
+        self.finished = None
+        self.changed = asyncio.Condition()
+
+    async def update(self, status=None, result=None, error=None):
+        async with self.changed:
+            if status is not None:
+                self.status = status
+                if status in ('done', 'failed'):
+                    self.finished = time.time()
+            if result is not None:
+                self.results.append(result)
+            if error is not None:
+                self.error = error
+            self.changed.notify_all()
+
+    def summary(self, results=True):
+        record = {'job_id': self.id, 'name': self.name, 'mode': self.mode, 'status': self.status,
+                  'tasks': self.n_tasks, 'completed': len(self.results), 'error': self.error,
+                  'elapsed': (self.finished or time.time())-self.created}
+        if results:
+            record['results'] = self.results
+        return record
+
+class FitService:
+
+    # workers is the number of fitting processes (default: all cores) and
+    # max_queue the number of jobs waiting to be parsed. Finished jobs are kept
+    # for polling up to max_jobs, oldest dropped first.
+    def __init__(self, workers=None, parse_threads=2, max_queue=16, max_jobs=1000,
+                 max_upload=50*2**20, cache_dir=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.parse_threads = parse_threads
+        self.max_jobs = max_jobs
+        self.max_upload = max_upload
+        self.cache_dir = cache_dir
+        self.queue = asyncio.Queue(max_queue)
+        self.jobs = OrderedDict()
+        self._ids = itertools.count(1)
+        self._runners = []
+        self.process_pool = None
+        self.thread_pool = None
+
+    async def start(self, host='127.0.0.1', port=8765, unix_path=None):
+        self.process_pool = ProcessPoolExecutor(self.workers)
+        self.thread_pool = ThreadPoolExecutor(self.parse_threads)
+        loop = asyncio.get_running_loop()
+        # Starting all worker processes now rather than on the first request.
+        await asyncio.gather(*(loop.run_in_executor(self.process_pool, _warm_up)
+                               for _ in range(self.workers)))
+        self._runners = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+        if unix_path:
+            return await asyncio.start_unix_server(self._handle, unix_path)
+        return await asyncio.start_server(self._handle, host, port)
+
+    async def close(self):
+        for runner in self._runners:
+            runner.cancel()
+        await asyncio.gather(*self._runners, return_exceptions=True)
+        self.process_pool.shutdown(cancel_futures=True)
+        self.thread_pool.shutdown(cancel_futures=True)
+
+    # Queueing an upload. Raises HTTPError 400 for a .csv composition without
+    # sample_mw (refused here rather than failing later in a worker) and 503
+    # when the queue is full. c10_mw and ita default to the values derived from
+    # the lab MWs.
+    def submit(self, body, mode='sample', name=None, settings=None):
+        if mode not in ('sample', 'collection'):
+            raise HTTPError(400, "mode must be 'sample' or 'collection'")
+        settings = dict({'sample_mw': None, 'ave_MC10plus': None, 'ita': None}, **(settings or {}))
+        if not is_report(body) and settings['sample_mw'] is None:
+            raise HTTPError(400, 'sample_mw is required for .csv compositions')
+        job_id = next(self._ids)
+        job = FitJob(job_id, body, mode, name or 'job%d' % job_id, settings)
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise HTTPError(503, 'queue is full', {'Retry-After': '1'})
+        self.jobs[job_id] = job
+        # Dropping the oldest finished jobs.
+        for old_id in [key for key, old in self.jobs.items() if old.finished is not None]:
+            if len(self.jobs) <= self.max_jobs:
+                break
+            del self.jobs[old_id]
+        return job
+
+    # Parsing an upload into (task name, data) pairs. Runs in the thread pool.
+    @staticmethod
+    def _parse(job):
+        body = io.BytesIO(job.body)
+        if not is_report(job.body):
+            df = pd.read_csv(body, header = 0, index_col = False)
+            missing = [column for column in CSV_COLUMNS if column not in df.columns]
+            if missing:
+                raise ValueError('missing .csv columns: %s' % ', '.join(missing))
+            return [(job.name, df)]
+        samples = CoreLabsXLSXLoader(body).read()
+        if not samples:
+            raise ValueError('no flash worksheets found')
+        if job.mode == 'collection':
+            return [(job.name, samples)]
+        tasks = []
+        for key, item in samples.items():
+            sample = FlashExpDataCollection([])
+            sample.add_sample(key, item)
+            tasks.append((key, sample))
+        return tasks
+
+    async def _process(self, job):
+        loop = asyncio.get_running_loop()
+        await job.update('parsing')
+        tasks = await loop.run_in_executor(self.thread_pool, self._parse, job)
+        job.body = None
+        job.n_tasks = len(tasks)
+        await job.update('fitting')
+        futures = [self._fit(name, data, job.settings) for name, data in tasks]
+        for future in asyncio.as_completed(futures):
+            await job.update(result=await future)
+        await job.update('done')
+
+    # Fitting one task in the process pool. A worker that dies (e.g. killed
+    # by the OOM killer) breaks the whole pool: the task is reported as failed
+    # and the pool is replaced so that later tasks and jobs still run.
+    async def _fit(self, name, data, settings):
+        loop = asyncio.get_running_loop()
+        pool = self.process_pool
+        start_time = time.time()
+        try:
+            return await loop.run_in_executor(pool, fit_job_task, name, data, settings,
+                                              self.cache_dir)
+        except BrokenProcessPool:
+            self._restart_pool(pool)
+            return {'event': 'result', 'task': name, 'ok': False,
+                    'error': 'worker process terminated abruptly',
+                    'elapsed': time.time()-start_time}
+
+    # Replacing a broken process pool (once, however many tasks saw it break).
+    def _restart_pool(self, broken):
+        if self.process_pool is broken:
+            self.process_pool = ProcessPoolExecutor(self.workers)
+            broken.shutdown(wait=False, cancel_futures=True)
+
+    async def _run(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self._process(job)
+            except Exception:
+                await job.update('failed', error=traceback.format_exc())
+            finally:
+                self.queue.task_done()
+
+    def status(self):
+        states = [job.status for job in self.jobs.values()]
+        return {'queued': self.queue.qsize(), 'max_queue': self.queue.maxsize,
+                'jobs': {state: states.count(state) for state in set(states)},
+                'workers': self.workers}
+
+    async def _handle(self, reader, writer):
+        try:
+            method, target, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                key, _, value = line.decode('latin-1').partition(':')
+                headers[key.strip().lower()] = value.strip()
+            url = urlsplit(target)
+            query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            parts = [part for part in url.path.split('/') if part]
+            try:
+                await self._route(method, parts, query, headers, reader, writer)
+            except HTTPError as e:
+                await self._respond(writer, e.status, {'error': str(e)}, e.headers)
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _route(self, method, parts, query, headers, reader, writer):
+        if method == 'POST' and parts == ['jobs']:
+            try:
+                length = int(headers.get('content-length', 0))
+            except ValueError:
+                raise HTTPError(400, 'Content-Length must be an integer')
+            if length < 0:
+                raise HTTPError(400, 'Content-Length must not be negative')
+            if length > self.max_upload:
+                raise HTTPError(413, 'upload larger than %d bytes' % self.max_upload)
+            # Refusing before the upload is read when the queue is full.
+            if self.queue.full():
+                raise HTTPError(503, 'queue is full', {'Retry-After': '1'})
+            if headers.get('expect', '').lower() == '100-continue':
+                writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+            body = await reader.readexactly(length)
+            try:
+                settings = {key: float(query[param]) for key, param in
+                            (('sample_mw', 'sample_mw'), ('ave_MC10plus', 'c10_mw'), ('ita', 'ita'))
+                            if param in query}
+            except ValueError:
+                raise HTTPError(400, 'sample_mw, c10_mw and ita must be numbers')
+            job = self.submit(body, query.get('mode', 'sample'), query.get('name'), settings)
+            await self._respond(writer, 202, job.summary(results=False),
+                                {'Location': '/jobs/%d' % job.id})
+        elif method == 'GET' and parts == ['status']:
+            await self._respond(writer, 200, self.status())
+        elif method == 'GET' and len(parts) in (2, 3) and parts[0] == 'jobs':
+            job = self.jobs.get(int(parts[1])) if parts[1].isdigit() else None
+            if job is None:
+                raise HTTPError(404, 'unknown job')
+            if len(parts) == 2:
+                await self._respond(writer, 200, job.summary())
+            elif parts[2] == 'events':
+                await self._stream(writer, job)
+            else:
+                raise HTTPError(404, 'not found')
+        else:
+            raise HTTPError(404, 'not found')
+
+    async def _respond(self, writer, status, payload, headers=None):
+        body = (json.dumps(payload)+'\n').encode()
+        head = ['HTTP/1.1 %d %s' % (status, HTTP_REASONS[status]), 'Content-Type: application/json',
+                'Content-Length: %d' % len(body), 'Connection: close']
+        head.extend('%s: %s' % item for item in (headers or {}).items())
+        writer.write(('\r\n'.join(head)+'\r\n\r\n').encode()+body)
+        await writer.drain()
+
+    # Streaming the job results as chunked newline-delimited JSON. drain()
+    # holds the stream back while the client is not reading.
+    async def _stream(self, writer, job):
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n'
+                     b'Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n')
+        sent = 0
+        while True:
+            async with job.changed:
+                await job.changed.wait_for(lambda: len(job.results) > sent or job.finished)
+                records, finished = job.results[sent:], job.finished is not None
+            if finished:
+                records.append(dict(job.summary(results=False), event='end'))
+            for record in records:
+                chunk = (json.dumps(record)+'\n').encode()
+                writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            sent += len(records)
+            await writer.drain()
+            if finished:
+                break
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+async def serve(host='127.0.0.1', port=8765, unix_path=None, **kwargs):
+    service = FitService(**kwargs)
+    server = await service.start(host, port, unix_path)
+    print('Serving on', unix_path or '%s:%d' % (host, port))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local gamma distribution fitting service.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', default=None, help='Unix socket path (instead of host and port)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of fitting processes (default: all cores)')
+    parser.add_argument('--parse-threads', type=int, default=2, help='number of parsing threads')
+    parser.add_argument('--max-queue', type=int, default=16,
+                        help='number of queued jobs before uploads are refused')
+    parser.add_argument('--cache-dir', default=None, help='directory of the fit cache')
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(args.host, args.port, args.unix, workers=args.workers,
+                          parse_threads=args.parse_threads, max_queue=args.max_queue,
+                          cache_dir=args.cache_dir))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
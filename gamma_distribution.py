@@ -5,7 +5,8 @@ Created on Fri May 22 10:09:02 2020
 @author: Dmitry Molokhov (molokhov@outlook.com)
 """
 # READ IT FIRST:
-# Gamma distribution fitting assumes C10 as the starting component.
+# Gamma distribution fitting assumes C10 as the starting component by default
+# but any SCN in the input can be used (see RegressionLayout).
 # The algorithm is based on Curtis Whitson's work primarily extracted
 # from Phase Behavior SPE Monograph (Volume 20) by Whitson and Brule.
 # Additional information sources are numerous papers on Gamma distribution
@@ -24,45 +25,20 @@ Created on Fri May 22 10:09:02 2020
 
 import pandas as pd
 import numpy as np
+import re
 import scipy.optimize as optim
 import scipy.special as sps
-import scipy.stats as stats
-import matplotlib.pyplot as plt
-pd.set_option('display.max_columns', 500)
+import scipy.sparse as sparse
 import time
-start_time = time.time()
+from fit_cache import cached_start
 
 # Function to prepare the data for distribution fitting.
 # Within the function we backcalculate component MWs used by that lab (though they can be entered
 # directly); normalise molecular weights and finally get our initial estimate of component molecular
-# weight upper bounds.
-def prepare_input(df, mw):
-    
-    # Back-calculating MWs
-    df['MWi_lab'] = df.apply(lambda x : x['wfi_lab']*mw/x['mfi_lab'], axis = 1)
-    
-    # Calculating initial values of upper bounds of individual MWn slices.
-    # Upper bounds are considered as midway between SCN MW values.
-    # C36+ upper bound is set to an arbitrary number (10000).
-    df['ubound_init'] = df['MWi_lab']+(df['MWi_lab'].shift(-1)-df['MWi_lab'])/2
-    df['ubound_init'] = df['ubound_init'].fillna(100000)
-    
-    # Generating regresion variables for component molecular weight bounds:
-    df['ubound'] = 'm'+df['SCN']
-    
-    # Adding top row to represent a lower boundary of C10 (or upper C9 boundary)
-    df_top = pd.DataFrame(pd.DataFrame([['C9']+[np.nan] * (len(df.columns)-1)], columns=df.columns))
-    df = df_top.append(df, ignore_index=True)
-    
-    # Calculating rescaled C10+ weight fractions.
-    df['wni_lab'] = df['wfi_lab']/df['wfi_lab'].sum()
-    
-    # Adding a regression variable for lower C10 molecular weight boundary:
-    df.at[0,'ubound'] = 'ita'
-    # df.at[27,'ubound'] = df.at[27,'ubound_init']
-    df.iloc[-1, df.columns.get_loc('ubound')] = df.iloc[-1, df.columns.get_loc('ubound_init')]
-    
-    return df
+# weight upper bounds. n is the first SCN of the fit (by default the first SCN of the input).
+def prepare_input(df, mw, n=None):
+    layout = RegressionLayout([df], [mw], 'SCN', 'mfi_lab', 'wfi_lab')
+    return layout.cut(n or layout.first_scn).dfs[0]
 
 def gamma_distribution(reg_vals, reg_vars, df, rmse_switch = False):
     
@@ -87,8 +63,7 @@ def gamma_distribution(reg_vals, reg_vars, df, rmse_switch = False):
     # Distribution Model to MW and Boiling Point Data For Petroleum Fractions", Equation 21
     df['Q'] = (np.exp(-df['y'])*(df['y']**lookup['alpha'])/
                sps.gamma(lookup['alpha']))
-    df['P0'] = stats.gamma.cdf((df['ubound']-lookup['ita']), 
-                               a=lookup['alpha'], scale=beta) # Equation 5.18
+    df['P0'] = sps.gammainc(lookup['alpha'], df['y'].clip(lower=0)) # Equation 5.18
     df['P1'] = df['P0']-(df['Q']/lookup['alpha']) # Equation 5.19
     df['Mi'] = (lookup['ita']+lookup['alpha']*beta*
                 ((df['P1']-df['P1'].shift())/(df['P0']-df['P0'].shift()))) # Equation 5.17
@@ -106,7 +81,1092 @@ def gamma_distribution(reg_vals, reg_vars, df, rmse_switch = False):
 
     return rmse_df
 
+# P0 and P1 integrals (Equations 5.18 and 5.19) at dimensionless bounds y.
+# Q is evaluated in log form so that the arbitrary plus fraction upper bound
+# does not overflow y**alpha.
+def gamma_integrals(y, alpha):
+    p0 = sps.gammainc(alpha, y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        q = np.exp(alpha*np.log(y)-y-sps.gammaln(alpha))
+    p1 = p0-q/alpha
+    return p0, p1
+
+# Compiled version of the gamma_distribution objective used by the solver.
+# The layout of the prepared input dataframe(s) is resolved once: every entry
+# of the 'ubound' column becomes either a fixed number or an index into the
+# regression vector. An evaluation then only scatters the regression values
+# into a preallocated float64 array and runs the monograph equations as plain
+# ufuncs. Several samples (sharing alpha, ita and the SCN bounds but each with
+# its own heavy end MW variable) are stored back to back in flat arrays.
+# Slices are the intervals between two consecutive bounds of a sample, i.e.
+# the rows 1: of the input dataframe.
+class GammaObjective:
+
+    def __init__(self, reg_vars, dfs, mw_vars):
+        self.reg_vars = list(reg_vars)
+        lookup = {var: i for i, var in enumerate(self.reg_vars)}
+        # Regression variables are expected to be unique.
+        assert len(lookup) == len(self.reg_vars)
+        self.alpha_idx = lookup['alpha']
+        self.ita_idx = lookup['ita']
+        self.mw_idx = np.array([lookup[var] for var in mw_vars], dtype=np.intp)
+
+        bounds, bound_vars, pos_sample = [], [], []
+        slice_hi, fit_slices, wni_lab, slice_starts = [], [], [], []
+        for s, df in enumerate(dfs):
+            ubound = df['ubound'].tolist()
+            # First slice of the sample in the flat slice array.
+            slice_starts.append(len(slice_hi))
+            for var in ubound:
+                if isinstance(var, str):
+                    bounds.append(np.nan)
+                    bound_vars.append(lookup[var])
+                else:
+                    bounds.append(float(var))
+                    bound_vars.append(-1)
+                pos_sample.append(s)
+            slice_hi.extend(range(len(bounds)-len(ubound)+1, len(bounds)))
+            # The last slice is the plus fraction and is not part of the RMSE.
+            fit_slices.extend(range(slice_starts[-1], len(slice_hi)-1))
+            wni_lab.extend(df['wni_lab'].iloc[1:-1].astype('float64'))
+
+        self.bounds = np.array(bounds, dtype='float64')
+        bound_vars = np.array(bound_vars, dtype=np.intp)
+        self.var_pos = np.flatnonzero(bound_vars >= 0)
+        self.var_idx = bound_vars[self.var_pos]
+        # Variables of the SCN bounds other than ita.
+        self.bound_idx = np.setdiff1d(self.var_idx, [self.ita_idx])
+        self.pos_sample = np.array(pos_sample, dtype=np.intp)
+        self.slice_hi = np.array(slice_hi, dtype=np.intp)
+        self.slice_lo = self.slice_hi-1
+        self.slice_sample = self.pos_sample[self.slice_hi]
+        self.slice_starts = np.array(slice_starts, dtype=np.intp)
+        self.fit_slices = np.array(fit_slices, dtype=np.intp)
+        self.wni_lab = np.array(wni_lab, dtype='float64')
+        # Working array reused by every evaluation.
+        self._ub = self.bounds.copy()
+
+        # Sparsity structure of the residual Jacobian. The first bound of every
+        # sample is ita (so y = 0 there whatever the regression values are) and
+        # the last one is fixed, as set up by prepare_input.
+        pos_first = self.slice_hi[self.slice_starts]-1
+        pos_last = np.append(pos_first[1:], len(self.bounds))-1
+        assert (bound_vars[pos_first] == self.ita_idx).all()
+        assert (bound_vars[pos_last] < 0).all()
+        n_fit = len(self.fit_slices)
+        slice_row = np.full(len(self.slice_hi), -1, dtype=np.intp)
+        slice_row[self.fit_slices] = np.arange(n_fit)
+        pos_slice = np.full(len(self.bounds), -1, dtype=np.intp)
+        pos_slice[self.slice_hi] = np.arange(len(self.slice_hi))
+        # An inner SCN bound only moves weight between the two slices next to it.
+        free = self.var_pos[~np.isin(self.var_pos, pos_first)]
+        rows_hi = slice_row[pos_slice[free]]
+        rows_lo = slice_row[pos_slice[free+1]]
+        self._free_hi = free[rows_hi >= 0]
+        self._free_lo = free[rows_lo >= 0]
+        fit_rows = np.arange(n_fit)
+        self._jac_rows = np.concatenate((fit_rows, fit_rows, fit_rows,
+                                         rows_hi[rows_hi >= 0], rows_lo[rows_lo >= 0]))
+        self._jac_cols = np.concatenate((np.full(n_fit, self.alpha_idx), np.full(n_fit, self.ita_idx),
+                                         self.mw_idx[self.slice_sample[self.fit_slices]],
+                                         bound_vars[self._free_hi], bound_vars[self._free_lo]))
+
+    @property
+    def n_vars(self):
+        return len(self.reg_vars)
+
+    # Full forward model. Returns the per-bound arrays (y, P0, P1) and the
+    # per-slice arrays (Mi, Wi, Wni) for the regression vector x. x can also
+    # be a 2D array with one regression vector per row, in which case all of
+    # them are evaluated in one batched call and the arrays gain a leading axis.
+    def evaluate(self, reg_vals):
+        x = np.asarray(reg_vals, dtype='float64')
+        assert x.shape[-1] == self.n_vars
+        if x.ndim == 1:
+            alpha = x[self.alpha_idx]
+            ita = x[self.ita_idx]
+            ub = self._ub
+        else:
+            alpha = x[..., self.alpha_idx, None]
+            ita = x[..., self.ita_idx, None]
+            ub = np.empty(x.shape[:-1]+self.bounds.shape)
+            ub[...] = self.bounds
+        ub[..., self.var_pos] = x[..., self.var_idx]
+        beta = (x[..., self.mw_idx]-ita)/alpha # Equation 5.14
+        y = (ub-ita)/beta[..., self.pos_sample] # Equation 5.22
+        p0, p1 = gamma_integrals(y, alpha)
+        dp0 = p0[..., self.slice_hi]-p0[..., self.slice_lo]
+        dp1 = p1[..., self.slice_hi]-p1[..., self.slice_lo]
+        mi = ita+alpha*beta[..., self.slice_sample]*dp1/dp0 # Equation 5.17
+        wi = mi*dp0
+        wni = wi/np.add.reduceat(wi, self.slice_starts, axis=-1)[..., self.slice_sample]
+        return {'y': y, 'P0': p0, 'P1': p1, 'Mi': mi, 'Wi': wi, 'Wni': wni}
+
+    # Best fit data in the layout of gamma_distribution(..., rmse_switch = True),
+    # one dataframe per input dataframe the objective was compiled from.
+    def frames(self, reg_vals, dfs):
+        x = np.asarray(reg_vals, dtype='float64')
+        ev = self.evaluate(x)
+        return [self.frame(x, df, s, ev) for s, df in enumerate(dfs)]
+
+    # Best fit dataframe of sample s alone from its input dataframe df. ev is
+    # the result of evaluate(reg_vals) when it is already at hand.
+    def frame(self, reg_vals, df, s, ev=None):
+        x = np.asarray(reg_vals, dtype='float64')
+        if ev is None:
+            ev = self.evaluate(x)
+        alpha = x[self.alpha_idx]
+        pos = self.pos_sample == s
+        sl = self.slice_sample == s
+        df = df.copy()
+        df['ubound'] = self._ub[pos]
+        df['y'] = ev['y'][pos]
+        with np.errstate(divide='ignore'):
+            df['Q'] = np.exp(alpha*np.log(df['y'])-df['y']-sps.gammaln(alpha))
+        df['P0'] = ev['P0'][pos]
+        df['P1'] = ev['P1'][pos]
+        for col in ['Mi', 'Wi', 'Wni']:
+            df[col] = np.append(np.nan, ev[col][sl])
+        df['Zni'] = df['Wni']/df['Mi']*df['Wi'].sum(skipna = True)
+        return df
+
+    # Differences between calculated and laboratory normalised weight fractions
+    # over the fitted slices of all samples.
+    def residuals(self, reg_vals):
+        return self.evaluate(reg_vals)['Wni'][..., self.fit_slices]-self.wni_lab
+
+    # RMSE in percent, identical to gamma_distribution(reg_vals, reg_vars, df).
+    # Returns one RMSE per row for a 2D array of regression vectors.
+    def __call__(self, reg_vals):
+        return 100*np.mean(self.residuals(reg_vals)**2, axis=-1)**.5
+
+    # Residuals and the values of their Jacobian in the (self._jac_rows,
+    # self._jac_cols) sparse layout.
+    # With Wi = ita*dP0 + (M-ita)*dP1 (Equation 5.17 times dP0) everything is
+    # differentiated analytically through y = (ub-ita)/beta, using
+    # dP0/dy = y**(alpha-1)*exp(-y)/gamma(alpha) and dP1/dy = y/alpha*dP0/dy.
+    # The only term without a closed form is the derivative of the regularised
+    # incomplete gamma function with respect to its shape parameter at fixed y,
+    # which is taken as a central difference of gammainc (P1 is gammainc with
+    # shape alpha+1).
+    # Like evaluate() this accepts a 2D array of regression vectors, one row
+    # per vector, and the residuals and values then gain a leading axis.
+    def residual_jacobian(self, reg_vals):
+        x = np.asarray(reg_vals, dtype='float64')
+        ev = self.evaluate(x)
+        if x.ndim == 1:
+            alpha = x[self.alpha_idx]
+            ita = x[self.ita_idx]
+        else:
+            alpha = x[..., self.alpha_idx, None]
+            ita = x[..., self.ita_idx, None]
+        mw = x[..., self.mw_idx]
+        y = ev['y']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            f0 = np.where(y > 0, np.exp((alpha-1)*np.log(y)-y-sps.gammaln(alpha)), 0.)
+        f1 = y*f0/alpha
+        h = 6e-6*alpha
+        dp0_da = (sps.gammainc(alpha+h, y)-sps.gammainc(alpha-h, y))/(2*h)
+        dp1_da = (sps.gammainc(alpha+1+h, y)-sps.gammainc(alpha+1-h, y))/(2*h)
+        mw_ita = (mw-ita)[..., self.pos_sample]
+        # Derivatives of y with respect to alpha, ita (explicit part) and M.
+        dy_da = y/alpha
+        dy_di = (y-alpha)/mw_ita
+        dy_dm = -y/mw_ita
+
+        hi, lo = self.slice_hi, self.slice_lo
+        sample = self.slice_sample
+        dp0 = ev['P0'][..., hi]-ev['P0'][..., lo]
+        dp1 = ev['P1'][..., hi]-ev['P1'][..., lo]
+        m_ita = (mw-ita)[..., sample]
+        total = np.add.reduceat(ev['Wi'], self.slice_starts, axis=-1)
+        wni = ev['Wni']
+
+        def normalised(dwi):
+            dtotal = np.add.reduceat(dwi, self.slice_starts, axis=-1)
+            return ((dwi-wni*dtotal[..., sample])/total[..., sample])[..., self.fit_slices]
+
+        def slice_diff(d):
+            return d[..., hi]-d[..., lo]
+
+        dwi_a = (ita*slice_diff(f0*dy_da+dp0_da)+
+                 m_ita*slice_diff(f1*dy_da+dp1_da))
+        dwi_i = (dp0-dp1+ita*slice_diff(f0*dy_di)+
+                 m_ita*slice_diff(f1*dy_di))
+        dwi_m = (dp1+ita*slice_diff(f0*dy_dm)+
+                 m_ita*slice_diff(f1*dy_dm))
+        # Weight moved per unit change of an inner bound. It leaves the total
+        # weight unchanged, so no normalisation term is needed.
+        beta = mw_ita/alpha
+        g = (ita*f0+mw_ita*f1)/beta/total[..., self.pos_sample]
+
+        vals = np.concatenate((normalised(dwi_a), normalised(dwi_i), normalised(dwi_m),
+                               g[..., self._free_hi], -g[..., self._free_lo]), axis=-1)
+        return ev['Wni'][..., self.fit_slices]-self.wni_lab, vals
+
+    # Residual Jacobian as a sparse matrix (e.g. for optim.least_squares).
+    # Alpha and ita touch every residual, an SCN bound only the two slices of
+    # each sample next to it and a heavy end MW variable only the residuals of
+    # its own sample.
+    def sparse_jacobian(self, reg_vals):
+        vals = self.residual_jacobian(reg_vals)[1]
+        return sparse.csr_matrix((vals, (self._jac_rows, self._jac_cols)),
+                                 shape=(len(self.fit_slices), self.n_vars))
+
+    # Analytic gradient of __call__ with respect to the regression vector.
+    # The RMSE is not differentiable at an exact fit, where its minimum (and
+    # a zero gradient) is.
+    def gradient(self, reg_vals):
+        res, vals = self.residual_jacobian(reg_vals)
+        rmse = 100*np.mean(res**2)**.5
+        if rmse == 0:
+            return np.zeros(self.n_vars)
+        return (1e4/(len(res)*rmse)*
+                np.bincount(self._jac_cols, vals*res[self._jac_rows], minlength=self.n_vars))
+
+# Solver boundaries preset around the initial values: 2% on SCN bounds below
+# C25, 5% on C25 and higher and on the heavy end MWs. No boundary on alpha.
+BOUND_TOLERANCE = 0.02
+HEAVY_BOUND_TOLERANCE = 0.05
+HEAVY_BOUND_SCN = 25
+
+# SCN number of a label such as 'C10' or 'C36+', including the butane and
+# pentane isomers reported on their own rows ('iC4', 'nC4', 'neoC5', 'iC5',
+# 'nC5'). None for anything else (e.g. 'CO2' or a blank row).
+def scn_number(label):
+    match = re.match(r'(?:i|n|neo)?C(\d+)\+?$', str(label))
+    return int(match.group(1)) if match else None
+
+# Smallest SCN width (in g/mol) used when the initial SCN bounds of a reduced
+# bound model do not increase.
+MIN_SCN_WIDTH = 1.0
+
+# Configuration of the SCN bound variables and of the solver boundaries of a
+# fit (see RegressionLayout.cut). kind is one of
+#   'free'        - every SCN bound is a variable within tolerance of its
+#                   initial value (heavy_tolerance from the SCN heavy_scn on),
+#   'increments'  - the SCN bounds are ita plus the cumulative widths of the
+#                   SCNs and the log widths are the variables, so the bounds
+#                   always increase; width_tolerance optionally bounds every
+#                   width relative to its initial value,
+#   'correlation' - the log SCN widths follow a polynomial of the given degree
+#                   in the SCN number, so all SCN bounds are described by
+#                   degree+1 coefficients.
+# ita is bounded by the tolerance of the SCN below the cut, the heavy end MWs by
+# mw_tolerance and alpha by alpha_bounds in all models.
+class BoundModel:
+
+    def __init__(self, kind='free', degree=2, tolerance=BOUND_TOLERANCE,
+                 heavy_tolerance=HEAVY_BOUND_TOLERANCE, heavy_scn=HEAVY_BOUND_SCN,
+                 mw_tolerance=HEAVY_BOUND_TOLERANCE, alpha_bounds=(-np.inf, np.inf),
+                 width_tolerance=None):
+        if kind not in ('free', 'increments', 'correlation'):
+            raise ValueError("kind must be 'free', 'increments' or 'correlation'")
+        self.kind = kind
+        self.degree = degree
+        self.tolerance = tolerance
+        self.heavy_tolerance = heavy_tolerance
+        self.heavy_scn = heavy_scn
+        self.mw_tolerance = mw_tolerance
+        self.alpha_bounds = tuple(alpha_bounds)
+        self.width_tolerance = width_tolerance
+
+    # Plain description of the model, e.g. for the fit cache settings.
+    def settings(self):
+        return tuple(sorted(vars(self).items()))
+
+    def __eq__(self, other):
+        return isinstance(other, BoundModel) and self.settings() == other.settings()
+
+    def __hash__(self):
+        return hash(self.settings())
+
+    def scn_tolerance(self, scn):
+        return self.heavy_tolerance if scn >= self.heavy_scn else self.tolerance
+
+    # Boundaries of the full regression vector (alpha, ita, SCN bounds, heavy
+    # end MWs) around init_vals. scns are the SCNs ending at ita and at every
+    # SCN bound.
+    def box(self, init_vals, scns):
+        n_mw = len(init_vals)-len(scns)-1
+        tolerance = np.concatenate(([0.0], [self.scn_tolerance(k) for k in scns],
+                                    np.full(n_mw, self.mw_tolerance)))
+        lb = init_vals-init_vals*tolerance
+        ub = init_vals+init_vals*tolerance
+        lb[0], ub[0] = self.alpha_bounds
+        return lb, ub
+
+    # Parameter map of the reduced models (None for 'free'). scns are the SCNs
+    # ending at every SCN bound.
+    def parameters(self, reg_vars, scns):
+        if self.kind == 'free':
+            return None
+        scns = np.asarray(scns, dtype='float64')
+        if self.kind == 'increments':
+            basis = np.eye(len(scns))
+            names = ['log_w'+var[1:] for var in reg_vars[2:2+len(scns)]]
+        else:
+            # Polynomial in the SCN number scaled to [0, 1].
+            t = (scns-scns[0])/max(scns[-1]-scns[0], 1)
+            degree = min(self.degree, len(scns)-1)
+            basis = t[:, None]**np.arange(degree+1)
+            names = ['log_w_c%d' % j for j in range(degree+1)]
+        return BoundParameters(reg_vars, basis, names)
+
+# Map between the variables of a reduced bound model and the full regression
+# vector (alpha, ita, SCN bounds, heavy end MWs) of GammaObjective. The reduced
+# vector is alpha, ita, the coefficients c and the heavy end MWs. The log width
+# of the SCN ending at every bound is basis @ c and the bounds are ita plus the
+# cumulative widths.
+class BoundParameters:
+
+    def __init__(self, full_vars, basis, names):
+        self.full_vars = list(full_vars)
+        self.basis = basis
+        self.n_bounds, self.n_coefs = basis.shape
+        self.reg_vars = np.array(self.full_vars[:2]+names+self.full_vars[2+self.n_bounds:])
+        self.mw_idx = np.arange(2+self.n_coefs, len(self.reg_vars))
+
+    # Full regression vector(s) of the reduced vector(s) z (one per row if 2D).
+    def expand(self, z):
+        z = np.asarray(z, dtype='float64')
+        widths = np.exp(z[..., 2:2+self.n_coefs]@self.basis.T)
+        bounds = z[..., 1, None]+np.cumsum(widths, axis=-1)
+        return np.concatenate((z[..., :2], bounds, z[..., 2+self.n_coefs:]), axis=-1)
+
+    # Reduced vector closest to the full regression vector x (least squares on
+    # the log SCN widths).
+    def reduce(self, x):
+        x = np.asarray(x, dtype='float64')
+        widths = np.maximum(np.diff(x[1:2+self.n_bounds]), MIN_SCN_WIDTH)
+        coefs = np.linalg.lstsq(self.basis, np.log(widths), rcond=None)[0]
+        return np.concatenate((x[:2], coefs, x[2+self.n_bounds:]))
+
+    # Derivatives of the SCN bounds with respect to ita and the coefficients,
+    # shape (..., n_bounds, 1+n_coefs).
+    def bound_jacobian(self, z):
+        z = np.asarray(z, dtype='float64')
+        widths = np.exp(z[..., 2:2+self.n_coefs]@self.basis.T)
+        dc = np.cumsum(widths[..., :, None]*self.basis, axis=-2)
+        return np.concatenate((np.ones(dc.shape[:-1]+(1,)), dc), axis=-1)
+
+# GammaObjective in the variables of a reduced bound model (see BoundModel).
+# It offers the interface of GammaObjective used by the solvers: the RMSE,
+# residuals, gradient and the residual Jacobian in a sparse layout, where
+# alpha and the heavy end MW columns keep the sparsity of GammaObjective and the
+# ita and coefficient columns are dense.
+class ReducedObjective:
+
+    def __init__(self, objective, parameters):
+        self.base = objective
+        self.parameters = parameters
+        self.reg_vars = list(parameters.reg_vars)
+        self.alpha_idx = 0
+        self.ita_idx = 1
+        self.mw_idx = parameters.mw_idx
+        self.bound_idx = np.array([], dtype=np.intp)
+        self.fit_slices = objective.fit_slices
+        self.wni_lab = objective.wni_lab
+        self.slice_starts = objective.slice_starts
+        self.slice_sample = objective.slice_sample
+
+        # Entries of the full Jacobian carried over (alpha and the heavy end
+        # MWs) and entries of ita and the SCN bounds, which are gathered into
+        # the dense ita and coefficient columns.
+        rows, cols = objective._jac_rows, objective._jac_cols
+        full_mw = {col: i for i, col in enumerate(objective.mw_idx)}
+        self._keep = np.flatnonzero((cols == objective.alpha_idx) | np.isin(cols, objective.mw_idx))
+        keep_cols = np.array([0 if col == objective.alpha_idx else self.mw_idx[full_mw[col]]
+                              for col in cols[self._keep]], dtype=np.intp)
+        self._gather = np.flatnonzero((cols == objective.ita_idx) | np.isin(cols, objective.bound_idx))
+        # Row of the bound Jacobian for every gathered entry: 0 for ita and
+        # k+1 for the k-th SCN bound (bounds are consecutive variables after ita).
+        self._gather_pos = np.where(cols[self._gather] == objective.ita_idx, 0,
+                                    cols[self._gather]-objective.ita_idx)
+        n_fit = len(self.fit_slices)
+        self._gather_rows = sparse.csr_matrix((np.ones(len(self._gather)),
+                                               (rows[self._gather], np.arange(len(self._gather)))),
+                                              shape=(n_fit, len(self._gather)))
+        dense_cols = np.arange(1, 2+parameters.n_coefs)
+        self._jac_rows = np.concatenate((rows[self._keep], np.repeat(np.arange(n_fit), len(dense_cols))))
+        self._jac_cols = np.concatenate((keep_cols, np.tile(dense_cols, n_fit)))
+
+    @property
+    def n_vars(self):
+        return len(self.reg_vars)
+
+    # Trial steps of the unbounded log widths may overflow; the solvers reject
+    # the resulting non-finite values, so the warnings are silenced.
+    def evaluate(self, reg_vals):
+        with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+            return self.base.evaluate(self.parameters.expand(reg_vals))
+
+    def frames(self, reg_vals, dfs):
+        return self.base.frames(self.parameters.expand(reg_vals), dfs)
+
+    def frame(self, reg_vals, df, s, ev=None):
+        return self.base.frame(self.parameters.expand(reg_vals), df, s, ev)
+
+    def residuals(self, reg_vals):
+        with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+            return self.base.residuals(self.parameters.expand(reg_vals))
+
+    def __call__(self, reg_vals):
+        with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+            return self.base(self.parameters.expand(reg_vals))
+
+    # Residuals and the values of their Jacobian in the (self._jac_rows,
+    # self._jac_cols) layout, by the chain rule through the parameter map.
+    # Accepts a 2D array of regression vectors like GammaObjective.
+    def residual_jacobian(self, reg_vals):
+        z = np.asarray(reg_vals, dtype='float64')
+        with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+            res, vals = self.base.residual_jacobian(self.parameters.expand(z))
+            dbound = self.parameters.bound_jacobian(z)
+        # Bound Jacobian with an ita row in front: ita only moves itself.
+        top = np.zeros(dbound.shape[:-2]+(1, dbound.shape[-1]))
+        top[..., 0, 0] = 1.0
+        dbound = np.concatenate((top, dbound), axis=-2)
+        terms = vals[..., self._gather, None]*dbound[..., self._gather_pos, :]
+        # Summing the terms of every residual: (entries, ...) -> (rows, ...).
+        terms = np.moveaxis(terms, -2, 0)
+        dense = (self._gather_rows@terms.reshape(len(self._gather), -1)).reshape(
+            (len(self.fit_slices),)+terms.shape[1:])
+        dense = np.moveaxis(dense, 0, -2)
+        dense = dense.reshape(dense.shape[:-2]+(-1,))
+        return res, np.concatenate((vals[..., self._keep], dense), axis=-1)
+
+    def sparse_jacobian(self, reg_vals):
+        vals = self.residual_jacobian(reg_vals)[1]
+        return sparse.csr_matrix((vals, (self._jac_rows, self._jac_cols)),
+                                 shape=(len(self.fit_slices), self.n_vars))
+
+    def gradient(self, reg_vals):
+        res, vals = self.residual_jacobian(reg_vals)
+        rmse = 100*np.mean(res**2)**.5
+        if rmse == 0:
+            return np.zeros(self.n_vars)
+        return (1e4/(len(res)*rmse)*
+                np.bincount(self._jac_cols, vals*res[self._jac_rows], minlength=self.n_vars))
+
+# Regression variables, initial values and solver boundaries of a fit of the
+# Cn+ fraction, as given by RegressionLayout.cut(). init_vals are derived from
+# the lab data and centre the boundaries lb, ub; x0 is the starting point
+# (init_vals or the values remembered by the layout, clipped into lb, ub).
+# With a reduced bound model (parameters is a BoundParameters) reg_vars,
+# init_vals, x0, lb and ub are the reduced variables the solvers work on;
+# full_vars and expand() give the full regression vector (alpha, ita, SCN
+# bounds, heavy end MWs) in either case.
+class RegressionCut:
+
+    def __init__(self, n, dfs, reg_vars, mw_vars, init_vals, x0, lb, ub, ita_name,
+                 scn_column='scn', model=None, parameters=None):
+        self.n = n
+        self.dfs = dfs
+        self.scn_column = scn_column
+        self.reg_vars = reg_vars
+        self.mw_vars = mw_vars
+        self.init_vals = init_vals
+        self.x0 = x0
+        self.lb = lb
+        self.ub = ub
+        # Name of the SCN bound that is ita in this cut (e.g. 'mC9' for C10+).
+        self.ita_name = ita_name
+        self.model = model or BoundModel()
+        self.parameters = parameters
+        self._objective = None
+
+    @property
+    def full_vars(self):
+        if self.parameters is None:
+            return self.reg_vars
+        return np.array(self.parameters.full_vars)
+
+    def expand(self, x):
+        return np.asarray(x, dtype='float64') if self.parameters is None else self.parameters.expand(x)
+
+    def reduce(self, x):
+        return np.asarray(x, dtype='float64') if self.parameters is None else self.parameters.reduce(x)
+
+    @property
+    def objective(self):
+        if self._objective is None:
+            full_vars = list(self.full_vars)
+            self._objective = GammaObjective(full_vars, self.dfs, self.mw_vars)
+            if self.parameters is not None:
+                self._objective = ReducedObjective(self._objective, self.parameters)
+        return self._objective
+
+# Regression layout of one or more samples sharing alpha and the SCN bounds.
+# The composition tables (one row per component with SCN label, mole and
+# weight fraction columns, in percent or fractions of the whole sample) are
+# grouped by SCN and the lab MWs and initial upper bounds of every SCN are
+# computed once. cut(n) then gives the input frames, regression variables and
+# boundaries of a Cn+ fit without preparing the input again. Values passed to
+# update() (e.g. a converged fit) are remembered by name, so a fit at another
+# cut starts from the alpha and SCN bounds already regressed. SCN bounds are
+# named after the SCN below them: 'mC9' is the upper bound of C9 and the lower
+# bound ita of a C10+ fit.
+# sample_ids adds sample_id and heavy_end_mw columns to the input frames and
+# mw_var is the heavy end MW variable name, formatted with the sample id and n.
+class RegressionLayout:
+
+    def __init__(self, tables, sample_mws, scn_column='scn', mf_column='lqd_mp',
+                 wf_column='lqd_wp', sample_ids=None, mw_var='{sample}_heavy_mw'):
+        self.scn_column = scn_column
+        self.mf_column = mf_column
+        self.wf_column = wf_column
+        self.sample_ids = sample_ids
+        self.sample_mws = np.asarray(sample_mws, dtype='float64')
+        self.mw_var = mw_var
+        self.tables, self.scns = [], []
+        for table, mw in zip(tables, self.sample_mws):
+            numbers = [scn_number(label) for label in table[scn_column]]
+            table = table[[k is not None for k in numbers]]
+            numbers = np.array([k for k in numbers if k is not None])
+            # Components of the same SCN (e.g. heptanes, methylcyclohexane and
+            # toluene for C7, or i-butane and n-butane for C4) are lumped
+            # together under the SCN label.
+            grouped = table.groupby(numbers, sort=False)
+            table = grouped.first()
+            table[[mf_column, wf_column]] = grouped[[mf_column, wf_column]].sum()
+            table[scn_column] = [label if label.startswith('C') else 'C%d' % k
+                                 for label, k in zip(table[scn_column], table.index)]
+            table = table.reset_index(drop=True)
+            table['MWi_lab'] = table[wf_column]*mw/table[mf_column]
+            # Calculating initial values of upper bounds of individual MWn slices.
+            # Upper bounds are considered as midway between SCN MW values.
+            # The plus fraction upper bound is set to an arbitrary number (100000).
+            table['ubound_init'] = table['MWi_lab']+(table['MWi_lab'].shift(-1)-table['MWi_lab'])/2
+            table['ubound_init'] = table['ubound_init'].fillna(100000)
+            self.tables.append(table)
+            self.scns.append(np.array([scn_number(label) for label in table[scn_column]]))
+        self.values = {}
+
+    # First SCN of the first sample.
+    @property
+    def first_scn(self):
+        return int(self.scns[0][0])
+
+    # Regression layout of the Cn+ fraction. ita is the initial lower bound of
+    # Cn (by default 14 below the initial upper bound of Cn) and heavy_mw the
+    # initial Cn+ MW of every sample (by default back-calculated from the lab
+    # MWs). alpha is the initial shape factor and bounds an optional BoundModel
+    # (by default every SCN bound is a variable within the preset tolerances).
+    def cut(self, n=10, alpha=1.0, ita=None, heavy_mw=None, bounds=None):
+        bounds = bounds or BoundModel()
+        dfs, mw_vars = [], []
+        for s, (table, scn) in enumerate(zip(self.tables, self.scns)):
+            rows = np.flatnonzero(scn == n)
+            if not len(rows):
+                raise ValueError('C%d is not found in the composition of sample %d' % (n, s))
+            body = table.iloc[rows[0]:]
+            # Adding top row to represent a lower boundary of Cn (or upper Cn-1 boundary)
+            top = body.iloc[:0].reindex([0])
+            top[self.scn_column] = 'C%d' % (n-1)
+            df = pd.concat([top, body], ignore_index=True)
+            # Generating regression variables for component molecular weight bounds.
+            # The top row is ita and the plus fraction upper bound is fixed.
+            df['ubound'] = (['ita']+['m'+label for label in body[self.scn_column].iloc[:-1]]+
+                            [body['ubound_init'].iloc[-1]])
+            # Calculating rescaled Cn+ weight fractions.
+            df['wni_lab'] = df[self.wf_column]/df[self.wf_column].sum()
+            sample = self.sample_ids[s] if self.sample_ids is not None else ''
+            mw_vars.append(self.mw_var.format(sample=sample, n=n))
+            if self.sample_ids is not None:
+                df['sample_id'] = sample
+                df['heavy_end_mw'] = mw_vars[-1]
+            dfs.append(df)
+
+        table = self.tables[0]
+        first = int(np.flatnonzero(self.scns[0] == n)[0])
+        body = table.iloc[first:-1]
+        ita_name = 'm'+table[self.scn_column].iloc[first-1] if first else 'mC%d' % (n-1)
+        bound_vars = ['m'+label for label in body[self.scn_column]]
+        if ita is None:
+            ita = body['ubound_init'].iloc[0]-14
+        if heavy_mw is None:
+            heavy_mw = [self.heavy_mw(s, n) for s in range(len(self.tables))]
+        reg_vars = ['alpha', 'ita']+bound_vars+mw_vars
+        init_vals = np.concatenate(([alpha, ita], body['ubound_init'], heavy_mw)).astype('float64')
+        scns = self.scns[0][first:-1]
+        lb, ub = bounds.box(init_vals, np.append(n-1, scns))
+
+        # Starting from the values remembered for this layout.
+        names = ['alpha', ita_name]+bound_vars+[(var, n) for var in mw_vars]
+        x0 = np.array([self.values.get(name, value) for name, value in zip(names, init_vals)])
+        x0 = np.clip(x0, lb, ub)
+        parameters = bounds.parameters(reg_vars, scns)
+        if parameters is not None:
+            # Solver boundaries of the reduced variables: the SCN bound boxes are
+            # replaced by the model (unbounded log widths unless width_tolerance).
+            coefs = parameters.reduce(init_vals)[2:2+parameters.n_coefs]
+            coef_lb, coef_ub = np.full(len(coefs), -np.inf), np.full(len(coefs), np.inf)
+            if bounds.kind == 'increments' and bounds.width_tolerance is not None:
+                coef_lb = coefs+np.log(1-bounds.width_tolerance)
+                coef_ub = coefs+np.log(1+bounds.width_tolerance)
+            lb = np.concatenate((lb[:2], coef_lb, lb[2+len(scns):]))
+            ub = np.concatenate((ub[:2], coef_ub, ub[2+len(scns):]))
+            init_vals = parameters.reduce(init_vals)
+            x0 = np.clip(parameters.reduce(x0), lb, ub)
+            reg_vars = parameters.reg_vars
+        return RegressionCut(n, dfs, np.array(reg_vars), mw_vars, init_vals, x0, lb, ub, ita_name,
+                             self.scn_column, bounds, parameters)
+
+    # Fit cache features of a cut: the normalised Cn+ weight and mole fractions
+    # and the log of the MW of every sample.
+    def cache_features(self, cut):
+        features = []
+        for df, mw in zip(cut.dfs, self.sample_mws):
+            mf = df[self.mf_column].values[1:].astype('float64')
+            features.append(np.concatenate((df['wni_lab'].values[1:], mf/mf.sum(), [np.log(mw)])))
+        return np.concatenate(features)
+
+    # Cn+ MW of sample s back-calculated from the lab MWs of its SCNs.
+    def heavy_mw(self, s, n):
+        table = self.tables[s][self.scns[s] >= n]
+        return table[self.wf_column].sum()*self.sample_mws[s]/table[self.mf_column].sum()
+
+    # Remembering the full regression vector x of a cut (see
+    # RegressionCut.expand). Heavy end MWs are only reused by fits at the same cut.
+    def update(self, cut, x):
+        for var, value in zip(cut.full_vars, x):
+            if var == 'ita':
+                var = cut.ita_name
+            elif var in cut.mw_vars:
+                var = (var, cut.n)
+            self.values[var] = float(value)
+
+# Local solve from x0 within the bounds lb, ub. Returns the regression values
+# and the RMSE. 'least_squares' uses the sparse residual Jacobian and suits
+# large collections. monitor is an optional fit_monitor.FitMonitor recording
+# call counts, timings and the RMSE per iteration.
+def local_fit(objective, x0, lb, ub, solver='SLSQP', monitor=None):
+    if solver not in ('SLSQP', 'least_squares'):
+        raise ValueError("solver must be 'SLSQP' or 'least_squares'")
+    fun = objective if solver == 'SLSQP' else objective.residuals
+    jac = objective.gradient if solver == 'SLSQP' else objective.sparse_jacobian
+    callback, on_residuals = None, None
+    if monitor is not None:
+        if solver == 'SLSQP':
+            # The RMSE at the point passed to the iteration callback has normally
+            # just been evaluated by the solver; it is only evaluated (and
+            # counted) again otherwise.
+            timed, last = monitor.timed(fun, 'objective'), {}
+
+            def fun(x):
+                last['x'], last['rmse'] = np.array(x), timed(x)
+                return last['rmse']
+
+            def callback(xk):
+                if 'x' not in last or not np.array_equal(xk, last['x']):
+                    fun(xk)
+                monitor.iteration(last['rmse'])
+        else:
+            # least_squares has no iteration callback; every residual evaluation
+            # is recorded instead.
+            on_residuals = lambda res: monitor.iteration(100*np.mean(res**2)**.5)
+            fun = monitor.timed(fun, 'objective', on_residuals)
+        jac = monitor.timed(jac, 'gradient')
+    start = time.perf_counter()
+    if solver == 'SLSQP':
+        res = optim.minimize(fun, x0=x0, jac=jac, callback=callback,
+                             method = 'SLSQP', bounds=optim.Bounds(lb, ub), options={'maxiter':10000})
+        rmse = float(res.fun)
+    else:
+        res = optim.least_squares(fun, x0=x0, jac=jac,
+                                  bounds=(lb, ub), method='trf', tr_solver='lsmr', x_scale='jac')
+        rmse = float(objective(res.x))
+    if monitor is not None:
+        monitor.times['solver'] += time.perf_counter()-start
+        monitor.solver_result(res)
+    return res.x, rmse
+
+# local_fit in a worker process of multi_start_fit. The calls, times,
+# RMSE trajectory and solver status are recorded by a local FitMonitor and
+# returned with the fit for the monitor of the parent process.
+def _monitored_local_fit(objective, x0, lb, ub, solver):
+    from fit_monitor import FitMonitor
+    monitor = FitMonitor(iterations=False)
+    x, rmse = local_fit(objective, x0, lb, ub, solver, monitor)
+    return x, rmse, {'counts': dict(monitor.counts), 'times': dict(monitor.times),
+                     'trajectory': monitor.trajectory, 'status': monitor.status}
+
+# Latin hypercube sample of n points in the d-dimensional unit cube.
+def latin_hypercube(n, d, rng):
+    strata = rng.permuted(np.tile(np.arange(n), (d, 1)), axis=1).T
+    return (strata+rng.random((n, d)))/n
+
+# Multi-start search for alpha, ita and the heavy end MW(s). n_starts
+# candidates are drawn by Latin hypercube sampling (alpha within alpha_range,
+# ita and the heavy end MWs within their bounds, other variables at x0) and
+# evaluated with a single batched objective call per chunk of candidates. Only
+# the top_k candidates (x0 itself competes as well) are refined with the local
+# solver, in a process pool when workers > 1. Returns the best (x, rmse).
+# monitor counts the calls and times of all refined starts (also in worker
+# processes) and keeps the solver status of the best one.
+def multi_start_fit(objective, x0, lb, ub, n_starts=1000, top_k=4, alpha_range=(0.3, 5.0),
+                    solver='SLSQP', workers=None, seed=None, chunk_size=256, monitor=None):
+    rng = np.random.default_rng(seed)
+    start = time.perf_counter()
+    x0, lb, ub = (np.asarray(a, dtype='float64') for a in (x0, lb, ub))
+    dims = np.concatenate(([objective.alpha_idx, objective.ita_idx], objective.mw_idx))
+    low, high = lb[dims], ub[dims]
+    low[0] = max(alpha_range[0], low[0])
+    high[0] = min(alpha_range[1], high[0])
+    candidates = np.tile(x0, (n_starts+1, 1))
+    candidates[1:, dims] = low+latin_hypercube(n_starts, len(dims), rng)*(high-low)
+    with np.errstate(all='ignore'):
+        rmse = np.concatenate([objective(candidates[i:i+chunk_size])
+                               for i in range(0, len(candidates), chunk_size)])
+    rmse[np.isnan(rmse)] = np.inf
+    starts = candidates[np.argsort(rmse, kind='stable')[:top_k]]
+    if monitor is not None:
+        monitor.times['multi_start_search'] += time.perf_counter()-start
+    if workers and workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            fits = list(executor.map(_monitored_local_fit, [objective]*len(starts), starts,
+                                     [lb]*len(starts), [ub]*len(starts), [solver]*len(starts)))
+        if monitor is not None:
+            for fit in fits:
+                for name, count in fit[2]['counts'].items():
+                    monitor.counts[name] += count
+                for name, value in fit[2]['times'].items():
+                    monitor.times[name] += value
+                for rmse in fit[2]['trajectory']:
+                    monitor.iteration(rmse)
+        statuses = [fit[2]['status'] for fit in fits]
+    else:
+        fits, statuses = [], []
+        for start in starts:
+            fits.append(local_fit(objective, start, lb, ub, solver, monitor))
+            statuses.append(monitor.status if monitor is not None else None)
+    best = min(range(len(fits)), key=lambda i: fits[i][1])
+    if monitor is not None:
+        monitor.status = statuses[best]
+    return fits[best][0], fits[best][1]
+
+# Batched normal equations J'J dx = J'r of the residual Jacobian of an
+# objective, assembled from its sparse (rows, cols) layout without forming J.
+# Columns split into shared variables (alpha, ita, SCN bounds or bound model
+# coefficients) and the heavy end MWs, each of which only touches the rows of
+# its own sample. J'J is then an arrow matrix: a dense shared block A, the
+# shared/MW block B and a diagonal MW block D, stored in p*p+p*s+s numbers per
+# replica (p shared variables, s samples) and solved through the Schur
+# complement A-B D^-1 B'. Memory grows linearly with the number of samples.
+class _NormalEquations:
+
+    def __init__(self, objective):
+        rows, cols = objective._jac_rows, objective._jac_cols
+        n_vars = objective.n_vars
+        self.mw_idx = np.asarray(objective.mw_idx, dtype=np.intp)
+        self.shared_idx = np.setdiff1d(np.arange(n_vars), self.mw_idx)
+        p, s = len(self.shared_idx), len(self.mw_idx)
+        self.p, self.s = p, s
+        shared_pos = np.full(n_vars, -1, dtype=np.intp)
+        shared_pos[self.shared_idx] = np.arange(p)
+        mw_pos = np.full(n_vars, -1, dtype=np.intp)
+        mw_pos[self.mw_idx] = np.arange(s)
+
+        # All ordered pairs of Jacobian entries in the same row.
+        order = np.argsort(rows, kind='stable')
+        counts = np.bincount(rows, minlength=len(objective.fit_slices))
+        starts = np.cumsum(counts)-counts
+        partners = counts[rows[order]]
+        first = np.repeat(np.arange(len(order)), partners)
+        second = (starts[rows[order]][first]+np.arange(partners.sum())-
+                  np.repeat(np.cumsum(partners)-partners, partners))
+        e1, e2 = order[first], order[second]
+        s1, s2 = shared_pos[cols[e1]], shared_pos[cols[e2]]
+        m1, m2 = mw_pos[cols[e1]], mw_pos[cols[e2]]
+        assert not ((m1 >= 0) & (m2 >= 0) & (m1 != m2)).any()
+        # Upper triangle of A (symmetrised in assemble), B and the diagonal D.
+        upper = (s1 >= 0) & (s2 >= s1)
+        mixed = (s1 >= 0) & (m2 >= 0)
+        diag = (m1 >= 0) & (m2 >= 0)
+        slot = np.concatenate((s1[upper]*p+s2[upper], p*p+s1[mixed]*s+m2[mixed], p*p+p*s+m1[diag]))
+        self._e1 = np.concatenate((e1[upper], e1[mixed], e1[diag]))
+        self._e2 = np.concatenate((e2[upper], e2[mixed], e2[diag]))
+        self._pairs = sparse.csr_matrix((np.ones(len(slot)), (slot, np.arange(len(slot)))),
+                                        shape=(p*p+p*s+s, len(slot)))
+        self._rows = rows
+        self._grad = sparse.csr_matrix((np.ones(len(cols)), (cols, np.arange(len(cols)))),
+                                       shape=(n_vars, len(cols)))
+
+    # A, B, D and the gradient J'r of every replica (one row of vals, res each).
+    def assemble(self, vals, res):
+        p, s = self.p, self.s
+        flat = (self._pairs@(vals[:, self._e1]*vals[:, self._e2]).T).T
+        upper = flat[:, :p*p].reshape(-1, p, p)
+        a = upper+upper.transpose(0, 2, 1)
+        a[:, np.arange(p), np.arange(p)] /= 2
+        b = flat[:, p*p:p*p+p*s].reshape(-1, p, s)
+        d = flat[:, p*p+p*s:]
+        grad = (self._grad@(vals*res[:, self._rows]).T).T
+        return a, b, d, grad
+
+    def diagonal(self, a, d):
+        diag = np.empty((len(d), self.p+self.s))
+        diag[:, self.shared_idx] = np.diagonal(a, axis1=1, axis2=2)
+        diag[:, self.mw_idx] = d
+        return diag
+
+    # Step of the damped normal equations with held variables kept fixed.
+    def solve(self, a, b, d, grad, held, damping):
+        diag = self.diagonal(a, d)
+        add = damping[:, None]*np.where(held, 1.0, diag)+1e-12*diag.max(axis=1, keepdims=True)
+        held_s, held_m = held[:, self.shared_idx], held[:, self.mw_idx]
+        eye = np.eye(self.p)
+        a = a+add[:, self.shared_idx, None]*eye
+        a = np.where(held_s[:, :, None] | held_s[:, None, :], eye, a)
+        b = np.where(held_s[:, :, None] | held_m[:, None, :], 0.0, b)
+        d = np.where(held_m, 1.0, d+add[:, self.mw_idx])
+        grad = np.where(held, 0.0, grad)
+        g_s, g_m = grad[:, self.shared_idx], grad[:, self.mw_idx]
+        bd = b/d[:, None, :]
+        schur = a-bd@b.transpose(0, 2, 1)
+        dx_s = np.linalg.solve(schur, (g_s-(bd@g_m[:, :, None])[:, :, 0])[:, :, None])[:, :, 0]
+        step = np.empty_like(grad)
+        step[:, self.shared_idx] = -dx_s
+        step[:, self.mw_idx] = -(g_m-(b.transpose(0, 2, 1)@dx_s[:, :, None])[:, :, 0])/d
+        return step
+
+# Least squares refit of many replicas of the lab data at once, as a
+# projected Levenberg-Marquardt iteration over all of them. Row r of wni_lab
+# replaces objective.wni_lab for replica r, which starts from x0[r] within
+# lb[r], ub[r]. Every iteration is one batched residual/Jacobian evaluation
+# and a batched solve of the damped normal equations (see _NormalEquations);
+# variables at a bound with the gradient pointing out of the box are held
+# fixed. A replica stops when its cost improves by less than tol or its step
+# is below xtol (both relative) or when its damping blows up.
+# Returns the regression values and the RMSE of every replica. Replicas whose
+# starting point cannot be evaluated are not fitted and get an RMSE of inf.
+def fit_replicas(objective, x0, wni_lab, lb, ub, max_iter=100, tol=1e-10, xtol=1e-8):
+    x, lb, ub = (np.array(np.broadcast_to(a, np.shape(x0)), dtype='float64') for a in (x0, lb, ub))
+    shift = np.broadcast_to(objective.wni_lab-np.asarray(wni_lab, dtype='float64'),
+                            (len(x), len(objective.fit_slices)))
+    normal = _NormalEquations(objective)
+
+    def cost(x, shift):
+        with np.errstate(all='ignore'):
+            res, vals = objective.residual_jacobian(x)
+        res = res+shift
+        total = (res**2).sum(axis=-1)
+        return res, vals, np.where(np.isfinite(total), total, np.inf)
+
+    res, vals, c = cost(x, shift)
+    damping = np.full(len(x), 1e-3)
+    active = np.isfinite(c)
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        idx = np.flatnonzero(active)
+        a, b, d, grad = normal.assemble(vals[idx], res[idx])
+        held = (((x[idx] <= lb[idx]) & (grad > 0)) | ((x[idx] >= ub[idx]) & (grad < 0)) |
+                (normal.diagonal(a, d) <= 0))
+        step = normal.solve(a, b, d, grad, held, damping[idx])
+        x_new = np.clip(x[idx]+step, lb[idx], ub[idx])
+        res_new, vals_new, c_new = cost(x_new, shift[idx])
+        better = c_new < c[idx]
+        small = np.abs(x_new-x[idx]).max(axis=1) <= xtol*np.abs(x[idx]).max(axis=1)
+        done = (better & ((c[idx]-c_new <= tol*c[idx]) | small)) | (damping[idx] > 1e10)
+        acc = idx[better]
+        x[acc], res[acc], vals[acc] = x_new[better], res_new[better], vals_new[better]
+        c[acc] = c_new[better]
+        damping[idx] = np.where(better, damping[idx]/3, damping[idx]*4)
+        active[idx[done]] = False
+    return x, 100*(c/len(objective.fit_slices))**.5
+
+# Replicas of the lab data of a cut for fit_replicas. 'monte_carlo' perturbs
+# the Cn+ weight fractions (plus fraction included) by relative Gaussian
+# noise wt_noise and normalises them again; 'bootstrap' applies relative
+# residuals of the fit x, resampled within every sample, to its fitted weight
+# fractions (weight fractions span decades, so absolute residuals of the light
+# SCNs would swamp the heavy ones). In both
+# cases the sample MW of every sample is perturbed by relative noise mw_noise:
+# lab MWs are proportional to it, so the boundaries of the SCN bounds and ita
+# (taken from the first sample) and of the heavy end MW of every sample scale
+# with it (the coefficients of a reduced bound model are not scaled). x is in
+# the variables of cut.objective. Returns the replica wni_lab and the factors
+# applied to lb, ub.
+def resample_lab_data(cut, x, n_replicas, method='monte_carlo', wt_noise=0.02, mw_noise=0.01,
+                      rng=None):
+    rng = rng or np.random.default_rng()
+    objective = cut.objective
+    fit = objective.fit_slices
+    if method == 'monte_carlo':
+        wni = np.concatenate([df['wni_lab'].values[1:] for df in cut.dfs]).astype('float64')
+        wni = np.maximum(wni*(1+wt_noise*rng.standard_normal((n_replicas, len(wni)))), 0)
+        wni /= np.add.reduceat(wni, objective.slice_starts, axis=1)[:, objective.slice_sample]
+        wni = wni[:, fit]
+    elif method == 'bootstrap':
+        fitted = objective.evaluate(x)['Wni'][fit]
+        residuals = objective.wni_lab/fitted-1
+        # Fitted slices of a sample are contiguous in fit_slices.
+        sample = objective.slice_sample[fit]
+        first = np.searchsorted(sample, sample)
+        count = np.bincount(sample)[sample]
+        draw = first+(rng.random((n_replicas, len(fit)))*count).astype(np.intp)
+        wni = fitted*(1+residuals[draw])
+    else:
+        raise ValueError("method must be 'monte_carlo' or 'bootstrap'")
+    mw_scale = 1+mw_noise*rng.standard_normal((n_replicas, len(cut.dfs)))
+    scale = np.ones((n_replicas, objective.n_vars))
+    scale[:, np.append(objective.ita_idx, objective.bound_idx)] = mw_scale[:, :1]
+    scale[:, objective.mw_idx] = mw_scale
+    return wni, scale
+
+# Uncertainty of the fit x of a cut from n_replicas perturbed copies of the
+# lab data (see resample_lab_data), each refitted with fit_replicas starting
+# from x. Replicas are fitted in chunks of chunk_size, in a process pool when
+# workers > 1. Returns two dataframes: the regression variables and the RMSE
+# with their fitted values, replica mean, standard deviation and percentiles
+# (columns p2.5, p50, ...) and the number of replicas fitted (replicas whose
+# perturbed starting point cannot be evaluated are dropped), and the same
+# statistics of Mi and Wni for every slice of every sample. x is the full
+# regression vector (see RegressionCut.expand); replicas of a reduced bound
+# model are fitted in its variables and reported as full regression vectors.
+def bootstrap_fit(cut, x, n_replicas=1000, method='monte_carlo', wt_noise=0.02, mw_noise=0.01,
+                  percentiles=(2.5, 50, 97.5), workers=None, seed=None, chunk_size=250):
+    objective = cut.objective
+    x = cut.reduce(x)
+    wni, scale = resample_lab_data(cut, x, n_replicas, method, wt_noise, mw_noise,
+                                   np.random.default_rng(seed))
+    lb, ub = cut.lb*scale, cut.ub*scale
+    x0 = np.clip(x, lb, ub)
+    chunks = [slice(i, i+chunk_size) for i in range(0, n_replicas, chunk_size)]
+    args = ([objective]*len(chunks), [x0[c] for c in chunks], [wni[c] for c in chunks],
+            [lb[c] for c in chunks], [ub[c] for c in chunks])
+    if workers and workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            fits = list(executor.map(fit_replicas, *args))
+    else:
+        fits = list(map(fit_replicas, *args))
+    xs = np.concatenate([fit[0] for fit in fits])
+    rmse = np.concatenate([fit[1] for fit in fits])
+    # Replicas that could not be fitted are left out of the statistics.
+    fitted = np.isfinite(rmse)
+    if not fitted.any():
+        raise ValueError('none of the replicas could be fitted')
+    xs, rmse = xs[fitted], rmse[fitted]
+
+    def statistics(df, values, prefix=''):
+        df[prefix+'mean'] = values.mean(axis=0)
+        df[prefix+'std'] = values.std(axis=0)
+        for q, value in zip(percentiles, np.percentile(values, percentiles, axis=0)):
+            df[prefix+'p%g' % q] = value
+        return df
+
+    par_df = pd.DataFrame({'Variables': np.append(cut.full_vars, 'RMSE'),
+                           'Values': np.append(cut.expand(x), objective(x))})
+    par_df = statistics(par_df, np.column_stack((cut.expand(xs), rmse)))
+    par_df['replicas'] = len(xs)
+    base = objective.evaluate(x)
+    ev = objective.evaluate(xs)
+    slice_df = pd.concat([df.iloc[1:][[column for column in ('sample_id', cut.scn_column)
+                                       if column in df.columns]] for df in cut.dfs],
+                         ignore_index=True)
+    for column in ('Mi', 'Wni'):
+        slice_df[column] = base[column]
+        slice_df = statistics(slice_df, ev[column], column+'_')
+    return par_df, slice_df
+
+# Fitting a single sample given as a dataframe with SCN, mfi_lab and wfi_lab columns.
+# Returns the regression results (variables and values followed by the RMSE) and
+# the best fit data.
+# n is the first SCN of the fit (by default the first SCN of the input),
+# ave_MC10plus the initial Cn+ MW and ita the initial lower bound of Cn. They
+# centre the solver boundaries, so by default (None) they are derived from the
+# data of the cut: the Cn+ MW back-calculated from the lab MWs and ita 14 below
+# the Cn upper bound. Fixed values (e.g. 225 and 131 for C10+) only suit one cut.
+# layout is an optional RegressionLayout of comp_input from a previous fit; its
+# fitted alpha and SCN bounds are then reused as the starting point, e.g. when
+# sweeping the cut point.
+# cache is an optional fit_cache.FitCache used to skip or warm start the solve.
+# n_starts > 0 replaces the single local solve with multi_start_fit.
+# monitor is an optional fit_monitor.FitMonitor.
+# bounds is an optional BoundModel, e.g. BoundModel('correlation') to fit a
+# smooth SCN bound correlation instead of every SCN bound.
+def gamma_distribution_fit(comp_input, sample_mw, ave_MC10plus=None, ita=None, cache=None,
+                           n_starts=0, top_k=4, monitor=None, n=None, layout=None, bounds=None):
+    if monitor is not None:
+        monitor.begin(solver='SLSQP', n_starts=n_starts)
+    start = time.perf_counter()
+
+    # Preparing input for the regression:
+    if layout is None:
+        layout = RegressionLayout([comp_input], [sample_mw], 'SCN', 'mfi_lab', 'wfi_lab',
+                                  mw_var='ave_mC{n}plus')
+    n = n or layout.first_scn
+    heavy_mw = None if ave_MC10plus is None else [ave_MC10plus]
+    cut = layout.cut(n, ita=ita, heavy_mw=heavy_mw, bounds=bounds)
+    df = cut.dfs[0]
+    reg_variables, lb, ub = cut.reg_vars, cut.lb, cut.ub
+
+    # Compiling the objective once for the solver:
+    objective = cut.objective
+    if monitor is not None:
+        monitor.times['prepare'] += time.perf_counter()-start
+
+    x, rmse, cache_hit = cut.x0, None, False
+    if cache is not None:
+        features = layout.cache_features(cut)
+        settings = {'n': n, 'ave_MC10plus': ave_MC10plus, 'ita': ita, 'n_starts': n_starts,
+                    'top_k': top_k}
+        if cut.parameters is not None:
+            settings['bounds'] = cut.model.settings()
+        start = time.perf_counter()
+        x, rmse = cached_start(cache, features, settings, reg_variables, x, lb, ub)
+        cache_hit = rmse is not None
+        if monitor is not None:
+            monitor.times['io'] += time.perf_counter()-start
+    if rmse is None:
+        if n_starts:
+            x, rmse = multi_start_fit(objective, x, lb, ub, n_starts, top_k, monitor=monitor)
+        else:
+            x, rmse = local_fit(objective, x, lb, ub, monitor=monitor)
+        if cache is not None:
+            start = time.perf_counter()
+            cache.put(features, settings, reg_variables, x, rmse, lb, ub)
+            if monitor is not None:
+                monitor.times['io'] += time.perf_counter()-start
+    layout.update(cut, cut.expand(x))
+
+    res_df = pd.DataFrame({'Variables': np.append(cut.full_vars, 'RMSE'),
+                           'Values': np.append(cut.expand(x), rmse)})
+
+    # Getting out best fit data
+    out_df = objective.frames(x, [df])[0]
+
+    if monitor is not None:
+        monitor.end(rmse, n_vars=objective.n_vars, n_residuals=len(objective.fit_slices),
+                    cache_hit=cache_hit)
+    return res_df, out_df
+
+# Uncertainty of a single sample fit from n_replicas perturbed copies of its
+# lab data (see bootstrap_fit). The sample is fitted with gamma_distribution_fit
+# first and every replica is refitted starting from that solution. Returns the
+# parameter and the Mi/Wni slice statistics dataframes.
+def gamma_distribution_bootstrap(comp_input, sample_mw, ave_MC10plus=None, ita=None, n=None,
+                                 n_replicas=1000, method='monte_carlo', wt_noise=0.02,
+                                 mw_noise=0.01, percentiles=(2.5, 50, 97.5), workers=None,
+                                 seed=None, bounds=None, chunk_size=250):
+    layout = RegressionLayout([comp_input], [sample_mw], 'SCN', 'mfi_lab', 'wfi_lab',
+                              mw_var='ave_mC{n}plus')
+    res_df = gamma_distribution_fit(comp_input, sample_mw, ave_MC10plus, ita, n=n, layout=layout,
+                                    bounds=bounds)[0]
+    heavy_mw = None if ave_MC10plus is None else [ave_MC10plus]
+    cut = layout.cut(n or layout.first_scn, ita=ita, heavy_mw=heavy_mw, bounds=bounds)
+    return bootstrap_fit(cut, res_df['Values'].values[:-1], n_replicas, method, wt_noise,
+                         mw_noise, percentiles, workers, seed, chunk_size)
+
 if __name__ == "__main__":
+    # Plotting is only needed when running as a script.
+    import matplotlib.pyplot as plt
+    pd.set_option('display.max_columns', 500)
+    start_time = time.time()
     
     # Reading .csv file with SCN identifiers, mole and weight fractions as three input columns
     # Column names are assumed to be in the top row and  they are SCN, mfi_lab, wfi_lab
@@ -123,37 +1183,13 @@ if __name__ == "__main__":
     # from the upper bound.
     ita = 131.0
     
-    # Preparing input for the regression:
-    df = prepare_input(comp_input, sample_mw)
-    
-    # Forming an array of regression variables (excluding MC36 upper bound):
-    reg_variables = np.concatenate((df.loc[df.index[0:-1], 'ubound'].unique(), np.array(['alpha', 'ave_mC10plus'])))
-    
-    # Forming an array of initial values corresponding to these variables (excluding MC36 upper bound):
-    init_vals = np.concatenate((df.loc[df.index[0:-1], 'ubound_init'], np.array([1.0, ave_MC10plus])))
-    init_vals[np.isnan(init_vals)] = ita
-    # Presetting upper and lower boundaries for the solver.
-    # I assume 2% range on SCNs below C25 and 5% on C25 and higher.
-    # No boundary on shape factor and 5% on C10 molecular weight.
-    ub = init_vals+init_vals*0.02
-    ub[16:] = init_vals[16:]+init_vals[16:]*0.05
-    lb = init_vals-init_vals*0.02
-    lb[16:] = init_vals[16:]-init_vals[16:]*0.05
-    lb[27] = -np.inf
-    ub[27] = np.inf
-    
-    res = optim.minimize(gamma_distribution, args=(reg_variables, df), x0=init_vals, 
-                            method = 'SLSQP', bounds=optim.Bounds(lb, ub), options={'maxiter':10000})
-
-    res_df = pd.DataFrame({'Variables': reg_variables, 'Values':res.x})
-
-    # Getting out best fit data
-    out_df = gamma_distribution(res.x, reg_variables, df, rmse_switch = True)
+    res_df, out_df = gamma_distribution_fit(comp_input, sample_mw, ave_MC10plus, ita)
 
     out_df.to_csv(r'.\DATA\out.csv') # [['SCN', 'Mi', 'Wni', 'Zni']]
     # Printing out C10+ molecular weight to the console
-    print('Calculated C10+ average molecular weight:', res_df.at[28, 'Values'])
-    print('RMSE: ', res.fun)
+    res = res_df.set_index('Variables')['Values']
+    print('Calculated C10+ average molecular weight:', res['ave_mC10plus'])
+    print('RMSE: ', res['RMSE'])
     
     # Creating a plot of lab vs calculated compositions
     plt.style.use('classic')
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Splitting a fitted gamma distribution into slices and lumping the slices
+into pseudo-components.
+
+Works on the fitted parameters (alpha, ita and the heavy end MW) of many
+samples at once. Every split returns a dictionary of 2D arrays with one row
+per sample and one column per slice:
+    Mi  - slice molecular weight,
+    Zni - mole fraction of the slice in the heavy end,
+    Wni - weight fraction of the slice in the heavy end,
+    bounds - upper MW bound of the slice (not for the quadrature split).
+Slices are generated either by generalised Gauss-Laguerre quadrature, between
+fixed MW boundaries or between boundaries carrying equal mass. Boundary splits
+use the same P0/P1 integrals as the regression (Equations 5.17 to 5.19 of the
+SPE Phase Behavior monograph).
+
+Usage example:
+    res_df = samples.gamma_distribution_fit()
+    alpha, ita, mw = fitted_parameters(res_df)
+    split = equal_mass_split(alpha, ita, mw, 200)
+    pseudo = lump(split, [20, 40, 60, 80])
+
+GitHub: https://github.com/dimmol/gamma_dist
+"""
+
+import re
+
+import numpy as np
+import pandas as pd
+import scipy.special as sps
+
+from gamma_distribution import gamma_integrals
+
+# Alpha, ita and the heavy end MWs of a regression results dataframe (as
+# returned by the fit functions). Every variable other than alpha, ita, the
+# SCN bounds (mC10, mC11, ...) and the RMSE is a heavy end MW, one per sample.
+def fitted_parameters(res_df):
+    values = res_df.set_index('Variables')['Values']
+    mw = values[[var not in ('alpha', 'ita', 'RMSE') and not re.match(r'mC\d+$', var)
+                 for var in values.index]]
+    n = len(mw)
+    return (np.full(n, values['alpha']), np.full(n, values['ita']),
+            mw.values.astype('float64'))
+
+# Broadcasting the parameters to column vectors of one row per sample.
+def _parameters(alpha, ita, mw):
+    alpha, ita, mw = np.broadcast_arrays(*(np.asarray(p, dtype='float64') for p in (alpha, ita, mw)))
+    alpha, ita, mw = (p.reshape(-1, 1) for p in (alpha, ita, mw))
+    beta = (mw-ita)/alpha # Equation 5.14
+    return alpha, ita, mw, beta
+
+# Slices between the MW bounds of every sample. bounds is either one
+# increasing sequence of upper bounds shared by all samples or a 2D array with
+# one row per sample. The last bound is normally np.inf so that the whole heavy
+# end is covered.
+def boundary_split(alpha, ita, mw, bounds):
+    alpha, ita, mw, beta = _parameters(alpha, ita, mw)
+    bounds = np.broadcast_to(np.asarray(bounds, dtype='float64'), (len(alpha), np.shape(bounds)[-1]))
+    # Adding the lower boundary ita (y = 0) in front of the upper bounds.
+    y = np.maximum((bounds-ita)/beta, 0) # Equation 5.22
+    y = np.concatenate((np.zeros((len(alpha), 1)), y), axis=1)
+    p0, p1 = gamma_integrals(y, alpha)
+    # The log form of Q is undefined at an infinite bound, where P0 = P1 = 1.
+    p1 = np.where(np.isinf(y), 1.0, p1)
+    dp0 = np.diff(p0, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mi = ita+alpha*beta*np.diff(p1, axis=1)/dp0 # Equation 5.17
+    # Empty slices (e.g. bounds below ita) get the MW of their lower bound.
+    lower = np.maximum(np.concatenate((ita, bounds[:, :-1]), axis=1), ita)
+    mi = np.where(dp0 > 0, mi, lower)
+    return {'Mi': mi, 'Zni': dp0, 'Wni': dp0*mi/mw, 'bounds': np.array(bounds)}
+
+# Dimensionless bounds y solving W(y) = target for the fractions c0 = ita/M of
+# the samples of one alpha (column vector). W(y) = P0(y)-(1-c0)*Q(y)/alpha is
+# the cumulative weight fraction (Equations 5.18 to 5.20 with M = ita+alpha*beta)
+# and lies between P0(y) and the incomplete gamma function of order alpha+1, so
+# their inverses lo, hi bracket the root. Newton steps leaving the bracket are
+# replaced by bisection. y is an optional starting point.
+def _weight_fraction_roots(alpha, c0, target, lo, hi, tol, max_iter, y=None):
+    lo, hi = np.broadcast_arrays(lo, np.broadcast_to(hi, np.broadcast(c0, hi).shape))
+    if y is None:
+        y = c0*lo+(1-c0)*hi
+    log_gamma = sps.gammaln(alpha)
+    for _ in range(max_iter):
+        with np.errstate(divide='ignore'):
+            q = np.exp(alpha*np.log(y)-y-log_gamma)
+        f = sps.gammainc(alpha, y)-(1-c0)*q/alpha-target
+        if np.abs(f).max() < tol:
+            break
+        lo = np.where(f < 0, y, lo)
+        hi = np.where(f > 0, y, hi)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step = y-f*y/(q*(c0+(1-c0)*y/alpha))
+        y = np.where((step >= lo) & (step <= hi), step, (lo+hi)/2)
+    return y
+
+# n slices carrying equal mass. Samples sharing alpha only differ by
+# c0 = ita/M, so for larger batches the bounds are solved on a grid of
+# grid_size c0 values, interpolated to every sample and refined by Newton steps.
+def equal_mass_split(alpha, ita, mw, n, tol=1e-10, max_iter=60, grid_size=65):
+    alpha, ita, mw, beta = _parameters(alpha, ita, mw)
+    target = np.arange(1, n)/n
+    c0 = ita/mw
+    y = np.empty((len(alpha), n-1))
+    for a in np.unique(alpha):
+        rows = alpha[:, 0] == a
+        lo, hi = sps.gammaincinv(a, target), sps.gammaincinv(a+1, target)
+        if rows.sum() <= grid_size:
+            y[rows] = _weight_fraction_roots(a, c0[rows], target, lo, hi, tol, max_iter)
+            continue
+        grid = np.linspace(c0[rows].min(), c0[rows].max(), grid_size)
+        y_grid = _weight_fraction_roots(a, grid[:, None], target, lo, hi, tol, max_iter)
+        # Linear interpolation between the grid points next to every sample.
+        i = np.minimum(np.searchsorted(grid, c0[rows, 0], side='right'), grid_size-1)
+        w = ((c0[rows, 0]-grid[i-1])/(grid[i]-grid[i-1]))[:, None]
+        y[rows] = _weight_fraction_roots(a, c0[rows], target, lo, hi, tol, max_iter,
+                                         y_grid[i-1]*(1-w)+y_grid[i]*w)
+    bounds = np.concatenate((ita+beta*y, np.full((len(alpha), 1), np.inf)), axis=1)
+    return boundary_split(alpha, ita, mw, bounds)
+
+# n slices from generalised Gauss-Laguerre quadrature with weight function
+# y**(alpha-1)*exp(-y). The quadrature points give the slice MWs and the
+# normalised weights the mole fractions, so that the first n*2-1 moments of the
+# distribution are reproduced exactly. Samples sharing alpha share the roots.
+def quadrature_split(alpha, ita, mw, n):
+    alpha, ita, mw, beta = _parameters(alpha, ita, mw)
+    mi = np.empty((len(alpha), n))
+    zi = np.empty((len(alpha), n))
+    for a in np.unique(alpha):
+        rows = alpha[:, 0] == a
+        x, w = sps.roots_genlaguerre(n, a-1)
+        mi[rows] = ita[rows]+beta[rows]*x
+        zi[rows] = w/w.sum()
+    return {'Mi': mi, 'Zni': zi, 'Wni': zi*mi/mw}
+
+# Lumping consecutive slices into pseudo-components. groups holds the number
+# of slices of every pseudo-component and has to add up to the number of
+# slices. Mole and weight fractions are summed and the pseudo-component MW is
+# the mole-weighted average of its slices.
+def lump(split, groups):
+    groups = np.asarray(groups, dtype=np.intp)
+    if groups.sum() != split['Mi'].shape[1] or (groups <= 0).any():
+        raise ValueError('groups must be positive and add up to the number of slices')
+    starts = np.concatenate(([0], np.cumsum(groups)[:-1]))
+    zi = np.add.reduceat(split['Zni'], starts, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mi = np.add.reduceat(split['Zni']*split['Mi'], starts, axis=1)/zi
+    lumped = {'Mi': mi, 'Zni': zi, 'Wni': np.add.reduceat(split['Wni'], starts, axis=1)}
+    if 'bounds' in split:
+        lumped['bounds'] = split['bounds'][:, starts+groups-1]
+    return lumped
+
+# Long format dataframe of a split or lump: one row per sample and slice with
+# sample_id, component (PC1, PC2, ...), Mi, Zni, Wni and the upper MW bound.
+def to_frame(split, sample_ids=None):
+    n_samples, n_slices = split['Mi'].shape
+    if sample_ids is None:
+        sample_ids = np.arange(n_samples)
+    df = pd.DataFrame({'sample_id': np.repeat(np.asarray(sample_ids), n_slices),
+                       'component': np.tile(['PC%d' % (i+1) for i in range(n_slices)], n_samples)})
+    for key in ('Mi', 'Zni', 'Wni', 'bounds'):
+        if key in split:
+            df[key] = split[key].ravel()
+    return df
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Shared fixtures of the test suite: the example C10+ composition of the DATA
+directory and small synthetic collections from benchmark.py.
+
+GitHub: https://github.com/dimmol/gamma_dist
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmark import synthetic_collection, synthetic_parameters
+from gamma_distribution import RegressionLayout
+
+DATA = os.path.join(ROOT, 'DATA')
+
+# Whole sample MW, initial C10+ MW and ita of the example composition (as in
+# the main section of gamma_distribution.py).
+SAMPLE_MW = 171.0
+AVE_MC10PLUS = 225.0
+ITA = 131.0
+
+@pytest.fixture
+def comp_input():
+    return pd.read_csv(os.path.join(DATA, 'gamma_dist_input.csv'), header = 0, index_col = False)
+
+# Layout of the example composition with the variable names of the single
+# sample fit ('ave_mC10plus' for the heavy end MW).
+@pytest.fixture
+def layout(comp_input):
+    return RegressionLayout([comp_input], [SAMPLE_MW], 'SCN', 'mfi_lab', 'wfi_lab',
+                            mw_var='ave_mC{n}plus')
+
+@pytest.fixture
+def cut(layout):
+    return layout.cut(10, ita=ITA, heavy_mw=[AVE_MC10PLUS])
+
+# Synthetic collection of three samples sharing alpha and ita, with 2% noise
+# on their C10+ compositions.
+@pytest.fixture
+def collection():
+    rng = np.random.default_rng(0)
+    return synthetic_collection(synthetic_parameters(3, rng), noise=0.02, rng=rng)
+
+# Regression layout of a collection, as its fits build it from the liquid
+# compositions and average liquid MWs of the samples.
+def collection_layout(samples):
+    return RegressionLayout([item.phase_frame() for item in samples.values()],
+                            [item.av_lqd_mw for item in samples.values()],
+                            sample_ids=[key.replace('.', '_') for key in samples.keys()])
+
+# C10+ cut of a collection layout started from the heavy end MWs of the samples.
+def collection_cut(samples, n=10, bounds=None, layout=None):
+    layout = layout or collection_layout(samples)
+    return layout.cut(n, heavy_mw=samples.heavy_end_mws(n), bounds=bounds)
+
+# Regression vectors spread over the solver boundaries of a cut, one per row.
+# Alpha, which has no boundaries, is drawn between 0.5 and 3 and the unbounded
+# coefficients of a reduced bound model within 0.1 of their initial values.
+def _random_points(cut, n, seed=0):
+    rng = np.random.default_rng(seed)
+    lb, ub = cut.lb.copy(), cut.ub.copy()
+    lb[0], ub[0] = 0.5, 3.0
+    free = ~(np.isfinite(lb) & np.isfinite(ub))
+    lb[free], ub[free] = cut.init_vals[free]-0.1, cut.init_vals[free]+0.1
+    return lb+(ub-lb)*rng.random((n, len(lb)))
+
+@pytest.fixture
+def random_points():
+    return _random_points
+
+# Central finite differences of fun (a scalar or array function) at x.
+def finite_differences(fun, x, rel_step=1e-6):
+    columns = []
+    for i in range(len(x)):
+        h = rel_step*max(abs(x[i]), 1.0)
+        step = np.zeros(len(x))
+        step[i] = h
+        columns.append((np.asarray(fun(x+step))-np.asarray(fun(x-step)))/(2*h))
+    return np.stack(columns, axis=-1)
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the batch fitting CLI helpers: unreadable inputs and failed fits
+are reported as failed tasks instead of stopping the batch.
+
+GitHub: https://github.com/dimmol/gamma_dist
+"""
+
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from batch_fit import collect_tasks, is_long_csv, iter_long_csv, run_samples, run_task
+from conftest import DATA, SAMPLE_MW
+
+def test_unreadable_inputs_are_failed_tasks(tmp_path):
+    (tmp_path / 'corrupt.xlsx').write_bytes(b'not a zip archive')
+    (tmp_path / 'empty.csv').write_text('')
+    shutil.copy(os.path.join(DATA, 'gamma_dist_input.csv'), tmp_path / 'good.csv')
+    tasks = collect_tasks(str(tmp_path))
+    assert [os.path.basename(path) for path, _ in tasks] == ['corrupt.xlsx', 'empty.csv', 'good.csv']
+    results = {os.path.basename(task[0]): run_task(task, SAMPLE_MW) for task in tasks}
+    assert 'BadZipFile' in results['corrupt.xlsx']['error']
+    assert 'EmptyDataError' in results['empty.csv']['error']
+    assert not results['corrupt.xlsx']['ok'] and not results['empty.csv']['ok']
+    assert results['good.csv']['ok']
+
+def test_non_finite_rmse_is_a_failed_task(tmp_path, comp_input):
+    comp_input.loc[3, 'wfi_lab'] = np.nan
+    path = str(tmp_path / 'nan.csv')
+    comp_input.to_csv(path, index=False)
+    result = run_task((path, None), SAMPLE_MW)
+    assert not result['ok']
+    assert 'RMSE is nan' in result['error']
+
+def test_split_archive_sample_is_a_failed_fit(tmp_path, comp_input):
+    rows = comp_input.rename(columns={'mfi_lab': 'mfi', 'wfi_lab': 'wfi'})
+    parts = [rows.assign(sample_id=sample_id) for sample_id in ('A', 'B')]
+    archive = pd.concat([parts[0][:8], parts[1], parts[0][8:]]).assign(sample_mw=SAMPLE_MW)
+    path = str(tmp_path / 'archive.csv')
+    archive.to_csv(path, index=False)
+    assert is_long_csv(path)
+    samples = list(iter_long_csv(path, chunksize=10))
+    assert [sample[0] for sample in samples] == ['A', 'B', 'A']
+    results = run_samples(path, samples)
+    assert [result['ok'] for result in results] == [True, True, False]
+    assert 'not contiguous' in results[2]['error']
+
+def test_unreadable_csv_is_not_an_archive(tmp_path):
+    (tmp_path / 'empty.csv').write_text('')
+    assert not is_long_csv(str(tmp_path / 'empty.csv'))
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the synthetic data of benchmark.py: the true gamma parameters lie
+within the solver boxes of the fits that are meant to recover them.
+
+GitHub: https://github.com/dimmol/gamma_dist
+"""
+
+import numpy as np
+import pytest
+
+from benchmark import scn_bounds, synthetic_collection, synthetic_composition, synthetic_parameters
+from conftest import collection_cut
+from gamma_distribution import RegressionLayout
+
+@pytest.mark.parametrize('alpha, mw_plus', [(0.85, 225.0), (0.5, 205.0), (2.5, 245.0)])
+def test_single_fit_truth_is_feasible(alpha, mw_plus):
+    ita = 130.0
+    comp_input, sample_mw = synthetic_composition(alpha, ita, mw_plus)
+    layout = RegressionLayout([comp_input], [sample_mw], 'SCN', 'mfi_lab', 'wfi_lab',
+                              mw_var='ave_mC{n}plus')
+    # The start of bench_single_fit.
+    cut = layout.cut(10, ita=0.99*ita, heavy_mw=[0.98*mw_plus])
+    x = np.concatenate(([alpha], scn_bounds(alpha, ita, mw_plus)[:-1], [mw_plus]))
+    assert ((x >= cut.lb) & (x <= cut.ub)).all()
+    assert cut.objective(x) < 1e-10
+
+def test_collection_truth_is_feasible():
+    params = synthetic_parameters(4, np.random.default_rng(0))
+    samples = synthetic_collection(params)
+    cut = collection_cut(samples)
+    alpha, ita = params[0][:2]
+    x = np.concatenate(([alpha], scn_bounds(*params[0])[:-1], [p[2] for p in params]))
+    assert ((x >= cut.lb) & (x <= cut.ub)).all()
+    assert cut.objective(x) < 1e-10
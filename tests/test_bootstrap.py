@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the replica refits behind the bootstrap bands: the sparse normal
+equations against the dense ones, fit_replicas against a single least squares
+fit and the sanity of the bands.
+
+GitHub: https://github.com/dimmol/gamma_dist
+"""
+
+import numpy as np
+import pytest
+
+from conftest import AVE_MC10PLUS, ITA, SAMPLE_MW, collection_cut
+from gamma_distribution import (_NormalEquations, fit_replicas, gamma_distribution_bootstrap,
+                                local_fit, resample_lab_data)
+
+def test_normal_equations_match_dense(collection, random_points):
+    cut = collection_cut(collection)
+    objective = cut.objective
+    normal = _NormalEquations(objective)
+    xs = random_points(cut, 4, seed=1)
+    res, vals = objective.residual_jacobian(xs)
+    a, b, d, grad = normal.assemble(vals, res)
+    rng = np.random.default_rng(2)
+    held = rng.random(xs.shape) < 0.2
+    damping = np.array([1e-3, 1e-1, 1.0, 10.0])
+    step = normal.solve(a, b, d, grad, held, damping)
+    shared, mw = normal.shared_idx, normal.mw_idx
+    for r, x in enumerate(xs):
+        jac = objective.sparse_jacobian(x).toarray()
+        hessian = jac.T@jac
+        np.testing.assert_allclose(a[r], hessian[np.ix_(shared, shared)], rtol=1e-12, atol=1e-14)
+        np.testing.assert_allclose(b[r], hessian[np.ix_(shared, mw)], rtol=1e-12, atol=1e-14)
+        np.testing.assert_allclose(d[r], hessian[mw, mw], rtol=1e-12)
+        np.testing.assert_allclose(grad[r], jac.T@res[r], rtol=1e-12, atol=1e-16)
+        # Damped dense step with the held variables fixed.
+        diag = np.diag(hessian)
+        add = damping[r]*np.where(held[r], 1.0, diag)+1e-12*diag.max()
+        free = ~held[r]
+        system = (hessian+np.diag(add))[np.ix_(free, free)]
+        expected = np.zeros(len(x))
+        expected[free] = -np.linalg.solve(system, (jac.T@res[r])[free])
+        np.testing.assert_allclose(step[r], expected, rtol=1e-8,
+                                   atol=1e-10*np.abs(expected).max())
+
+def test_fit_replicas_matches_least_squares(collection):
+    cut = collection_cut(collection)
+    objective = cut.objective
+    x = local_fit(objective, cut.x0, cut.lb, cut.ub, solver='least_squares')[0]
+    wni = resample_lab_data(cut, x, 3, rng=np.random.default_rng(3))[0]
+    xs, rmse = fit_replicas(objective, np.tile(x, (len(wni), 1)), wni, cut.lb, cut.ub)
+    lab = objective.wni_lab
+    try:
+        for r in range(len(wni)):
+            objective.wni_lab = wni[r]
+            assert rmse[r] == pytest.approx(objective(xs[r]), rel=1e-10)
+            assert rmse[r] <= objective(x)
+            reference = local_fit(objective, x, cut.lb, cut.ub, solver='least_squares')[1]
+            assert rmse[r] <= reference*(1+1e-3)
+    finally:
+        objective.wni_lab = lab
+    assert ((xs >= cut.lb) & (xs <= cut.ub)).all()
+
+def test_fit_replicas_skips_starts_that_cannot_be_evaluated(cut):
+    x0 = np.tile(cut.x0, (2, 1))
+    x0[1, 0] = np.nan
+    xs, rmse = fit_replicas(cut.objective, x0, cut.objective.wni_lab, cut.lb, cut.ub)
+    assert np.isfinite(rmse[0]) and rmse[1] == np.inf
+
+@pytest.mark.parametrize('method', ['monte_carlo', 'bootstrap'])
+def test_bootstrap_bands(comp_input, method):
+    par_df, slice_df = gamma_distribution_bootstrap(comp_input, SAMPLE_MW, AVE_MC10PLUS, ITA,
+                                                    n_replicas=40, method=method, seed=0,
+                                                    chunk_size=15)
+    assert (par_df['replicas'] == 40).all()
+    assert (par_df['p2.5'] <= par_df['p50']).all() and (par_df['p50'] <= par_df['p97.5']).all()
+    values = par_df.set_index('Variables')
+    for var in ('alpha', 'ita', 'ave_mC10plus'):
+        assert values.at[var, 'std'] > 0
+        assert values.at[var, 'p2.5'] <= values.at[var, 'Values'] <= values.at[var, 'p97.5']
+    for column in ('Mi', 'Wni'):
+        assert (slice_df[column+'_p2.5'] <= slice_df[column+'_p97.5']).all()
+    assert len(slice_df) == len(comp_input)
+    np.testing.assert_allclose(slice_df['Wni_mean'].sum(), 1.0, rtol=1e-10)
+
+def test_bootstrap_chunks_do_not_change_the_bands(comp_input):
+    fits = [gamma_distribution_bootstrap(comp_input, SAMPLE_MW, AVE_MC10PLUS, ITA, n_replicas=30,
+                                         seed=1, chunk_size=chunk_size)[0]
+            for chunk_size in (7, 250)]
+    np.testing.assert_allclose(fits[0]['mean'], fits[1]['mean'], rtol=1e-12)
+    np.testing.assert_allclose(fits[0]['std'], fits[1]['std'], rtol=1e-9)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the reduced SCN bound models (BoundModel): the parameter map, the
+chain-ruled Jacobian of ReducedObjective and fits with every model.
+
+GitHub: https://github.com/dimmol/gamma_dist
+"""
+
+import numpy as np
+import pytest
+
+from conftest import AVE_MC10PLUS, ITA, SAMPLE_MW, collection_cut, finite_differences
+from gamma_distribution import BoundModel, ReducedObjective, gamma_distribution_fit
+
+MODELS = [BoundModel('increments'), BoundModel('correlation', degree=2)]
+
+def test_free_model_is_the_default(comp_input, layout, cut):
+    free_cut = layout.cut(10, ita=ITA, heavy_mw=[AVE_MC10PLUS], bounds=BoundModel('free'))
+    assert free_cut.parameters is None
+    for key in ('reg_vars', 'init_vals', 'x0', 'lb', 'ub'):
+        np.testing.assert_array_equal(getattr(free_cut, key), getattr(cut, key))
+    fits = [gamma_distribution_fit(comp_input, SAMPLE_MW, AVE_MC10PLUS, ITA, bounds=bounds)[0]
+            for bounds in (None, BoundModel())]
+    np.testing.assert_array_equal(fits[0]['Values'], fits[1]['Values'])
+
+def test_equal_models_hash_alike():
+    assert BoundModel('correlation', degree=2) == MODELS[1]
+    assert hash(BoundModel('correlation', degree=2)) == hash(MODELS[1])
+    assert len({BoundModel(), BoundModel('free'), *MODELS, BoundModel('increments')}) == 3
+
+@pytest.mark.parametrize('model', MODELS, ids=lambda model: model.kind)
+def test_parameter_map(layout, model, random_points):
+    cut = layout.cut(10, ita=ITA, heavy_mw=[AVE_MC10PLUS], bounds=model)
+    parameters = cut.parameters
+    assert len(cut.reg_vars) == 2+parameters.n_coefs+1
+    if model.kind == 'correlation':
+        assert parameters.n_coefs == model.degree+1
+    for z in random_points(cut, 3):
+        x = parameters.expand(z)
+        # The SCN bounds always increase from ita.
+        assert (np.diff(x[1:-1]) > 0).all()
+        np.testing.assert_allclose(parameters.bound_jacobian(z)[:, 1:],
+                                   finite_differences(lambda z: parameters.expand(z)[2:-1],
+                                                      z)[:, 2:2+parameters.n_coefs],
+                                   rtol=1e-6)
+    # The increments model describes any increasing bounds exactly.
+    if model.kind == 'increments':
+        full = layout.cut(10, ita=ITA, heavy_mw=[AVE_MC10PLUS]).init_vals
+        np.testing.assert_allclose(parameters.expand(parameters.reduce(full)), full, rtol=1e-12)
+
+@pytest.mark.parametrize('model', MODELS, ids=lambda model: model.kind)
+def test_reduced_jacobian_matches_finite_differences(collection, model, random_points):
+    cut = collection_cut(collection, bounds=model)
+    objective = cut.objective
+    assert isinstance(objective, ReducedObjective)
+    for z in random_points(cut, 2, seed=1):
+        jac = objective.sparse_jacobian(z).toarray()
+        dense = finite_differences(objective.residuals, z)
+        np.testing.assert_allclose(jac, dense, rtol=1e-4, atol=1e-7*np.abs(dense).max())
+        grad = objective.gradient(z)
+        np.testing.assert_allclose(grad, finite_differences(objective, z), rtol=1e-4,
+                                   atol=1e-6*np.abs(grad).max())
+        np.testing.assert_array_equal(objective.residuals(z),
+                                      objective.base.residuals(cut.expand(z)))
+
+@pytest.mark.parametrize('model', MODELS+[BoundModel('increments', width_tolerance=0.05)],
+                         ids=['increments', 'correlation', 'width_tolerance'])
+def test_reduced_fit_lists_increasing_bounds(comp_input, model):
+    res_df = gamma_distribution_fit(comp_input, SAMPLE_MW, AVE_MC10PLUS, ITA, bounds=model)[0]
+    free_df = gamma_distribution_fit(comp_input, SAMPLE_MW, AVE_MC10PLUS, ITA)[0]
+    assert list(res_df['Variables']) == list(free_df['Variables'])
+    values = res_df.set_index('Variables')['Values']
+    bounds = values[[var.startswith('mC') for var in values.index]]
+    assert values['ita'] < bounds.iloc[0] and (np.diff(bounds) > 0).all()
+    assert values['RMSE'] < 1.0
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the columnar .npz storage of FlashExpDataCollection and of the
+sample data kept by a collection fit.
+
+GitHub: https://github.com/dimmol/gamma_dist
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import DATA
+from corelab_reader import CoreLabsXLSXLoader, FlashExpDataCollection
+
+@pytest.fixture(scope='module')
+def report():
+    return CoreLabsXLSXLoader(os.path.join(DATA, 'PS1.xlsx')).read()
+
+def assert_same_samples(loaded, samples):
+    assert loaded.sample_names == samples.sample_names
+    for key, item in samples.items():
+        other = loaded[key]
+        np.testing.assert_array_equal(other.values, item.values)
+        assert list(other.components.scn) == list(item.components.scn)
+        assert list(other.components.cl_name) == list(item.components.cl_name)
+        assert other.av_lqd_mw == item.av_lqd_mw
+        assert other.depth == item.depth
+        assert other.cylinder == item.cylinder
+
+@pytest.mark.parametrize('mmap_mode', [None, 'r'])
+def test_report_round_trip(report, tmp_path, mmap_mode):
+    path = str(tmp_path/'report.npz')
+    report.save(path)
+    loaded = FlashExpDataCollection.load(path, mmap_mode=mmap_mode)
+    assert_same_samples(loaded, report)
+    np.testing.assert_array_equal(loaded.heavy_end_mws(10), report.heavy_end_mws(10))
+    # Samples reported with the same component list share one table.
+    tables = {id(item.components) for item in loaded.values()}
+    assert len(tables) == len({id(item.components) for item in report.values()})
+    for item in loaded.values():
+        assert not item.values.flags.writeable
+    if mmap_mode:
+        assert all(isinstance(item.values.base, np.memmap) for item in loaded.values())
+
+def test_missing_descriptors_round_trip(collection, tmp_path):
+    samples = collection
+    samples['C.2'].depth, samples['C.2'].cylinder = 4000.5, '1234'
+    assert samples['C.1'].depth is None and samples['C.1'].cylinder is None
+    path = str(tmp_path/'samples.npz')
+    samples.save(path)
+    assert_same_samples(FlashExpDataCollection.load(path, mmap_mode='r'), samples)
+
+def test_compressed_file_loads_without_mmap(report, tmp_path):
+    path, compressed_path = str(tmp_path/'report.npz'), str(tmp_path/'compressed.npz')
+    report.save(path)
+    with np.load(path) as data:
+        np.savez_compressed(compressed_path, **data)
+    assert_same_samples(FlashExpDataCollection.load(compressed_path, mmap_mode='r'), report)
+
+def test_empty_collection_round_trip(tmp_path):
+    path = str(tmp_path/'empty.npz')
+    FlashExpDataCollection().save(path)
+    assert len(FlashExpDataCollection.load(path)) == 0
+
+def test_fit_keeps_no_frames_on_the_samples(collection):
+    samples = collection
+    res_df = samples.gamma_distribution_fit(verbose=False)
+    for item in samples.values():
+        assert item.gamma_input is None
+        assert not item._frames
+    # The best fit data is built from the fitted values on access.
+    first, again = samples['C.1'].gamma_output, samples['C.1'].gamma_output
+    assert first is not again
+    pd.testing.assert_frame_equal(first, again)
+    wni = np.concatenate([item.gamma_output['Wni'].values[1:-1] for item in samples.values()])
+    lab = np.concatenate([item.gamma_output['wni_lab'].values[1:-1] for item in samples.values()])
+    assert 100*np.mean((wni-lab)**2)**0.5 == pytest.approx(res_df['Values'].iloc[-1], rel=1e-10)
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the checks of the fitting service on submitted uploads.
+
+GitHub: https://github.com/dimmol/gamma_dist
+"""
+
+import os
+
+import pytest
+
+from conftest import DATA, SAMPLE_MW
+from fit_service import FitService, HTTPError
+
+@pytest.fixture
+def csv_body():
+    with open(os.path.join(DATA, 'gamma_dist_input.csv'), 'rb') as f:
+        return f.read()
+
+def test_csv_without_sample_mw_is_refused(csv_body):
+    service = FitService(workers=1)
+    with pytest.raises(HTTPError) as error:
+        service.submit(csv_body)
+    assert error.value.status == 400
+    assert not service.jobs and service.queue.empty()
+
+def test_csv_with_sample_mw_is_queued(csv_body):
+    service = FitService(workers=1)
+    job = service.submit(csv_body, settings={'sample_mw': SAMPLE_MW})
+    assert job.settings == {'sample_mw': SAMPLE_MW, 'ave_MC10plus': None, 'ita': None}
+    assert service.queue.qsize() == 1
+
+def test_report_does_not_need_sample_mw():
+    with open(os.path.join(DATA, 'PS1.xlsx'), 'rb') as f:
+        body = f.read()
+    service = FitService(workers=1)
+    service.submit(body, mode='collection')
+    assert service.queue.qsize() == 1
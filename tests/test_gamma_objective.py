@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the compiled gamma distribution objective (GammaObjective) against
+the dataframe implementation it replaces.
+
+GitHub: https://github.com/dimmol/gamma_dist
+"""
+
+import numpy as np
+import pytest
+
+from benchmark import synthetic_collection, synthetic_parameters
+from conftest import collection_cut, finite_differences
+from gamma_distribution import GammaObjective, gamma_distribution
+
+def test_rmse_matches_gamma_distribution(cut, random_points):
+    objective = cut.objective
+    for x in np.vstack((cut.x0, random_points(cut, 5))):
+        assert objective(x) == pytest.approx(gamma_distribution(x, cut.reg_vars, cut.dfs[0]),
+                                             rel=1e-10)
+
+def test_frames_match_gamma_distribution(cut, random_points):
+    x = random_points(cut, 1)[0]
+    out_df = cut.objective.frames(x, cut.dfs)[0]
+    ref_df = gamma_distribution(x, cut.reg_vars, cut.dfs[0], rmse_switch=True)
+    for column in ('y', 'P0', 'P1', 'Mi', 'Wi', 'Wni', 'Zni'):
+        np.testing.assert_allclose(out_df[column].values.astype('float64'),
+                                   ref_df[column].values.astype('float64'), rtol=1e-10)
+
+def test_batched_evaluate_matches_single(cut, random_points):
+    objective = cut.objective
+    xs = random_points(cut, 7)
+    batch = objective.evaluate(xs)
+    for i, x in enumerate(xs):
+        single = objective.evaluate(x)
+        for key in ('y', 'P0', 'P1', 'Mi', 'Wi', 'Wni'):
+            np.testing.assert_allclose(batch[key][i], single[key], rtol=1e-12)
+    np.testing.assert_allclose(objective(xs), [objective(x) for x in xs], rtol=1e-12)
+    assert objective.residuals(xs).shape == (len(xs), len(objective.fit_slices))
+
+def test_collection_rmse_matches_gamma_distribution(collection):
+    cut = collection_cut(collection)
+    objective = GammaObjective(cut.reg_vars, cut.dfs, cut.mw_vars)
+    x = cut.x0*(1+0.01*np.random.default_rng(1).standard_normal(len(cut.x0)))
+    assert objective(x) == pytest.approx(collection.gamma_distribution(x, cut.reg_vars,
+                                                                      dfs=cut.dfs), rel=1e-10)
+    # Every sample is normalised on its own.
+    wni = objective.evaluate(x)['Wni']
+    sums = np.add.reduceat(wni, objective.slice_starts)
+    np.testing.assert_allclose(sums, 1.0, rtol=1e-12)
+
+def test_gradient_matches_finite_differences(cut, random_points):
+    objective = cut.objective
+    for x in random_points(cut, 3, seed=2):
+        grad = objective.gradient(x)
+        np.testing.assert_allclose(grad, finite_differences(objective, x), rtol=1e-4,
+                                   atol=1e-6*np.abs(grad).max())
+
+def test_gradient_is_zero_at_exact_fit(cut):
+    objective = cut.objective
+    objective.wni_lab = objective.evaluate(cut.x0)['Wni'][objective.fit_slices]
+    assert objective(cut.x0) == 0
+    grad = objective.gradient(cut.x0)
+    assert grad.shape == (objective.n_vars,)
+    assert not grad.any()
+
+def test_sparse_jacobian_matches_finite_differences(collection, random_points):
+    cut = collection_cut(collection)
+    objective = cut.objective
+    x = random_points(cut, 1, seed=4)[0]
+    jac = objective.sparse_jacobian(x)
+    assert jac.shape == (len(objective.fit_slices), objective.n_vars)
+    dense = finite_differences(objective.residuals, x)
+    np.testing.assert_allclose(jac.toarray(), dense, rtol=1e-4, atol=1e-7*np.abs(dense).max())
+    # A heavy end MW only moves the residuals of its own sample.
+    row_sample = objective.slice_sample[objective.fit_slices]
+    mw_jac = jac.toarray()[:, objective.mw_idx]
+    assert not mw_jac[row_sample[:, None] != np.arange(len(cut.mw_vars))].any()
+
+def test_least_squares_collection_fit_recovers_parameters():
+    rng = np.random.default_rng(5)
+    params = synthetic_parameters(4, rng)
+    samples = synthetic_collection(params, rng=rng)
+    fits = [samples.gamma_distribution_fit(verbose=False, solver=solver).set_index('Variables')
+            for solver in ('least_squares', 'SLSQP')]
+    sparse_fit, dense_fit = [df['Values'] for df in fits]
+    assert sparse_fit['RMSE'] <= dense_fit['RMSE']*(1+1e-3)
+    heavy_mws = [key.replace('.', '_')+'_heavy_mw' for key in samples.sample_names]
+    assert sparse_fit['alpha'] == pytest.approx(params[0][0], rel=1e-2)
+    np.testing.assert_allclose(sparse_fit[heavy_mws], [p[2] for p in params], rtol=5e-3)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the gamma splits and lumping: mole and mass conservation, the
+quadrature moments and consistency with the regression model.
+
+GitHub: https://github.com/dimmol/gamma_dist
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.special as sps
+
+from gamma_split import (boundary_split, equal_mass_split, fitted_parameters, lump,
+                         quadrature_split, to_frame)
+
+ALPHA = np.array([0.7, 0.7, 1.3, 2.5])
+ITA = np.array([125.0, 131.0, 128.0, 90.0])
+MW = np.array([210.0, 240.0, 225.0, 160.0])
+
+def assert_conserved(split, mw):
+    np.testing.assert_allclose(split['Zni'].sum(axis=1), 1.0, rtol=1e-10)
+    np.testing.assert_allclose(split['Wni'].sum(axis=1), 1.0, rtol=1e-10)
+    # The mole-weighted slice MWs add up to the heavy end MW.
+    np.testing.assert_allclose((split['Zni']*split['Mi']).sum(axis=1), mw, rtol=1e-10)
+
+def test_boundary_split_conserves_moles_and_mass():
+    bounds = np.append(np.arange(140.0, 700.0, 14.0), np.inf)
+    split = boundary_split(ALPHA, ITA, MW, bounds)
+    assert split['Mi'].shape == (len(ALPHA), len(bounds))
+    assert_conserved(split, MW)
+    # Every slice MW lies within its bounds.
+    lower = np.maximum(np.concatenate((ITA[:, None], split['bounds'][:, :-1]), axis=1), ITA[:, None])
+    assert (split['Mi'] >= lower-1e-9).all()
+    assert (split['Mi'] <= split['bounds']).all()
+
+def test_boundary_split_matches_regression_model(cut):
+    x = cut.init_vals.copy()
+    x[0] = 0.9
+    objective = cut.objective
+    ev = objective.evaluate(x)
+    # SCN bounds and the fixed plus fraction upper bound.
+    bounds = np.append(x[2:-1], cut.dfs[0]['ubound'].iloc[-1])
+    split = boundary_split(x[0], x[1], x[-1], bounds)
+    np.testing.assert_allclose(split['Mi'][0], ev['Mi'], rtol=1e-10)
+    np.testing.assert_allclose(split['Wni'][0], ev['Wni'], rtol=1e-8)
+
+@pytest.mark.parametrize('n_samples', [4, 200])
+def test_equal_mass_split(n_samples):
+    rng = np.random.default_rng(0)
+    ita = rng.uniform(120.0, 135.0, n_samples)
+    mw = rng.uniform(190.0, 260.0, n_samples)
+    alpha = np.where(np.arange(n_samples) % 2, 0.8, 1.6)
+    split = equal_mass_split(alpha, ita, mw, 10)
+    np.testing.assert_allclose(split['Wni'], 0.1, atol=1e-9)
+    assert_conserved(split, mw)
+    assert (np.diff(split['bounds'], axis=1) > 0).all()
+
+def test_quadrature_split_moments():
+    n = 5
+    split = quadrature_split(ALPHA, ITA, MW, n)
+    assert_conserved(split, MW)
+    beta = (MW-ITA)/ALPHA
+    # Moments of Y = (M-ita)/beta, gamma distributed with shape alpha, are
+    # exact up to the order 2n-1.
+    y = (split['Mi']-ITA[:, None])/beta[:, None]
+    for k in range(2*n):
+        moment = np.exp(sps.gammaln(ALPHA+k)-sps.gammaln(ALPHA))
+        np.testing.assert_allclose((split['Zni']*y**k).sum(axis=1), moment, rtol=1e-8)
+
+def test_lump_conserves_moles_and_mass():
+    split = equal_mass_split(ALPHA, ITA, MW, 12)
+    lumped = lump(split, [3, 4, 5])
+    assert lumped['Mi'].shape == (len(ALPHA), 3)
+    assert_conserved(lumped, MW)
+    np.testing.assert_allclose(lumped['Wni'][:, 0], split['Wni'][:, :3].sum(axis=1))
+    np.testing.assert_allclose(lumped['Zni'][:, 2], split['Zni'][:, 7:].sum(axis=1))
+    np.testing.assert_array_equal(lumped['bounds'], split['bounds'][:, [2, 6, 11]])
+    with pytest.raises(ValueError):
+        lump(split, [3, 4])
+    with pytest.raises(ValueError):
+        lump(split, [13, -1])
+
+def test_fitted_parameters_and_frame():
+    res_df = pd.DataFrame({'Variables': ['alpha', 'ita', 'mC10', 'mC11', 'S_1_heavy_mw',
+                                         'S_2_heavy_mw', 'RMSE'],
+                           'Values': [0.9, 130.0, 145.0, 160.0, 220.0, 230.0, 0.5]})
+    alpha, ita, mw = fitted_parameters(res_df)
+    np.testing.assert_array_equal(alpha, [0.9, 0.9])
+    np.testing.assert_array_equal(ita, [130.0, 130.0])
+    np.testing.assert_array_equal(mw, [220.0, 230.0])
+    df = to_frame(quadrature_split(alpha, ita, mw, 3), ['S_1', 'S_2'])
+    assert list(df['component']) == ['PC1', 'PC2', 'PC3']*2
+    assert list(df['sample_id']) == ['S_1']*3+['S_2']*3
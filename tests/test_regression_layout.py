@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of RegressionLayout: the C10+ layout against the original
+prepare_input and solver setup, other cuts and warm starts.
+
+GitHub: https://github.com/dimmol/gamma_dist
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmark import synthetic_liquid
+from conftest import AVE_MC10PLUS, ITA, SAMPLE_MW, collection_cut
+from gamma_distribution import RegressionLayout, gamma_distribution_fit
+
+# The C10+ input preparation and solver setup of the original script: ita,
+# the SCN bounds, alpha and the C10+ MW with 2% boxes (5% from C25 on) and no
+# boundaries on alpha.
+def original_setup(df, mw):
+    df = df.copy()
+    df['MWi_lab'] = df.apply(lambda x : x['wfi_lab']*mw/x['mfi_lab'], axis = 1)
+    df['ubound_init'] = df['MWi_lab']+(df['MWi_lab'].shift(-1)-df['MWi_lab'])/2
+    df['ubound_init'] = df['ubound_init'].fillna(100000)
+    df['ubound'] = 'm'+df['SCN']
+    df_top = pd.DataFrame([['C9']+[np.nan] * (len(df.columns)-1)], columns=df.columns)
+    df = pd.concat([df_top, df], ignore_index=True)
+    df['wni_lab'] = df['wfi_lab']/df['wfi_lab'].sum()
+    df.at[0,'ubound'] = 'ita'
+    df.iloc[-1, df.columns.get_loc('ubound')] = df.iloc[-1, df.columns.get_loc('ubound_init')]
+
+    reg_variables = np.concatenate((df.loc[df.index[0:-1], 'ubound'].unique(),
+                                    np.array(['alpha', 'ave_mC10plus'])))
+    init_vals = np.concatenate((df.loc[df.index[0:-1], 'ubound_init'],
+                                np.array([1.0, AVE_MC10PLUS])))
+    init_vals[np.isnan(init_vals)] = ITA
+    ub = init_vals+init_vals*0.02
+    ub[16:] = init_vals[16:]+init_vals[16:]*0.05
+    lb = init_vals-init_vals*0.02
+    lb[16:] = init_vals[16:]-init_vals[16:]*0.05
+    lb[27] = -np.inf
+    ub[27] = np.inf
+    return df, reg_variables, init_vals, lb, ub
+
+def test_c10_cut_matches_original_setup(comp_input, cut):
+    df, reg_variables, init_vals, lb, ub = original_setup(comp_input, SAMPLE_MW)
+    for column in ('SCN', 'mfi_lab', 'wfi_lab', 'MWi_lab', 'ubound_init', 'ubound', 'wni_lab'):
+        pd.testing.assert_series_equal(cut.dfs[0][column], df[column], check_dtype=False)
+    assert sorted(cut.reg_vars) == sorted(reg_variables)
+    order = [list(reg_variables).index(var) for var in cut.reg_vars]
+    np.testing.assert_allclose(cut.init_vals, init_vals[order])
+    np.testing.assert_allclose(cut.lb, lb[order])
+    np.testing.assert_allclose(cut.ub, ub[order])
+
+def test_cut_lumps_components_of_an_scn():
+    liquid, av_mw = synthetic_liquid(0.85, 130.0, 225.0)
+    layout = RegressionLayout([liquid], [av_mw])
+    df = layout.cut(7).dfs[0]
+    assert list(df['scn'][:3]) == ['C6', 'C7', 'C8']
+    c7 = liquid[liquid['scn'] == 'C7']
+    assert df['lqd_mp'].iloc[1] == pytest.approx(c7['lqd_mp'].sum())
+    assert df['lqd_wp'].iloc[1] == pytest.approx(c7['lqd_wp'].sum())
+    assert df['wni_lab'].sum() == pytest.approx(1.0)
+    # The C7+ MW from the lab MWs is the mass weighted mean of the C7+ rows.
+    heavy = liquid[liquid['scn'].isin(df['scn'][1:])]
+    assert layout.heavy_mw(0, 7) == pytest.approx(
+        heavy['lqd_wp'].sum()*av_mw/heavy['lqd_mp'].sum())
+
+def test_warm_start_reuses_fitted_bounds(collection):
+    values = collection.gamma_distribution_fit(n=10, verbose=False).set_index('Variables')['Values']
+    # The layout of the fit remembers its values.
+    cut = collection_cut(collection, 11, layout=collection.layout)
+    x0 = dict(zip(cut.reg_vars, cut.x0))
+    assert x0['alpha'] == values['alpha']
+    # The C10 upper bound becomes ita of the C11+ fit.
+    assert x0['ita'] == pytest.approx(np.clip(values['mC10'], cut.lb[1], cut.ub[1]))
+    k = list(cut.reg_vars).index('mC20')
+    assert x0['mC20'] == pytest.approx(np.clip(values['mC20'], cut.lb[k], cut.ub[k]))
+
+def test_warm_start_layout_follows_sample_changes(collection):
+    collection.gamma_distribution_fit(verbose=False, warm_start=True)
+    del collection['C.2']
+    res_df = collection.gamma_distribution_fit(verbose=False, warm_start=True)
+    assert collection.layout.sample_ids == ['C_1', 'C_3']
+    heavy_mws = [var for var in res_df['Variables'] if var.endswith('_heavy_mw')]
+    assert heavy_mws == ['C_1_heavy_mw', 'C_3_heavy_mw']
+
+def test_default_start_suits_every_cut(comp_input, layout):
+    # Sweeping the cut over one layout: the default initial values follow the cut.
+    for n in (10, 12, 15):
+        res_df = gamma_distribution_fit(comp_input, SAMPLE_MW, n=n, layout=layout)[0]
+        values = res_df.set_index('Variables')['Values']
+        assert values['RMSE'] < 1e-3
+        assert 'ave_mC%dplus' % n in values.index
+
+def test_isomers_are_lumped_into_their_scn():
+    liquid, av_mw = synthetic_liquid(0.85, 130.0, 225.0)
+    layout = RegressionLayout([liquid], [av_mw])
+    df = layout.cut(4).dfs[0]
+    assert list(df['scn'][:4]) == ['C3', 'C4', 'C5', 'C6']
+    for k, labels in ((4, ['iC4', 'nC4']), (5, ['C5', 'iC5', 'nC5'])):
+        rows = liquid[liquid['scn'].isin(labels)]
+        assert df['lqd_mp'].iloc[k-3] == pytest.approx(rows['lqd_mp'].sum())
+    assert layout.heavy_mw(0, 4) > layout.heavy_mw(0, 3)